@@ -0,0 +1,20 @@
+"""
+ASGI config for backend_server project.
+
+It exposes the ASGI callable as a module-level variable named ``application``, e.g. for
+``uvicorn backend_server.asgi:application``. Django 1.11 has no ASGI support of its own, see
+luacs_backend/asgi.py.
+"""
+
+import os
+
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend_server.settings")
+
+wsgi_application = get_wsgi_application()
+
+# Imports models, so Django must be set up first
+from luacs_backend.asgi import ASGIHandler  # noqa: E402
+
+application = ASGIHandler(wsgi_application)
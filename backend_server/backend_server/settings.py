@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/1.11/ref/settings/
 
 import os
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -43,6 +45,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'luacs_backend.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -79,17 +82,86 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'luacs_backend.permissions.TerminalTokenOrAdminUserPermission',
     ],
-    'PAGE_SIZE': 10
+    'DEFAULT_RENDERER_CLASSES': (
+        'rest_framework.renderers.JSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'rest_framework.parsers.JSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ),
+    'PAGE_SIZE': 10,
+    'DEFAULT_VERSIONING_CLASS': 'luacs_backend.versioning.AcceptHeaderOrQueryParameterVersioning',
+    'DEFAULT_VERSION': '1',
+    'ALLOWED_VERSIONS': ('1', '2'),
 }
 
+# MessagePack for terminal traffic, if the optional msgpack package is installed
+try:
+    import msgpack
+except ImportError:
+    pass
+else:
+    REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES'] += ('luacs_backend.renderers.MessagePackRenderer',)
+    REST_FRAMEWORK['DEFAULT_PARSER_CLASSES'] += ('luacs_backend.renderers.MessagePackParser',)
+
 
 # Database
 # https://docs.djangoproject.com/en/1.11/ref/settings/#databases
+#
+# Configured by the environment: LUACS_DB_ENGINE=postgresql (production, needs psycopg2) with
+# LUACS_DB_NAME, LUACS_DB_USER, LUACS_DB_PASSWORD, LUACS_DB_HOST and LUACS_DB_PORT, or sqlite (the
+# default, for small sites) with the database file in LUACS_DB_NAME. Connections are kept open for
+# LUACS_DB_CONN_MAX_AGE seconds (0 closes them after every request), put a pooler like PgBouncer in
+# front of PostgreSQL if many server processes are running.
+
+DB_ENGINE = os.environ.get('LUACS_DB_ENGINE', 'sqlite')
+if DB_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('LUACS_DB_NAME', 'luacs'),
+            'USER': os.environ.get('LUACS_DB_USER', ''),
+            'PASSWORD': os.environ.get('LUACS_DB_PASSWORD', ''),
+            'HOST': os.environ.get('LUACS_DB_HOST', ''),
+            'PORT': os.environ.get('LUACS_DB_PORT', ''),
+            'CONN_MAX_AGE': int(os.environ.get('LUACS_DB_CONN_MAX_AGE', 60)),
+        }
+    }
+elif DB_ENGINE == 'sqlite':
+    DATABASES = {
+        'default': {
+            # Applies LUACS_SQLITE_PRAGMAS and takes the write lock at the start of transactions
+            'ENGINE': 'luacs_backend.backends.sqlite3',
+            'NAME': os.environ.get('LUACS_DB_NAME', os.path.join(BASE_DIR, 'db.sqlite3')),
+            'CONN_MAX_AGE': int(os.environ.get('LUACS_DB_CONN_MAX_AGE', 60)),
+            'OPTIONS': {
+                # Seconds to wait for a lock held by another connection
+                'timeout': 20,
+            },
+        }
+    }
+else:
+    raise ImproperlyConfigured('Unknown LUACS_DB_ENGINE {!r}, expected sqlite or '
+                               'postgresql.'.format(DB_ENGINE))
+
+
+# Cache
+# https://docs.djangoproject.com/en/1.11/topics/cache/
+#
+# Holds the serialized device and terminal documents (see luacs_backend/documents.py). The local
+# memory cache is per process, with several server processes use a shared cache (e.g.,
+# 'django.core.cache.backends.filebased.FileBasedCache' with a directory in LOCATION), so that
+# invalidations reach all of them.
 
-DATABASES = {
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'luacs',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
     }
 }
 
@@ -131,3 +203,36 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/1.11/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# LUACS
+
+# In-process cache of terminal tokens (number of entries and seconds until an entry expires)
+LUACS_TERMINAL_CACHE_SIZE = 256
+LUACS_TERMINAL_CACHE_TTL = 60
+
+# Per view request metrics (exported at /luacs/metrics), requests with more database queries than
+# LUACS_QUERY_BUDGET are logged together with their SQL (None disables the check)
+LUACS_METRICS = True
+LUACS_QUERY_BUDGET = 50
+
+# Server-sent event stream of changes (/luacs/api/changes/stream/): seconds until the server closes
+# a stream (the client reconnects) and seconds between polls of the change log
+LUACS_STREAM_TIMEOUT = 300
+LUACS_STREAM_POLL_INTERVAL = 1
+
+# Seconds a cached device or terminal document may be served at most, device documents expire
+# earlier if one of their permissions does
+LUACS_DOCUMENT_CACHE_TIMEOUT = 300
+
+# Threads serving requests under ASGI (backend_server/asgi.py), idle change streams do not use one
+LUACS_ASGI_THREADS = 16
+
+# Applied to every new SQLite connection: write-ahead log (readers and the writer do not block each
+# other), fsync only at checkpoints (safe with WAL, a power loss may only lose the last
+# transactions) and a 20 MB page cache
+LUACS_SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -20000,
+}
@@ -1,7 +1,10 @@
 from django.contrib import admin
 from django.contrib.auth.models import User
+from django.db.models import Count, Prefetch
+from django.utils import timezone
 
-from .models import Profile, Device, DeviceStatus, Permission, PermissionGroup, Terminal
+from .models import (Profile, Device, DeviceStatus, Permission, PermissionGroup, Terminal,
+                     TZ_MAX)
 
 
 # TODO add permission model for django users?
@@ -11,22 +14,49 @@ class PermissionGroupAdmin(admin.ModelAdmin):
     list_display = ('name', 'devices', 'member_count', 'default_permission_days', 'max_unused_days')
     fields = ('name', 'default_permission_days', 'max_unused_days')
 
+    def get_queryset(self, request):
+        devices = Device.objects.only('pk', 'required_permission_group')
+        return super().get_queryset(request).annotate(
+            member_count=Count('members', distinct=True)).prefetch_related(
+                Prefetch('devices', queryset=devices))
+
     def devices(self, obj):
         return ", ".join([d.shortname for d in obj.devices.all()])
 
     def member_count(self, obj):
-        return len(obj.members.all())
+        return obj.member_count
+    member_count.admin_order_field = 'member_count'
 
 
 @admin.register(Permission)
 class PermissionAdmin(admin.ModelAdmin):
-    list_display = ('granted_to', 'permission_group', 'granted_until', 'last_used', 'valid_now')
+    list_display = ('granted_to', 'permission_group', 'granted_until', 'last_used', 'valid_until',
+                    'valid_now')
+    list_select_related = ('granted_to__user', 'permission_group')
     readonly_fields = ('last_used', 'granted_on')
     fieldsets = ((None, {'fields': ('granted_to', 'permission_group', 'granted_until', 
                                     'last_used')}),
                  ('Granter info', {'fields': ('granted_by', 'granted_on'),
                                    'classes': ['collapse']}))
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_last_used()
+
+    def last_used(self, obj):
+        return obj.last_used
+    last_used.admin_order_field = 'last_used'
+
+    def valid_until(self, obj):
+        return obj.effective_expiry if obj.effective_expiry != TZ_MAX else None
+    valid_until.admin_order_field = 'effective_expiry'
+    valid_until.empty_value_display = 'forever'
+
+    def valid_now(self, obj):
+        # The stored expiry, no need to look at the usage again
+        return obj.effective_expiry >= timezone.now()
+    valid_now.boolean = True
+    valid_now.admin_order_field = 'effective_expiry'
+
     def has_delete_permission(self, request, obj=None):
         return False
 
@@ -44,21 +74,31 @@ class PermissionProfileInline(admin.StackedInline):
 class ProfileAdmin(admin.ModelAdmin):
     def last_name(self, obj):
         return obj.user.last_name
+    last_name.admin_order_field = 'user__last_name'
 
     def first_name(self, obj):
         return obj.user.first_name
+    first_name.admin_order_field = 'user__first_name'
 
     def email(self, obj):
         return obj.user.email
+    email.admin_order_field = 'user__email'
 
     fields = ('user', ('id_type', 'id_string'),)
     list_display = ('last_name', 'first_name', 'email', 'id_type', 'id_string')
+    list_select_related = ('user',)
     inlines = [PermissionProfileInline]
 
 
 @admin.register(Device)
 class DeviceAdmin(admin.ModelAdmin):
     list_display = ('shortname', 'model_name', 'required_permission_group', 'terminal')
+    list_select_related = ('required_permission_group', 'terminal')
+
+    def get_queryset(self, request):
+        # Terminal.__str__ lists the terminal's devices
+        return super().get_queryset(request).prefetch_related(Prefetch(
+            'terminal__devices', queryset=Device.objects.only('pk', 'terminal')))
 
 
 @admin.register(Terminal)
@@ -66,14 +106,33 @@ class TerminalAdmin(admin.ModelAdmin):
     list_display = ('id', 'token', 'devices_list')
     fields = ('token', )
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(
+            device_count=Count('devices')).prefetch_related(
+                Prefetch('devices', queryset=Device.objects.only('pk', 'terminal')))
+
     def devices_list(self, obj):
         return ", ".join([d.shortname for d in obj.devices.all()])
+    devices_list.admin_order_field = 'device_count'
 
 
 @admin.register(DeviceStatus)
 class DeviceStatusAdmin(admin.ModelAdmin):
     # Original: https://gist.github.com/aaugustin/1388243
     actions = None
+    list_display = ('start_time', 'end_time', 'device', 'in_operation', 'user', 'change_reason')
+    # Date ranges filter on the start_time index. A date_hierarchy would list the years and months
+    # of all statuses on every page load, which needs a full table scan.
+    list_filter = ('start_time', 'in_operation', 'device')
+    list_select_related = ('device', 'authorization__granted_to__user')
+    # Counting the whole history on every page load is too expensive
+    show_full_result_count = False
+    # A select box would render every permission
+    raw_id_fields = ('authorization',)
+
+    def user(self, obj):
+        return obj.authorization.granted_to if obj.authorization else None
+    user.admin_order_field = 'authorization__granted_to__user__last_name'
 
     # We cannot call super().get_fields(request, obj) because that method calls
     # get_readonly_fields(request, obj), causing infinite recursion. Ditto for
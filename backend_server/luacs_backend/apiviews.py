@@ -1,13 +1,77 @@
+from datetime import datetime, timedelta
+import csv
+import hashlib
+import itertools
+import json
+
+from django.conf import settings
+from django.db.models import F, Max, Min, Prefetch, Q, Sum
+from django.http import StreamingHttpResponse
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.shortcuts import get_object_or_404
 from rest_framework import viewsets
+from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.decorators import detail_route, list_route
-from rest_framework.exceptions import NotFound
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework import mixins
+from rest_framework import status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
 
 from . import serializers
 from . import models
+from . import pagination
+from . import events
+from . import rollups
+from . import documents
+from .expansion import ExpandMixin, get_expand
+from .fieldsets import SparseFieldsMixin, get_fieldset, is_selected
+from .renderers import EventStreamRenderer
+from .versioning import CompactMixin
+
+
+class Echo:
+    '''File-like object that returns what is written, for streaming csv.writer output'''
+    def write(self, value):
+        return value
+
+
+def get_datetime_param(request, name):
+    '''Returns the query parameter as aware datetime, None if it was not given'''
+    value = request.query_params.get(name)
+    if value is None:
+        return None
+    try:
+        parsed = parse_datetime(value)
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise ValidationError({name: 'Expected an ISO 8601 date and time.'})
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def get_id_param(request, name):
+    '''Returns the query parameter as integer primary key, None if it was not given'''
+    value = request.query_params.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValidationError({name: 'Expected an id.'})
+
+
+def prefetch_devices(lookup):
+    '''Returns the lookups to prefetch for embedding the devices at lookup'''
+    return [Prefetch(lookup, queryset=models.Device.objects.select_related(
+                'current_status', 'required_permission_group').order_by('pk')),
+            models.PermissionGroup.prefetch_valid_permissions(
+                lookup + '__required_permission_group__permission_set')]
+
 
 class CreateListRetrieveViewSet(mixins.CreateModelMixin,
                                 mixins.ListModelMixin,
@@ -21,6 +85,85 @@ class CreateListRetrieveViewSet(mixins.CreateModelMixin,
     """
     pass
 
+
+class ConditionalRetrieveMixin:
+    '''
+    Answers retrieve requests with 304 Not Modified if their If-None-Match header matches the
+    ETag, without serializing the object
+
+    The ETag is derived from get_validator(instance, data), which must change whenever the
+    representation of the instance does, and from the API version, format and fieldset (see
+    fieldsets.py) of the request.
+    data is the serialized instance if it is already available. Responses with expanded objects
+    (see expansion.py) have no ETag, the embedded objects change independently.
+    '''
+    def get_validator(self, instance, data=None):
+        raise NotImplementedError('get_validator() must be implemented.')
+
+    def get_etag(self, request, instance, data=None):
+        return self.format_etag(request, self.get_validator(instance, data))
+
+    def format_etag(self, request, validator):
+        validator = '{}|{}|{}|{}'.format(validator, request.version,
+                                         request.accepted_renderer.format, get_fieldset(request))
+        return '"{}"'.format(hashlib.sha1(validator.encode()).hexdigest())
+
+    def conditional_response(self, request, instance):
+        if get_expand(request):
+            return Response(self.get_serializer(instance).data)
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            etag = self.get_etag(request, instance)
+            if etag in if_none_match:
+                return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        data = self.get_serializer(instance).data
+        if not if_none_match:
+            etag = self.get_etag(request, instance, data)
+        return Response(data, headers={'ETag': etag})
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(request, self.get_object())
+
+
+class CachedRetrieveMixin(ConditionalRetrieveMixin):
+    '''
+    Serves retrieve requests from the document cache (see documents.py), without database
+    queries if the document is cached
+
+    document is the name the serialized objects are cached under, get_document_timeout() may
+    shorten how long a document stays valid. Documents with expanded objects are not cached.
+    '''
+    document = None
+
+    def get_document_timeout(self, instance):
+        return None
+
+    def cached_response(self, request, pk, get_instance):
+        if get_expand(request):
+            return self.conditional_response(request, get_instance())
+        # Hyperlinks contain the host
+        variant = (request.version, request.build_absolute_uri('/'), get_fieldset(request))
+        version, cached = documents.get(self.document, pk, variant)
+        if cached is None:
+            instance = get_instance()
+            data = documents.to_plain(self.get_serializer(instance).data)
+            validator = self.get_validator(instance, data)
+            # Documents are invalidated by their primary key, not by other spellings of it
+            if str(pk) == str(instance.pk):
+                documents.store(self.document, pk, version, variant, (data, validator),
+                                self.get_document_timeout(instance))
+        else:
+            data, validator = cached
+        etag = self.format_etag(request, validator)
+        if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        return Response(data, headers={'ETag': etag})
+
+    def retrieve(self, request, *args, **kwargs):
+        pk = self.kwargs[self.lookup_url_kwarg or self.lookup_field]
+        return self.cached_response(request, pk, self.get_object)
+
+
 #class DeviceViewSet(viewsets.ViewSet):
 #    queryset = models.Device.objects.all()
 #    
@@ -38,15 +181,62 @@ class CreateListRetrieveViewSet(mixins.CreateModelMixin,
 #            querydata, permissions=permissions, context={'request': request})
 #        return Response(serializer.data)
 # TODO restrict all view to terminal specific information
-class DeviceViewSet(viewsets.ReadOnlyModelViewSet):
+class DeviceViewSet(CompactMixin, SparseFieldsMixin, CachedRetrieveMixin, ExpandMixin,
+                    viewsets.ReadOnlyModelViewSet):
     """
     API endpoint that allows devices to be viewed.
     """
-    queryset = models.Device.objects.all().order_by('pk')
+    queryset = models.Device.objects.select_related(
+        'current_status', 'required_permission_group').order_by('pk')
     serializer_class = serializers.DeviceSerializer
+    compact_serializer_class = serializers.CompactDeviceSerializer
+    document = documents.DEVICE
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        # One query for the valid permissions of all listed devices, unless they are left out
+        if is_selected(self.request, 'valid_permissions'):
+            queryset = queryset.prefetch_related(models.PermissionGroup.prefetch_valid_permissions(
+                'required_permission_group__permission_set'))
+        return queryset
+
+    def get_expand_prefetch(self):
+        return {'required_permission_group': ['required_permission_group__devices']}
+
+    def get_document_timeout(self, device):
+        # The document changes when the first of its permissions expires
+        if (device.required_permission_group_id is None or
+                not is_selected(self.request, 'valid_permissions')):
+            return None
+        expiry = models.Permission.objects.filter(
+            permission_group=device.required_permission_group_id,
+            effective_expiry__gte=timezone.now()).aggregate(
+                expiry=Min('effective_expiry'))['expiry']
+        if expiry is None or expiry == models.TZ_MAX:
+            return None
+        return max(0, (expiry - timezone.now()).total_seconds())
+
+    def get_validator(self, device, data=None):
+        # Changes of the device, its terminal, its permission group and its permissions
+        # (including their usage) are logged. Permissions also expire as time passes.
+        changes = Q(terminal_id=device.terminal_id)
+        if device.required_permission_group_id is not None:
+            changes |= Q(permission_group_id=device.required_permission_group_id)
+        if data is None:
+            permissions = device.get_valid_permissions()
+            # Prefetched
+            valid_permissions = (len(permissions) if isinstance(permissions, list)
+                                 else permissions.count())
+        elif 'valid_permissions' in data:
+            valid_permissions = len(data['valid_permissions'])
+        else:
+            # Left out by ?fields= or ?omit=
+            valid_permissions = None
+        return (models.Change.objects.filter(changes).last_seq(), device.current_status_id,
+                valid_permissions)
 
 
-class DeviceStatusViewSet(CreateListRetrieveViewSet):
+class DeviceStatusViewSet(CompactMixin, SparseFieldsMixin, CreateListRetrieveViewSet):
     """
     API endpoint that allows devices status to be viewed and added.
     """
@@ -55,47 +245,480 @@ class DeviceStatusViewSet(CreateListRetrieveViewSet):
     # TODO restrict asociation with user data to last five entries per device
     queryset = models.DeviceStatus.objects.all()
     serializer_class = serializers.DeviceStatusSerializer
+    compact_serializer_class = serializers.CompactDeviceStatusSerializer
+    pagination_class = pagination.StatusCursorPagination
+    export_fields = ('id', 'device', 'start_time', 'end_time', 'in_operation', 'authorization',
+                     'authorization__granted_to', 'change_reason')
+
+    def get_queryset(self):
+        '''
+        Supports filtering by device (?device=<shortname>), by user (?user=<profile id>), by a
+        point in time (?at=<datetime>) and by overlap with a time range
+        (?start=<datetime>&end=<datetime>).
+        '''
+        queryset = super().get_queryset()
+        user = get_id_param(self.request, 'user')
+        if user is not None:
+            queryset = queryset.filter(authorization__granted_to=user)
+        device = self.request.query_params.get('device')
+        at = get_datetime_param(self.request, 'at')
+        start = get_datetime_param(self.request, 'start')
+        end = get_datetime_param(self.request, 'end')
+        if device is not None:
+            queryset = queryset.filter(device=device)
+        if at is not None:
+            if device is not None:
+                held = get_object_or_404(models.Device, pk=device).status_at(at)
+                queryset = queryset.filter(pk=held.pk) if held else queryset.none()
+            else:
+                queryset = queryset.active_at(at)
+        if start is not None or end is not None:
+            queryset = queryset.overlapping(start or models.TZ_MIN, end or models.TZ_MAX)
+        return queryset
+
+    @list_route()
+    def export(self, request):
+        '''
+        Streams all statuses matching the filters as NDJSON (default) or CSV (?output=csv)
+
+        Rows are read with a server side iterator, so memory use does not depend on the size of
+        the export.
+        '''
+        output = request.query_params.get('output', 'ndjson')
+        if output not in ('ndjson', 'csv'):
+            raise ValidationError({'output': 'Expected ndjson or csv.'})
+        rows = self.get_queryset().order_by('start_time', 'id').values_list(
+            *self.export_fields).iterator()
+        header = [f.replace('authorization__granted_to', 'user') for f in self.export_fields]
 
+        encoder = JSONEncoder()
+        if output == 'csv':
+            writer = csv.writer(Echo())
+            content = itertools.chain([writer.writerow(header)], (
+                writer.writerow([encoder.default(v) if isinstance(v, datetime) else v
+                                 for v in row]) for row in rows))
+            content_type = 'text/csv'
+        else:
+            content = (encoder.encode(dict(zip(header, row))) + '\n' for row in rows)
+            content_type = 'application/x-ndjson'
+        response = StreamingHttpResponse(content, content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="device_status.{}"'.format(
+            output)
+        return response
 
-class TerminalViewSet(viewsets.ReadOnlyModelViewSet):
+    @list_route(methods=['post'])
+    def batch(self, request):
+        '''
+        Adds an ordered list of statuses (e.g., buffered while offline) in one transaction
+
+        Each item needs a client supplied event_id, resubmitted items are reported as duplicate.
+        Statuses must be newer than the current status of their device. Returns one result per
+        item, in the order of the request.
+        '''
+        if not isinstance(request.data, list):
+            raise ValidationError('Expected a list of statuses.')
+        events = []
+        results = []
+        for item in request.data:
+            event = serializers.DeviceStatusEventSerializer(data=item)
+            if event.is_valid():
+                events.append(event.validated_data)
+                results.append({'event_id': event.validated_data['event_id'],
+                                'status': 'created'})
+            else:
+                events.append(None)
+                results.append({'event_id': item.get('event_id') if isinstance(item, dict)
+                                else None, 'status': 'rejected', 'errors': event.errors})
+        valid_events = [e for e in events if e is not None]
+
+        # Constant number of lookups for all items
+        devices = models.Device.objects.select_related('current_status')
+        if request.terminal:
+            devices = devices.filter(terminal=request.terminal)
+        devices = devices.in_bulk({e['device'] for e in valid_events})
+        permission_groups = dict(models.Permission.objects.filter(
+            pk__in={e['authorization'] for e in valid_events if e['authorization']}
+        ).values_list('pk', 'permission_group'))
+        existing = set(models.DeviceStatus.objects.filter(
+            device__in=list(devices), event_id__in={e['event_id'] for e in valid_events}
+        ).values_list('device', 'event_id'))
+
+        statuses = []
+        seen = set()
+        for event, result in zip(events, results):
+            if event is None:
+                continue
+            device = devices.get(event['device'])
+            key = (event['device'], event['event_id'])
+            if device is None:
+                result.update(status='rejected', errors={'device': ['Unknown device.']})
+            elif key in existing or key in seen:
+                result['status'] = 'duplicate'
+            elif (event['authorization'] is not None and
+                    permission_groups.get(event['authorization']) !=
+                    device.required_permission_group_id):
+                result.update(status='rejected', errors={
+                    'authorization': ['Permission does not exist or is not for this device.']})
+            elif device.current_status and device.current_status.start_time > event['start_time']:
+                result.update(status='rejected', errors={
+                    'start_time': ['Older than the current status of the device.']})
+            else:
+                seen.add(key)
+                statuses.append(models.DeviceStatus(
+                    device=device, event_id=event['event_id'], start_time=event['start_time'],
+                    in_operation=event['in_operation'], authorization_id=event['authorization'],
+                    change_reason=event['change_reason']))
+        if statuses:
+            models.DeviceStatus.objects.append(statuses)
+            # Inserted in bulk, without signals
+            documents.invalidate(documents.DEVICE, [s.device_id for s in statuses])
+            documents.invalidate_groups(permission_groups[s.authorization_id]
+                                        for s in statuses if s.authorization_id is not None)
+        return Response({'results': results})
+
+
+class TerminalViewSet(CompactMixin, SparseFieldsMixin, CachedRetrieveMixin, ExpandMixin,
+                      viewsets.ReadOnlyModelViewSet):
     """
     API endpoint that allows terminals to be viewed.
     """
     queryset = models.Terminal.objects.all().order_by('pk')
     serializer_class = serializers.TerminalSerializer
-    
+    compact_serializer_class = serializers.CompactTerminalSerializer
+    document = documents.TERMINAL
+
+    def get_expand_prefetch(self):
+        return {'devices': prefetch_devices('devices')}
+
     @list_route()
     def myself(self, request):
         '''Returns only the terminal object associated with the requests auth token'''
         if request.terminal:
-            return Response(self.get_serializer(request.terminal).data)
+            return self.cached_response(request, request.terminal.pk,
+                                        lambda: self.expand_instance(request.terminal))
         else:
             raise NotFound(detail='No terminal is associated with this request.')
 
+    def get_validator(self, terminal, data=None):
+        # Devices added to or removed from a terminal are logged with its scope
+        return models.Change.objects.filter(terminal_id=terminal.pk).last_seq()
 
-class ProfileViewSet(viewsets.ReadOnlyModelViewSet):
+    @list_route()
+    def snapshot(self, request):
+        '''
+        Returns everything the requests terminal needs to authorize users locally
+
+        The snapshot carries a version (also sent as ETag), a request with a matching
+        If-None-Match header is answered with 304 Not Modified.
+        '''
+        if not request.terminal:
+            raise NotFound(detail='No terminal is associated with this request.')
+        # Read before building the snapshot, so that no change can slip through in between
+        seq = models.Change.objects.last_seq()
+        snapshot = {
+            'terminal': request.terminal.id,
+            'devices': {
+                d.shortname: {'model_name': d.model_name,
+                              'required_permission_group': d.required_permission_group_id,
+                              'automatic_logout': d.automatic_logout_seconds,
+                              'allow_logout_during_operation': d.allow_logout_during_operation}
+                for d in request.terminal.devices.all()},
+            'credentials': request.terminal.get_cache_permissions(),
+        }
+        snapshot['version'] = hashlib.sha1(json.dumps(
+            snapshot, sort_keys=True, cls=JSONEncoder).encode()).hexdigest()
+        # Not part of the version, replaying already included changes is harmless
+        snapshot['seq'] = seq
+        etag = '"{}"'.format(snapshot['version'])
+        if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        return Response(snapshot, headers={'ETag': etag})
+
+
+class ChangeViewSet(SparseFieldsMixin, viewsets.GenericViewSet):
+    """
+    API endpoint that lists changes after a sequence number (?since=<seq>).
+
+    Terminals only receive changes relevant to them. If changes after `since` were already pruned
+    from the log, 410 Gone is returned and the client must resync in full (e.g., by fetching the
+    snapshot). /changes/stream/ pushes the same changes as server-sent events.
+
+    `last_seq` (the `since` of the next request) may skip over changes, but only up to the newest
+    committed change: every change with a lower sequence number is visible as well, as inserts
+    into the change log wait for each other's transactions (see ChangeQuerySet.lock_for_insert).
+    """
+    queryset = models.Change.objects.all()
+    serializer_class = serializers.ChangeSerializer
+    page_size = 500
+
+    def get_since(self, value):
+        try:
+            return int(value)
+        except ValueError:
+            raise ValidationError({'since': 'Expected a sequence number.'})
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.request.terminal:
+            queryset = queryset.relevant_to(self.request.terminal)
+        return queryset
+
+    def list(self, request):
+        since = self.get_since(request.query_params.get('since', 0))
+        bounds = models.Change.objects.aggregate(first=Min('seq'), last=Max('seq'))
+        # Everything before the oldest entry has been pruned
+        if bounds['first'] is not None and since < bounds['first'] - 1:
+            return Response({'resync': True, 'detail': 'Changes since {} are no longer '
+                                                       'available.'.format(since)},
+                            status=status.HTTP_410_GONE)
+
+        queryset = self.get_queryset().filter(seq__gt=since)
+        changes = list(queryset.order_by('seq')[:self.page_size + 1])
+        more = len(changes) > self.page_size
+        changes = changes[:self.page_size]
+        if more:
+            last_seq = changes[-1].seq
+        else:
+            # Skip over irrelevant changes as well
+            last_seq = max([bounds['last'] or 0, since] + [c.seq for c in changes[-1:]])
+        return Response({'resync': False, 'since': since, 'last_seq': last_seq, 'more': more,
+                         'changes': self.get_serializer(changes, many=True).data})
+
+    @list_route(renderer_classes=[EventStreamRenderer, JSONRenderer])
+    def stream(self, request):
+        '''
+        Streams relevant changes as server-sent events
+
+        Resumes after the Last-Event-ID header or ?since=<seq>, without either only new changes
+        are sent. The server closes the stream after LUACS_STREAM_TIMEOUT seconds, clients
+        reconnect with the id of the last event they received. If the changes to resume from were
+        already pruned, a single "resync" event is sent instead.
+        '''
+        since = request.META.get('HTTP_LAST_EVENT_ID', request.query_params.get('since'))
+        since = events.resume_after(None if since is None else self.get_since(since))
+        if since is None:
+            return StreamingHttpResponse([events.RESYNC_EVENT], content_type='text/event-stream')
+
+        response = StreamingHttpResponse(events.change_events(
+            self.get_queryset(), since, timeout=settings.LUACS_STREAM_TIMEOUT,
+            interval=settings.LUACS_STREAM_POLL_INTERVAL), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # Disables response buffering of nginx
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+class ProfileViewSet(CompactMixin, SparseFieldsMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint that allows profiles to be viewed.
     """
     # TODO allow insertion of a new Profile and User
     # TODO allow update of users meta data if they have the magical url
-    queryset = models.Profile.objects.all().order_by('pk')
+    queryset = models.Profile.objects.select_related('user').order_by('pk')
     serializer_class = serializers.ProfileSerializer
+    compact_serializer_class = serializers.CompactProfileSerializer
+
+    @list_route()
+    def lookup(self, request):
+        '''Returns the profile identified by the id_type and id_string query parameters'''
+        id_type = request.query_params.get('id_type')
+        id_string = request.query_params.get('id_string')
+        if not id_type or not id_string:
+            raise ValidationError('Both id_type and id_string are required.')
+        # Exact match on the unique (id_type, id_string) index
+        profile = get_object_or_404(self.get_queryset(), id_type=id_type, id_string=id_string)
+        return Response(self.get_serializer(profile).data)
 
 
-class PermissionViewSet(viewsets.ModelViewSet):
+class PermissionViewSet(CompactMixin, SparseFieldsMixin, ConditionalRetrieveMixin, ExpandMixin,
+                        viewsets.ModelViewSet):
     """
     API endpoint that allows Permissions to be viewed or edited.
     """
     # TODO allow insertion of new permissions (and invalidation of any preceeding)
-    queryset = (models.Permission.objects.filter(granted_until__gte=timezone.now()) |
-                models.Permission.objects.filter(granted_until__isnull=True)).order_by('granted_on')
+    queryset = models.Permission.objects.all().order_by('granted_on')
     serializer_class = serializers.PermissionSerializer
+    compact_serializer_class = serializers.CompactPermissionSerializer
+    pagination_class = pagination.PermissionCursorPagination
 
+    def get_queryset(self):
+        '''
+        Only valid permissions, optionally filtered by profile (?granted_to=<id>), permission
+        group (?permission_group=<id>) or the group required by a device (?device=<shortname>)
+        '''
+        # Validity depends on the current time, so it must be evaluated per request
+        return self.filter_queryset_by_params(super().get_queryset().valid())
 
-class PermissionGroupViewSet(viewsets.ModelViewSet):
+    def filter_queryset_by_params(self, queryset):
+        # Served by the (granted_to, permission_group) and (permission_group, effective_expiry)
+        # indexes
+        profile = get_id_param(self.request, 'granted_to')
+        if profile is not None:
+            queryset = queryset.filter(granted_to=profile)
+        group = get_id_param(self.request, 'permission_group')
+        if group is not None:
+            queryset = queryset.filter(permission_group=group)
+        device = self.request.query_params.get('device')
+        if device is not None:
+            queryset = queryset.filter(permission_group__devices=device)
+        return queryset
+
+    def get_expand_prefetch(self):
+        return {'granted_to': [Prefetch('granted_to',
+                                        queryset=models.Profile.objects.select_related('user'))],
+                'permission_group': ['permission_group__devices']}
+
+    def get_validator(self, permission, data=None):
+        # Changes of the permission, its group and its usage are logged with the group's scope
+        return models.Change.objects.filter(
+            permission_group_id=permission.permission_group_id).last_seq()
+
+    def get_days(self, default):
+        try:
+            days = int(self.request.query_params.get('days', default))
+        except ValueError:
+            raise ValidationError({'days': 'Expected a number of days.'})
+        if days < 0:
+            raise ValidationError({'days': 'Must not be negative.'})
+        return timedelta(days=days)
+
+    @list_route()
+    def expiring(self, request):
+        '''Valid permissions that expire within ?days=<n> (default: 14)'''
+        now = timezone.now()
+        queryset = self.filter_queryset_by_params(
+            super().get_queryset().expiring(now, now + self.get_days(14)))
+        page = self.paginate_queryset(queryset)
+        return self.get_paginated_response(self.get_serializer(page, many=True).data)
+
+    @list_route()
+    def lapsed(self, request):
+        '''Permissions that expired through non-use within the last ?days=<n> (default: 30)'''
+        now = timezone.now()
+        # Otherwise they ended at granted_until
+        queryset = self.filter_queryset_by_params(
+            super().get_queryset().expiring(now - self.get_days(30), now).exclude(
+                granted_until=F('effective_expiry')))
+        page = self.paginate_queryset(queryset)
+        return self.get_paginated_response(self.get_serializer(page, many=True).data)
+
+
+class PermissionGroupViewSet(CompactMixin, SparseFieldsMixin, ExpandMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows Permission Groups to be viewed or edited.
     """
     queryset = models.PermissionGroup.objects.all().order_by('pk')
     serializer_class = serializers.PermissionGroupSerializer
+    compact_serializer_class = serializers.CompactPermissionGroupSerializer
+
+    def get_expand_prefetch(self):
+        return {'devices': prefetch_devices('devices')}
+
+
+class UsageViewSet(SparseFieldsMixin, mixins.ListModelMixin, viewsets.GenericViewSet):
+    """
+    API endpoint for device utilization, answered from the hourly and daily usage rollups.
+
+    The rollups are updated periodically by the rollup_usage command, the summary tells up to
+    which time (`rolled_up_until`).
+    """
+    queryset = models.UsageRollup.objects.all()
+    serializer_class = serializers.UsageRollupSerializer
+    pagination_class = pagination.UsageCursorPagination
+
+    def get_queryset(self):
+        '''
+        Supports ?period=hour|day (default: day) and filtering by device (?device=<shortname>),
+        permission group (?permission_group=<id>) and buckets starting within
+        ?start=<datetime>&end=<datetime>.
+        '''
+        period = self.request.query_params.get('period', models.UsageRollup.DAY)
+        if period not in dict(models.UsageRollup.PERIODS):
+            raise ValidationError({'period': 'Expected hour or day.'})
+        queryset = super().get_queryset().filter(period=period)
+        device = self.request.query_params.get('device')
+        if device is not None:
+            queryset = queryset.filter(device=device)
+        group = get_id_param(self.request, 'permission_group')
+        if group is not None:
+            queryset = queryset.filter(permission_group=group)
+        start = get_datetime_param(self.request, 'start')
+        if start is not None:
+            queryset = queryset.filter(bucket__gte=start)
+        end = get_datetime_param(self.request, 'end')
+        if end is not None:
+            queryset = queryset.filter(bucket__lt=end)
+        return queryset
+
+    @list_route()
+    def summary(self, request):
+        '''
+        Totals per device (?group_by=device) or permission group (?group_by=permission_group)
+        within ?start and ?end, by default the 30 days before the rollups end. For devices,
+        utilization is the share of that time the device was in use.
+        '''
+        group_by = request.query_params.get('group_by', 'device')
+        if group_by not in ('device', 'permission_group'):
+            raise ValidationError({'group_by': 'Expected device or permission_group.'})
+        rolled_up_until = rollups.watermark()
+        end = get_datetime_param(request, 'end') or rolled_up_until or timezone.now()
+        start = get_datetime_param(request, 'start') or end - timedelta(days=30)
+        totals = self.get_queryset().filter(bucket__gte=start, bucket__lt=end).values(
+            group_by).annotate(usage_minutes=Sum('usage_minutes'),
+                               operated_minutes=Sum('operated_minutes'),
+                               sessions=Sum('sessions')).order_by(group_by)
+        minutes = (end - start).total_seconds() / 60
+        results = []
+        for total in totals:
+            if group_by == 'device':
+                total['utilization'] = total['usage_minutes'] / minutes if minutes > 0 else None
+            results.append(total)
+        return Response({'rolled_up_until': rolled_up_until, 'start': start, 'end': end,
+                         'results': results})
+
+
+class AuthorizeView(APIView):
+    """
+    API endpoint that decides whether a credential may use a device.
+
+    Expects `device` (shortname), `id_type` and `id_string` and answers with the decision, the
+    user's name and the device's logout policy.
+    """
+    def post(self, request):
+        query = serializers.AuthorizationRequestSerializer(data=request.data)
+        query.is_valid(raise_exception=True)
+        query = query.validated_data
+
+        devices = models.Device.objects.all()
+        if request.terminal:
+            devices = devices.filter(terminal=request.terminal)
+        device = get_object_or_404(devices, shortname=query['device'])
+        data = {
+            'authorized': False,
+            'reason': None,
+            'permission': None,
+            'valid_until': None,
+            'user': None,
+            'device': {
+                'shortname': device.shortname,
+                'automatic_logout': device.automatic_logout_seconds,
+                'allow_logout_during_operation': device.allow_logout_during_operation,
+            },
+        }
+
+        profile = models.Profile.objects.select_related('user').filter(
+            id_type=query['id_type'], id_string=query['id_string']).first()
+        if profile is None:
+            data['reason'] = 'unknown credential'
+            return Response(data)
+        data['user'] = {'id': profile.id, 'name': profile.display_name}
+
+        permission = models.Permission.objects.valid().filter(
+            granted_to=profile, permission_group=device.required_permission_group_id
+        ).order_by('-valid_until').first()
+        if permission is None:
+            data['reason'] = 'no valid permission'
+            return Response(data)
+        data.update(authorized=True, permission=permission.id,
+                    valid_until=permission.valid_until)
+        return Response(data)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class LuacsBackendConfig(AppConfig):
     name = 'luacs_backend'
     verbose_name = 'LUACS Backend'
+
+    def ready(self):
+        # Connects the invalidation receivers in every process, including management commands
+        from . import documents  # noqa: F401
@@ -0,0 +1,250 @@
+'''
+ASGI adapter
+
+Django 1.11 only implements WSGI. ASGIHandler (see backend_server/asgi.py) runs Django's WSGI
+handler in a thread pool, one thread per request like a threaded WSGI server. The change event
+stream of terminals (/luacs/api/changes/stream/) is served by a coroutine instead: only its
+database polls run in the pool, so idle streams do not hold a thread. One process can keep
+hundreds of terminals connected while the pool serves their authorizations, statuses and
+snapshots.
+
+Requests to the stream without a valid terminal token are passed to Django, which answers them
+(e.g., with 403) like any other request.
+'''
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import io
+import sys
+import threading
+from urllib.parse import parse_qs
+
+from django.conf import settings
+from django.db import connections
+from django.urls import reverse
+
+from . import events
+from . import models
+from .permissions import get_terminal
+
+
+def release_connections():
+    '''Closes the current thread's database connections that are too old, like after requests'''
+    for connection in connections.all():
+        if not connection.in_atomic_block:
+            connection.close_if_unusable_or_obsolete()
+
+
+def get_environ(scope, body):
+    '''Returns the WSGI environ of an ASGI http scope'''
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        # WSGI strings are latin-1 decoded bytes
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    # The body has been read completely
+    environ.setdefault('CONTENT_LENGTH', str(len(body)))
+    return environ
+
+
+# Response chunks a thread may produce ahead of the client
+QUEUE_SIZE = 8
+
+
+async def drain(queue):
+    '''Consumes the queue until None'''
+    while (await queue.get()) is not None:
+        pass
+
+
+async def disconnect(receive):
+    '''Returns once the client disconnected'''
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+def get_header(scope, name):
+    for header, value in scope.get('headers', []):
+        if header.decode('latin-1').lower() == name:
+            return value.decode('latin-1')
+    return None
+
+
+class ASGIHandler:
+    '''ASGI 3 application serving a Django WSGI application'''
+    def __init__(self, wsgi_application, executor=None):
+        self.wsgi_application = wsgi_application
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers=getattr(settings, 'LUACS_ASGI_THREADS', 16))
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope type {}'.format(scope['type']))
+        elif scope['method'] == 'GET' and scope['path'] == reverse('change-stream'):
+            await self.stream(scope, receive, send)
+        else:
+            await self.wsgi(scope, receive, send)
+
+    def run(self, function, *args):
+        '''Runs function in the thread pool, returns an awaitable of the result'''
+        def job():
+            try:
+                return function(*args)
+            finally:
+                release_connections()
+        return asyncio.get_event_loop().run_in_executor(self.executor, job)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def wsgi(self, scope, receive, send):
+        '''Passes the request to the WSGI application, which runs in the thread pool'''
+        body = b''
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        loop = asyncio.get_event_loop()
+        # Filled by the thread, which waits while the queue is full: a streaming response (e.g.,
+        # the status export) is produced as fast as the client reads it, not buffered
+        messages = asyncio.Queue(maxsize=QUEUE_SIZE)
+        closed = threading.Event()
+
+        def put(message):
+            asyncio.run_coroutine_threadsafe(messages.put(message), loop).result()
+
+        def respond():
+            response = {}
+
+            def start_response(status, headers, exc_info=None):
+                response['start'] = {
+                    'type': 'http.response.start', 'status': int(status.split(' ', 1)[0]),
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                for name, value in headers]}
+
+            try:
+                result = self.wsgi_application(get_environ(scope, body), start_response)
+                try:
+                    for chunk in result:
+                        if closed.is_set():
+                            break
+                        if 'start' in response:
+                            put(response.pop('start'))
+                        if chunk:
+                            put({'type': 'http.response.body', 'body': chunk,
+                                 'more_body': True})
+                finally:
+                    if hasattr(result, 'close'):
+                        result.close()
+                if 'start' in response:
+                    put(response.pop('start'))
+            finally:
+                put(None)
+
+        done = self.run(respond)
+        finished = False
+        try:
+            while True:
+                message = await messages.get()
+                if message is None:
+                    finished = True
+                    break
+                await send(message)
+        finally:
+            if not finished:
+                # Sending failed, stop the response and release the waiting thread
+                closed.set()
+                asyncio.ensure_future(drain(messages))
+        # Raises the exception of the WSGI application, if any (the server answers with 500)
+        await done
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+    def start_stream(self, scope):
+        '''
+        Returns the terminal and sequence number to stream after, or (None, None) if the request
+        is left to Django
+        '''
+        authorization = (get_header(scope, 'authorization') or '').split()
+        if len(authorization) != 2 or authorization[0].lower() != 'token':
+            return None, None
+        terminal = get_terminal(authorization[1])
+        since = get_header(scope, 'last-event-id')
+        if since is None:
+            since = parse_qs(scope.get('query_string', b'').decode('latin-1')).get(
+                'since', [None])[0]
+        try:
+            since = None if since is None else int(since)
+        except ValueError:
+            # Answered with 400
+            return None, None
+        if terminal is None:
+            return None, None
+        return terminal, events.resume_after(since)
+
+    async def stream(self, scope, receive, send):
+        '''The change event stream, see ChangeViewSet.stream()'''
+        terminal, since = await self.run(self.start_stream, scope)
+        if terminal is None:
+            await self.wsgi(scope, receive, send)
+            return
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no')]})
+        if since is None:
+            await send({'type': 'http.response.body', 'body': events.RESYNC_EVENT.encode()})
+            return
+
+        polls = events.poll_events(
+            models.Change.objects.relevant_to(terminal), since,
+            timeout=settings.LUACS_STREAM_TIMEOUT, interval=settings.LUACS_STREAM_POLL_INTERVAL)
+        disconnected = asyncio.ensure_future(disconnect(receive))
+        try:
+            while True:
+                # Polls in the thread pool
+                chunk = await self.run(next, polls, None)
+                if chunk is None:
+                    break
+                if isinstance(chunk, float):
+                    # Waits without holding a thread, returns early if the client disconnected
+                    await asyncio.wait([disconnected], timeout=chunk)
+                    if disconnected.done():
+                        return
+                else:
+                    await send({'type': 'http.response.body', 'body': chunk.encode(),
+                                'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
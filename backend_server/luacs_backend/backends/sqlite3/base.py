@@ -0,0 +1,22 @@
+'''
+SQLite backend tuned for concurrent writers
+
+Applies LUACS_SQLITE_PRAGMAS to every new connection. With the default settings the database uses
+a write-ahead log, so that readers do not block the writer and vice versa, and waits for locks
+instead of failing with "database is locked". Transactions (atomic blocks) take the write lock
+when they begin: a deferred transaction that reads first cannot wait for the lock once another
+connection has written in the meantime, it fails immediately.
+'''
+from django.conf import settings
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for pragma, value in getattr(settings, 'LUACS_SQLITE_PRAGMAS', {}).items():
+            conn.execute('PRAGMA {} = {}'.format(pragma, value))
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute('BEGIN IMMEDIATE')
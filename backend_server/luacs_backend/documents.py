@@ -0,0 +1,168 @@
+'''
+Document cache
+
+Serialized device and terminal documents are kept in Django's cache (see CACHES in the settings),
+so that terminals polling their configuration are answered without database queries. A document
+is stored per API version and host (hyperlinks contain it), together with the validator of its
+ETag. Every variant has its own cache key, which contains the current version of the document,
+so storing a variant never overwrites another one.
+
+Entries are invalidated through signals when the device, its terminal, its permission group, one
+of the group's permissions or the device's status changes. Code that changes these without
+going through the models (queryset updates, bulk inserts) has to call invalidate() or
+invalidate_groups() itself. Invalidating drops the version of the document, right away and again
+when the transaction commits, as documents read by other requests before the commit are stale.
+Every entry expires after LUACS_DOCUMENT_CACHE_TIMEOUT seconds at the latest, which also bounds
+how long another process may serve a stale document if the cache is not shared between
+processes (like the default locmem cache).
+'''
+from collections import OrderedDict
+import hashlib
+from urllib.parse import quote
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from django.dispatch import receiver
+
+from . import models
+from .metrics import registry
+
+
+DEVICE = 'device'
+TERMINAL = 'terminal'
+
+
+def get_key(document, pk):
+    # Quoted, primary keys taken from URLs may contain characters cache keys must not
+    return 'luacs:document:{}:{}'.format(document, quote(str(pk), safe=''))
+
+
+def get_variant_key(document, pk, version, variant):
+    return '{}:{}:{}'.format(get_key(document, pk), version,
+                             hashlib.sha1(repr(variant).encode()).hexdigest())
+
+
+def get_timeout():
+    return getattr(settings, 'LUACS_DOCUMENT_CACHE_TIMEOUT', 300)
+
+
+def get(document, pk, variant):
+    '''
+    Returns the version of the document and the cached value of a variant (None if not cached)
+
+    The version is created if the document has none. A value read from the database afterwards
+    has to be stored with this version, it is dropped if the document was invalidated meanwhile.
+    '''
+    key = get_key(document, pk)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, get_timeout())
+        version = cache.get(key)
+        value = None
+    else:
+        value = cache.get(get_variant_key(document, pk, version, variant))
+    registry.inc('luacs_document_cache_total', help_text='Document cache lookups',
+                 document=document, result='miss' if value is None else 'hit')
+    return version, value
+
+
+def to_plain(data):
+    '''
+    Returns serialized data with plain containers and strings
+
+    Hyperlinks reference the linked object, pickling them would load it (e.g., every profile of
+    a device's permissions).
+    '''
+    if isinstance(data, dict):
+        return OrderedDict((key, to_plain(value)) for key, value in data.items())
+    if isinstance(data, list):
+        return [to_plain(value) for value in data]
+    if isinstance(data, str):
+        return str(data)
+    return data
+
+
+def store(document, pk, version, variant, value, timeout=None):
+    '''
+    Caches a variant of a version of the document (see get()) for timeout seconds (default: the
+    configured timeout)
+    '''
+    if version is None:
+        # Not cached at all (e.g., timeout 0)
+        return
+    default = get_timeout()
+    timeout = default if timeout is None else min(timeout, default)
+    cache.set(get_variant_key(document, pk, version, variant), value, timeout)
+
+
+def invalidate(document, pks):
+    '''Removes the documents with the given primary keys (None is ignored)'''
+    keys = [get_key(document, pk) for pk in set(pks) if pk is not None]
+    if keys:
+        # Right away, so that the transaction does not read its own stale documents
+        cache.delete_many(keys)
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def invalidate_groups(group_ids):
+    '''Removes the documents of the devices requiring one of the permission groups'''
+    group_ids = {pk for pk in group_ids if pk is not None}
+    if group_ids:
+        invalidate(DEVICE, models.Device.objects.filter(
+            required_permission_group__in=group_ids).values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=models.Terminal)
+@receiver(post_delete, sender=models.Terminal)
+def terminal_changed(sender, instance, **kwargs):
+    invalidate(TERMINAL, [instance.pk])
+
+
+@receiver(post_save, sender=models.Device)
+@receiver(post_delete, sender=models.Device)
+def device_changed(sender, instance, **kwargs):
+    invalidate(DEVICE, [instance.pk])
+    # The device lists of its terminal, and of the terminal it was moved away from
+    invalidate(TERMINAL, [instance.terminal_id, getattr(instance, '_previous_terminal_id', None)])
+
+
+@receiver(post_save, sender=models.PermissionGroup)
+def permission_group_changed(sender, instance, **kwargs):
+    invalidate_groups([instance.pk])
+
+
+@receiver(pre_delete, sender=models.PermissionGroup)
+def permission_group_deleted(sender, instance, **kwargs):
+    # Its devices are updated (required_permission_group set to null) without signals
+    invalidate_groups([instance.pk])
+
+
+@receiver(pre_save, sender=models.Permission)
+def remember_previous_permission_group(sender, instance, **kwargs):
+    if not instance._state.adding:
+        instance._previous_permission_group_id = models.Permission.objects.filter(
+            pk=instance.pk).values_list('permission_group', flat=True).first()
+
+
+@receiver(post_save, sender=models.Permission)
+@receiver(post_delete, sender=models.Permission)
+def permission_changed(sender, instance, **kwargs):
+    invalidate_groups([instance.permission_group_id,
+                       getattr(instance, '_previous_permission_group_id', None)])
+
+
+@receiver(post_save, sender=models.DeviceStatus)
+@receiver(post_delete, sender=models.DeviceStatus)
+def device_status_changed(sender, instance, **kwargs):
+    # The current status of the device, and the validity of the authorizing permissions (see
+    # models.remember_previous_authorization)
+    invalidate(DEVICE, [instance.device_id])
+    authorizations = {instance.authorization_id,
+                      getattr(instance, '_previous_authorization_id', None)} - {None}
+    if authorizations:
+        invalidate(DEVICE, models.Device.objects.filter(
+            required_permission_group__permission__in=authorizations).values_list(
+                'pk', flat=True))
@@ -0,0 +1,96 @@
+'''
+Server-sent events
+
+change_events() turns the change log into a text/event-stream. It polls the database for changes
+after the last sent sequence number, at most batch_size rows at a time, so a connection holds
+no more than one batch in memory however far behind the client is. The sequence number is the
+event id, clients resume by reconnecting with the Last-Event-ID header.
+'''
+import json
+import time
+
+from django.db.models import Min
+from rest_framework.utils.encoders import JSONEncoder
+
+from .models import Change
+from .serializers import ChangeSerializer
+
+
+# Comment lines keep proxies from closing idle connections
+HEARTBEAT_SECONDS = 15
+# Reconnection delay suggested to clients (milliseconds)
+RETRY_MILLISECONDS = 1000
+# Sent instead of changes, if the changes to resume from were pruned
+RESYNC_EVENT = 'event: resync\ndata: {"resync": true}\n\n'
+
+
+def format_event(data, event=None, id=None):
+    '''Returns one event in the text/event-stream format'''
+    lines = []
+    if id is not None:
+        lines.append('id: {}'.format(id))
+    if event is not None:
+        lines.append('event: {}'.format(event))
+    lines.append('data: {}'.format(json.dumps(data, cls=JSONEncoder)))
+    return '\n'.join(lines) + '\n\n'
+
+
+def resume_after(since):
+    '''
+    Returns the sequence number to stream changes after, given the one of the last event the
+    client received (None for only new changes). Returns None if changes after since were pruned
+    already, the client then has to resync.
+    '''
+    if since is None:
+        return Change.objects.last_seq()
+    first = Change.objects.aggregate(first=Min('seq'))['first']
+    if first is not None and since < first - 1:
+        return None
+    return since
+
+
+def next_events(changes, since, batch_size=100):
+    '''Returns (seq, event) of up to batch_size changes after since'''
+    return [(change.seq, format_event(ChangeSerializer(change).data, event='change',
+                                      id=change.seq))
+            for change in changes.filter(seq__gt=since).order_by('seq')[:batch_size]]
+
+
+def poll_events(changes, since, timeout, interval, batch_size=100):
+    '''
+    Yields the text of the stream, and the number of seconds to wait (a float) before polling
+    again once all pending changes were sent, until timeout seconds have passed
+
+    The caller waits, so that the ASGI handler can do so without holding a thread.
+    '''
+    deadline = time.monotonic() + timeout
+    heartbeat = time.monotonic()
+    yield 'retry: {}\n\n'.format(RETRY_MILLISECONDS)
+    while True:
+        batch = next_events(changes, since, batch_size)
+        if batch:
+            since = batch[-1][0]
+            yield ''.join(event for seq, event in batch)
+        # Checked before fetching more, a busy change log must not keep the stream open
+        now = time.monotonic()
+        if now >= deadline:
+            return
+        if len(batch) == batch_size:
+            # More changes are pending
+            continue
+        if now - heartbeat >= HEARTBEAT_SECONDS:
+            heartbeat = now
+            yield ': keepalive\n\n'
+        yield float(min(interval, deadline - now))
+
+
+def change_events(changes, since, timeout, interval, batch_size=100):
+    '''
+    Yields the changes after since as "change" events until timeout seconds have passed,
+    polling every interval seconds once all pending changes were sent
+    '''
+    for chunk in poll_events(changes, since, timeout, interval, batch_size):
+        if isinstance(chunk, float):
+            time.sleep(chunk)
+        else:
+            yield chunk
@@ -0,0 +1,76 @@
+'''
+Embedded related objects
+
+Related objects are linked (URLs, or primary keys in the compact representation). Clients that
+need them anyway can have them embedded with ?expand=<field>[,<field>...] instead of requesting
+every object on its own, e.g., /luacs/api/terminals/myself/?expand=devices returns the terminal
+together with all its devices. Only the top level objects of GET requests are expanded, the
+embedded objects are prefetched.
+'''
+import sys
+
+from django.db.models import prefetch_related_objects
+from rest_framework import serializers
+from rest_framework.exceptions import ValidationError
+
+from .fieldsets import get_names, is_selected
+
+
+def get_expand(request):
+    '''Returns the names of the fields to expand'''
+    return get_names(request, 'expand') or frozenset()
+
+
+class ExpandableSerializerMixin:
+    '''
+    Replaces the fields in expandable_fields with nested serializers if they are expanded
+
+    expandable_fields maps field names to the serializer class (or its name in the module of the
+    serializer) and the keyword arguments of the nested serializer.
+    '''
+    expandable_fields = {}
+
+    def get_fields(self):
+        fields = super().get_fields()
+        parent = self.parent
+        if isinstance(parent, serializers.ListSerializer):
+            parent = parent.parent
+        if parent is not None:
+            # Embedded objects are not expanded any further
+            return fields
+        for name in get_expand(self.context.get('request')) & set(self.expandable_fields):
+            serializer_class, kwargs = self.expandable_fields[name]
+            if isinstance(serializer_class, str):
+                serializer_class = getattr(sys.modules[type(self).__module__], serializer_class)
+            fields[name] = serializer_class(read_only=True, **kwargs)
+        return fields
+
+
+class ExpandMixin:
+    '''
+    Validates ?expand= and prefetches the expanded objects
+
+    get_expand_prefetch() returns the expandable fields, mapped to the lookups to prefetch for
+    them. It is called per request, prefetch querysets may depend on the time.
+    '''
+    def get_expand_prefetch(self):
+        return {}
+
+    def get_expand_lookups(self):
+        expand = get_expand(self.request)
+        prefetch = self.get_expand_prefetch()
+        unknown = expand - set(prefetch)
+        if unknown:
+            raise ValidationError({'expand': 'Unknown field {}, expected one of {}.'.format(
+                ', '.join(sorted(unknown)), ', '.join(sorted(prefetch)))})
+        # Fields left out by ?fields= or ?omit= (see fieldsets.py) are not serialized
+        return [lookup for name in sorted(expand) if is_selected(self.request, name)
+                for lookup in prefetch[name]]
+
+    def get_queryset(self):
+        return super().get_queryset().prefetch_related(*self.get_expand_lookups())
+
+    def expand_instance(self, instance):
+        '''Prefetches the expanded objects of an instance which was not loaded by get_queryset()'''
+        prefetch_related_objects([instance], *self.get_expand_lookups())
+        return instance
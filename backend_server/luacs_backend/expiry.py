@@ -0,0 +1,67 @@
+'''
+Expiry notifications
+
+Permission.effective_expiry is kept current when permissions, their group's max_unused_days or
+their usage change. sweep() is run periodically (see the sweep_expiry command) and sends signals
+for the permissions that expired, or entered the notice period, since the previous sweep. Both
+are range scans on the effective_expiry index.
+
+Receivers get the permissions as a queryset, e.g.:
+
+    @receiver(expiry.permissions_expiring)
+    def remind(sender, permissions, **kwargs):
+        for permission in permissions.select_related('granted_to__user'):
+            ...
+'''
+from datetime import timedelta
+
+from django.db import transaction
+from django.dispatch import Signal
+from django.utils import timezone
+
+from .models import Permission, ExpiryWatermark
+
+
+# Sent with the permissions whose validity ends within the notice period
+permissions_expiring = Signal(providing_args=['permissions'])
+# Sent with the permissions that are no longer valid
+permissions_expired = Signal(providing_args=['permissions'])
+
+
+def sweep(now=None, notice=timedelta(days=14)):
+    '''
+    Sends permissions_expiring and permissions_expired for the expiries since the previous sweep,
+    returns the number of expiring and expired permissions
+
+    The stored expiry of these permissions is recomputed first, in case they were used or changed
+    without going through the model (e.g., by bulk updates).
+    '''
+    if now is None:
+        now = timezone.now()
+    with transaction.atomic():
+        # Locked, so that concurrent runs do not notify twice
+        mark = ExpiryWatermark.objects.select_for_update().first()
+        if mark is None:
+            # First run, only notify about upcoming expiries
+            mark = ExpiryWatermark(time=now)
+            noticed = now
+        elif mark.time >= now:
+            return 0, 0
+        else:
+            noticed = mark.time + notice
+        Permission.objects.expiring(mark.time, now + notice).refresh_expiry()
+        expiring = Permission.objects.expiring(max(now, noticed), now + notice)
+        expired = Permission.objects.expiring(mark.time, now)
+        counts = expiring.count(), expired.count()
+        mark.time = now
+        mark.save()
+    if counts[0]:
+        permissions_expiring.send(sender=Permission, permissions=expiring)
+    if counts[1]:
+        permissions_expired.send(sender=Permission, permissions=expired)
+    return counts
+
+
+def rebuild():
+    '''Recomputes the stored expiry of all permissions, returns their number'''
+    return Permission.objects.all().refresh_expiry()
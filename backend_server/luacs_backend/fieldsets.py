@@ -0,0 +1,59 @@
+'''
+Sparse fieldsets
+
+?fields=<field>[,<field>...] limits the top level objects of GET responses to the given fields,
+?omit=<field>[,<field>...] leaves fields out. Fields which are not selected are not evaluated at
+all, e.g., /luacs/api/devices/laser/?omit=valid_permissions does not look up the permissions of
+the device, and expansions (see expansion.py) of unselected fields are not prefetched.
+'''
+from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.serializers import ListSerializer
+
+
+def get_names(request, param):
+    '''Returns the comma separated names in a query parameter of GET requests, None if not given'''
+    if request is None or request.method not in SAFE_METHODS:
+        return None
+    value = request.query_params.get(param)
+    if value is None:
+        return None
+    return frozenset(name.strip() for name in value.split(',') if name.strip())
+
+
+def is_selected(request, name):
+    '''Returns whether the field is part of the response'''
+    fields = get_names(request, 'fields')
+    omit = get_names(request, 'omit')
+    return (fields is None or name in fields) and (omit is None or name not in omit)
+
+
+def get_fieldset(request):
+    '''Returns the selection as a hashable value, (None, None) if all fields are selected'''
+    fields = get_names(request, 'fields')
+    omit = get_names(request, 'omit')
+    return (None if fields is None else tuple(sorted(fields)),
+            None if omit is None else tuple(sorted(omit)))
+
+
+def select_fields(serializer, request):
+    '''Removes the fields which are not selected from the serializer (or its child), returns it'''
+    fields = get_names(request, 'fields')
+    omit = get_names(request, 'omit')
+    if fields is None and omit is None:
+        return serializer
+    child = serializer.child if isinstance(serializer, ListSerializer) else serializer
+    unknown = ((fields or frozenset()) | (omit or frozenset())) - set(child.fields)
+    if unknown:
+        raise ValidationError({'fields': 'Unknown field {}, expected one of {}.'.format(
+            ', '.join(sorted(unknown)), ', '.join(child.fields))})
+    for name in list(child.fields):
+        if not is_selected(request, name):
+            del child.fields[name]
+    return serializer
+
+
+class SparseFieldsMixin:
+    '''Applies ?fields= and ?omit= to the serializers of a view'''
+    def get_serializer(self, *args, **kwargs):
+        return select_fields(super().get_serializer(*args, **kwargs), self.request)
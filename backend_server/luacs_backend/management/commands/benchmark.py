@@ -0,0 +1,190 @@
+from io import BytesIO
+import json
+import time
+
+import django
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from luacs_backend.models import Terminal, Profile, Permission, DeviceStatus
+from luacs_backend.renderers import msgpack, MessagePackRenderer, MessagePackParser
+
+
+def percentile(values, p):
+    '''Nearest-rank percentile of a non-empty list'''
+    ordered = sorted(values)
+    return ordered[max(0, int(round(p / 100 * len(ordered))) - 1)]
+
+
+class Command(BaseCommand):
+    help = ('Measures latency percentiles and query counts of the hot API endpoints and admin '
+            'changelists against the current database (see generate_testdata), and compares '
+            'payload size and encoding time of JSON and MessagePack. Results are written as JSON '
+            'and can be compared against a baseline.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--output', help='Write results to this file instead of stdout')
+        parser.add_argument('--baseline', help='Fail if results regress against this file')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='Allowed relative latency increase over the baseline '
+                                 '(default: 0.25)')
+        parser.add_argument('--host', default='localhost',
+                            help='Host header of the requests, must be in ALLOWED_HOSTS')
+
+    def get_cases(self, host):
+        '''
+        Returns (name, request function) of all benchmarked requests, and of the requests whose
+        payloads are compared between formats
+        '''
+        terminal = Terminal.objects.filter(
+            devices__required_permission_group__isnull=False).order_by('pk').first()
+        if terminal is None:
+            raise CommandError('No terminal with devices found, run generate_testdata first.')
+        device = terminal.devices.filter(required_permission_group__isnull=False).first()
+        permission = Permission.objects.valid().filter(
+            permission_group=device.required_permission_group_id
+        ).select_related('granted_to').first()
+        profile = permission.granted_to if permission else Profile.objects.first()
+        admin, created = User.objects.get_or_create(
+            username='benchmark-admin', defaults={'is_superuser': True, 'is_staff': True})
+
+        client = Client(HTTP_HOST=host, HTTP_AUTHORIZATION='Token {}'.format(terminal.token))
+        admin_client = Client(HTTP_HOST=host)
+        admin_client.force_login(admin)
+        device_url = 'http://{}{}'.format(host, reverse('device-detail', args=[device.pk]))
+
+        def insert_status():
+            return client.post(reverse('devicestatus-list'), {
+                'device': device_url, 'start_time': timezone.now().isoformat(),
+                'in_operation': False, 'change_reason': 'benchmark'})
+
+        cases = [
+            ('terminals_myself', lambda: client.get(reverse('terminal-myself'))),
+            ('device_detail', lambda: client.get(reverse('device-detail', args=[device.pk]))),
+            ('authorize', lambda: client.post(reverse('authorize'), {
+                'device': device.pk, 'id_type': profile.id_type,
+                'id_string': profile.id_string})),
+            ('profile_lookup', lambda: client.get(reverse('profile-lookup'), {
+                'id_type': profile.id_type, 'id_string': profile.id_string})),
+            ('status_insert', insert_status),
+        ]
+        for model in ('permission', 'permissiongroup', 'devicestatus', 'device', 'terminal',
+                      'profile'):
+            url = reverse('admin:luacs_backend_{}_changelist'.format(model))
+            cases.append(('admin_{}_changelist'.format(model),
+                          lambda url=url: admin_client.get(url)))
+
+        compact = 'application/json; version=2'
+        payloads = [
+            ('snapshot', lambda: client.get(reverse('terminal-snapshot'))),
+            ('device_detail', lambda: client.get(reverse('device-detail', args=[device.pk]),
+                                                 HTTP_ACCEPT=compact)),
+        ]
+        return cases, payloads
+
+    def measure(self, request, iterations):
+        # Warm up caches (e.g., terminal authentication) before measuring
+        request()
+        durations = []
+        queries = []
+        for i in range(iterations):
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                response = request()
+                durations.append((time.perf_counter() - start) * 1000)
+            if response.status_code >= 400:
+                raise CommandError('Request failed with status {}: {}'.format(
+                    response.status_code, response.content[:200]))
+            queries.append(len(captured))
+        return {
+            'p50_ms': percentile(durations, 50),
+            'p90_ms': percentile(durations, 90),
+            'p99_ms': percentile(durations, 99),
+            'mean_ms': sum(durations) / len(durations),
+            'max_ms': max(durations),
+            'queries': max(queries),
+            'response_bytes': len(response.content),
+        }
+
+    def measure_formats(self, request, iterations):
+        '''Compares payload size and encode/decode time of the response data between formats'''
+        data = request().data
+        formats = [('json', JSONRenderer(), JSONParser())]
+        if msgpack is not None:
+            formats.append(('msgpack', MessagePackRenderer(), MessagePackParser()))
+        results = {}
+        for name, renderer, parser in formats:
+            encode = []
+            decode = []
+            for i in range(iterations):
+                start = time.perf_counter()
+                body = renderer.render(data)
+                encode.append((time.perf_counter() - start) * 1000)
+                start = time.perf_counter()
+                parser.parse(BytesIO(body))
+                decode.append((time.perf_counter() - start) * 1000)
+            results[name] = {'bytes': len(body), 'encode_ms': percentile(encode, 50),
+                             'decode_ms': percentile(decode, 50)}
+        return results
+
+    def compare(self, results, baseline, tolerance):
+        '''Returns a list of regressions against the baseline'''
+        regressions = []
+        for name, old in baseline['results'].items():
+            new = results['results'].get(name)
+            if new is None:
+                continue
+            if new['queries'] > old['queries']:
+                regressions.append('{}: {} queries instead of {}'.format(
+                    name, new['queries'], old['queries']))
+            if new['p50_ms'] > old['p50_ms'] * (1 + tolerance):
+                regressions.append('{}: median {:.1f} ms instead of {:.1f} ms'.format(
+                    name, new['p50_ms'], old['p50_ms']))
+        return regressions
+
+    def handle(self, *args, **options):
+        results = {
+            'meta': {
+                'timestamp': timezone.now().isoformat(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'iterations': options['iterations'],
+                'profiles': Profile.objects.count(),
+                'permissions': Permission.objects.count(),
+                'statuses': DeviceStatus.objects.count(),
+            },
+            'results': {},
+            'formats': {},
+        }
+        cases, payloads = self.get_cases(options['host'])
+        for name, request in cases:
+            results['results'][name] = self.measure(request, options['iterations'])
+            self.stderr.write('{:32} p50 {p50_ms:8.2f} ms  p99 {p99_ms:8.2f} ms  '
+                              '{queries:4d} queries'.format(name, **results['results'][name]))
+        for name, request in payloads:
+            results['formats'][name] = self.measure_formats(request, options['iterations'])
+            for fmt, result in results['formats'][name].items():
+                self.stderr.write('{:24} {:7} {bytes:8d} bytes  encode {encode_ms:6.2f} ms  '
+                                  'decode {decode_ms:6.2f} ms'.format(name, fmt, **result))
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                regressions = self.compare(results, json.load(f), options['tolerance'])
+            if regressions:
+                raise CommandError('Regressions against {}:\n{}'.format(
+                    options['baseline'], '\n'.join(regressions)))
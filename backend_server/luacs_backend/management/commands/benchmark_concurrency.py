@@ -0,0 +1,116 @@
+import json
+import threading
+import time
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, DatabaseError
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from luacs_backend.models import Device
+from .benchmark import percentile
+
+
+class Command(BaseCommand):
+    help = ('Measures throughput, latency and failures of parallel writers, each posting device '
+            'statuses as another terminal, against the current database (see generate_testdata). '
+            'Run it with each LUACS_DB_ENGINE to compare the backends.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=8,
+                            help='Number of parallel writers (default: 8)')
+        parser.add_argument('--requests', type=int, default=50,
+                            help='Statuses posted by each writer (default: 50)')
+        parser.add_argument('--output', help='Write results to this file instead of stdout')
+        parser.add_argument('--host', default='localhost',
+                            help='Host header of the requests, must be in ALLOWED_HOSTS')
+
+    def write(self, device, host, count, start, results):
+        '''Posts count statuses of device as its terminal, once all writers are ready'''
+        client = Client(HTTP_HOST=host,
+                        HTTP_AUTHORIZATION='Token {}'.format(device.terminal.token))
+        device_url = 'http://{}{}'.format(host, reverse('device-detail', args=[device.pk]))
+        durations = []
+        errors = []
+        try:
+            start.wait()
+            for i in range(count):
+                begin = time.perf_counter()
+                try:
+                    response = client.post(reverse('devicestatus-list'), {
+                        'device': device_url, 'start_time': timezone.now().isoformat(),
+                        'in_operation': bool(i % 2), 'change_reason': 'concurrency benchmark'})
+                except DatabaseError as e:
+                    errors.append(str(e))
+                    continue
+                # Failed requests count as errors only, not towards throughput and latency
+                if response.status_code >= 400:
+                    errors.append('status {}'.format(response.status_code))
+                else:
+                    durations.append((time.perf_counter() - begin) * 1000)
+        finally:
+            # Connections are per thread
+            connections.close_all()
+            results.append((durations, errors))
+
+    def handle(self, *args, **options):
+        writers = options['writers']
+        # One device per writer, so that only the database serializes them
+        devices = list(Device.objects.filter(terminal__isnull=False).select_related(
+            'terminal').order_by('pk')[:writers])
+        if len(devices) < writers:
+            raise CommandError('Found only {} devices with terminals, run generate_testdata '
+                               'first.'.format(len(devices)))
+        journal_mode = None
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                journal_mode = cursor.execute('PRAGMA journal_mode').fetchone()[0]
+
+        start = threading.Barrier(writers + 1)
+        results = []
+        threads = [threading.Thread(target=self.write, args=(
+            device, options['host'], options['requests'], start, results)) for device in devices]
+        for thread in threads:
+            thread.start()
+        start.wait()
+        begin = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - begin
+
+        durations = [d for thread_durations, errors in results for d in thread_durations]
+        errors = [e for thread_durations, thread_errors in results for e in thread_errors]
+        output = {
+            'meta': {
+                'timestamp': timezone.now().isoformat(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'journal_mode': journal_mode,
+                'conn_max_age': connection.settings_dict['CONN_MAX_AGE'],
+                'writers': writers,
+                'requests': writers * options['requests'],
+            },
+            'results': {
+                'throughput_per_s': len(durations) / elapsed,
+                'errors': len(errors),
+                'error_samples': sorted(set(errors))[:5],
+            },
+        }
+        if durations:
+            output['results'].update({
+                'p50_ms': percentile(durations, 50),
+                'p90_ms': percentile(durations, 90),
+                'p99_ms': percentile(durations, 99),
+                'max_ms': max(durations),
+            })
+        self.stderr.write('{writers} writers: {throughput_per_s:.1f} statuses/s, {errors} errors'
+                          .format(writers=writers, **output['results']))
+
+        output = json.dumps(output, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,105 @@
+from datetime import timedelta
+import random
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from luacs_backend.models import (Profile, Terminal, Device, DeviceStatus, PermissionGroup,
+                                  Permission)
+
+
+class Command(BaseCommand):
+    help = ('Generates a synthetic lab: profiles, permission groups, terminals with devices, '
+            'permissions and years of device status history. Meant for benchmarks, run it on an '
+            'empty database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', type=int, default=1000)
+        parser.add_argument('--groups', type=int, default=10,
+                            help='Number of permission groups (default: 10)')
+        parser.add_argument('--terminals', type=int, default=10)
+        parser.add_argument('--devices-per-terminal', type=int, default=2)
+        parser.add_argument('--permissions-per-profile', type=int, default=3)
+        parser.add_argument('--years', type=float, default=1,
+                            help='Years of device status history (default: 1)')
+        parser.add_argument('--sessions-per-day', type=int, default=4,
+                            help='Usage sessions per device and day (default: 4)')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if Terminal.objects.filter(token__startswith='lab-terminal-').exists():
+            raise CommandError('Test data has already been generated in this database.')
+        rnd = random.Random(options['seed'])
+        now = timezone.now()
+        history_start = now - timedelta(days=365 * options['years'])
+
+        with transaction.atomic():
+            User.objects.bulk_create(
+                User(username='lab-user-{}'.format(i), first_name='User', last_name=str(i),
+                     email='lab-user-{}@example.com'.format(i))
+                for i in range(options['profiles']))
+            users = User.objects.filter(username__startswith='lab-user-')
+            Profile.objects.bulk_create(
+                Profile(user=u, id_type='rfid', id_string='{:010d}'.format(u.pk)) for u in users)
+            profiles = list(Profile.objects.filter(user__username__startswith='lab-user-'))
+
+            groups = [PermissionGroup.objects.create(
+                name='Lab group {}'.format(i), max_unused_days=rnd.choice([None, 90, 180]))
+                for i in range(options['groups'])]
+
+            devices = []
+            for t in range(options['terminals']):
+                terminal = Terminal.objects.create(token='lab-terminal-{}'.format(t))
+                for d in range(options['devices_per_terminal']):
+                    devices.append(Device.objects.create(
+                        shortname='lab-device-{}-{}'.format(t, d), model_name='Lab device',
+                        required_permission_group=rnd.choice(groups), terminal=terminal,
+                        automatic_logout=timedelta(minutes=rnd.choice([0, 5, 30]))))
+
+            permissions = []
+            for profile in profiles:
+                for group in rnd.sample(groups, min(len(groups),
+                                                    options['permissions_per_profile'])):
+                    granted_until = rnd.choice([None, now + timedelta(days=rnd.randint(-30, 365))])
+                    permissions.append(Permission(granted_to=profile, permission_group=group,
+                                                  granted_until=granted_until))
+            Permission.objects.bulk_create(permissions)
+            # granted_on is set automatically, backdate it to the start of the history
+            lab_permissions = Permission.objects.filter(
+                granted_to__user__username__startswith='lab-user-')
+            lab_permissions.update(granted_on=history_start)
+            permissions_by_group = {}
+            for pk, group_id in lab_permissions.values_list('pk', 'permission_group'):
+                permissions_by_group.setdefault(group_id, []).append(pk)
+
+            statuses = 0
+            for device in devices:
+                candidates = permissions_by_group.get(device.required_permission_group_id)
+                if not candidates:
+                    continue
+                history = []
+                day = history_start
+                while day < now:
+                    for session in range(options['sessions_per_day']):
+                        login = day + timedelta(minutes=rnd.randint(0, 24 * 60 - 1))
+                        authorization = rnd.choice(candidates)
+                        operated = login + timedelta(minutes=rnd.randint(1, 10))
+                        logout = operated + timedelta(minutes=rnd.randint(5, 120))
+                        history += [(t, in_operation, auth) for t, in_operation, auth in (
+                            (login, False, authorization), (operated, True, authorization),
+                            (logout, False, None)) if t < now]
+                    day += timedelta(days=1)
+                history.sort(key=lambda h: h[0])
+                DeviceStatus.objects.append([
+                    DeviceStatus(device=device, start_time=start, in_operation=in_operation,
+                                 authorization_id=authorization, change_reason='generated')
+                    for start, in_operation, authorization in history])
+                statuses += len(history)
+            # Neither bulk_create() nor backdating granted_on computed the stored expiry
+            lab_permissions.refresh_expiry()
+
+        self.stdout.write(
+            'Generated {} profiles, {} permissions, {} devices and {} statuses.'.format(
+                len(profiles), len(permissions), len(devices), statuses))
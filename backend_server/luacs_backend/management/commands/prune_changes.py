@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from luacs_backend.models import Change
+
+
+class Command(BaseCommand):
+    help = ('Deletes change log entries older than the retention period. Terminals that have not '
+            'synchronized since then need to resync in full.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30,
+                            help='Retention period in days (default: 30)')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        # The newest entry is always kept, it marks up to where the log has been pruned
+        keep = (Change.objects.filter(timestamp__gte=cutoff).order_by('seq').first() or
+                Change.objects.order_by('-seq').first())
+        if keep is None:
+            return
+        deleted, _ = Change.objects.filter(seq__lt=keep.seq).delete()
+        self.stdout.write('Deleted {} change log entries before #{}.'.format(deleted, keep.seq))
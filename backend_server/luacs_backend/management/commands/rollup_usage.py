@@ -0,0 +1,33 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from luacs_backend import rollups
+
+
+class Command(BaseCommand):
+    help = ('Aggregates the device status history into hourly and daily usage rollups, continuing '
+            'from where the previous run stopped. Meant to be run periodically (e.g., by cron).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lag', type=int, default=5,
+                            help='Minutes to stay behind the current time, so that buffered '
+                                 'statuses of terminals can still arrive (default: 5)')
+        parser.add_argument('--chunk-days', type=int, default=7,
+                            help='Days rolled up per transaction (default: 7)')
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Discard all rollups and aggregate the complete history again, '
+                                 'needed after statuses were inserted or deleted retroactively')
+
+    def handle(self, *args, **options):
+        until = timezone.now() - timedelta(minutes=options['lag'])
+        chunk = timedelta(days=options['chunk_days'])
+        if options['rebuild']:
+            mark = rollups.rebuild(until, chunk)
+        else:
+            mark = rollups.catch_up(until, chunk)
+        if mark is None:
+            self.stdout.write('No statuses to roll up.')
+        else:
+            self.stdout.write('Usage rolled up until {}.'.format(mark.isoformat()))
@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from luacs_backend import expiry
+
+
+class Command(BaseCommand):
+    help = ('Sends the expiry notifications (see luacs_backend.expiry) for permissions that '
+            'expired or will expire within the notice period, since the previous run. Meant to be '
+            'run periodically (e.g., by cron).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--notice-days', type=int, default=14,
+                            help='Days before expiry to send the expiring notification '
+                                 '(default: 14)')
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Recompute the stored expiry of all permissions first, needed '
+                                 'after permissions or statuses were changed by bulk updates')
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            self.stdout.write('Recomputed the expiry of {} permissions.'.format(expiry.rebuild()))
+        expiring, expired = expiry.sweep(notice=timedelta(days=options['notice_days']))
+        self.stdout.write('{} permissions expiring, {} expired.'.format(expiring, expired))
@@ -0,0 +1,203 @@
+'''
+In-process request metrics
+
+MetricsMiddleware records wall time, number of database queries, total SQL time and response
+size for every request, labeled by view and action. The histograms are kept per process and
+exported in the Prometheus text format by views.metrics. Streaming responses are recorded once
+they were sent completely, including the queries run while streaming.
+'''
+from bisect import bisect_left
+from collections import OrderedDict, deque
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+class Histogram:
+    '''Cumulative histogram with fixed bucket bounds'''
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        '''Yields (upper bound, number of observations <= bound), ending with +Inf'''
+        total = 0
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            total += count
+            yield bound, total
+
+
+class Registry:
+    '''Thread safe collection of labeled histograms and counters'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = OrderedDict()
+
+    def _get(self, name, kind, help_text, labels, factory):
+        metric = self._metrics.setdefault(name, {'kind': kind, 'help': help_text,
+                                                 'series': OrderedDict()})
+        key = tuple(sorted(labels.items()))
+        if key not in metric['series']:
+            metric['series'][key] = factory()
+        return metric['series'], key
+
+    def observe(self, name, value, bounds, help_text='', **labels):
+        with self._lock:
+            series, key = self._get(name, 'histogram', help_text, labels,
+                                    lambda: Histogram(bounds))
+            series[key].observe(value)
+
+    def inc(self, name, amount=1, help_text='', **labels):
+        with self._lock:
+            series, key = self._get(name, 'counter', help_text, labels, lambda: 0)
+            series[key] += amount
+
+    def clear(self):
+        with self._lock:
+            self._metrics.clear()
+
+    def render(self):
+        '''Returns all metrics in the Prometheus text exposition format'''
+        def fmt_labels(key, **extra):
+            items = list(key) + sorted(extra.items())
+            if not items:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                                  for k, v in items) + '}'
+
+        lines = []
+        with self._lock:
+            for name, metric in self._metrics.items():
+                if metric['help']:
+                    lines.append('# HELP {} {}'.format(name, metric['help']))
+                lines.append('# TYPE {} {}'.format(name, metric['kind']))
+                for key, value in metric['series'].items():
+                    if metric['kind'] == 'counter':
+                        lines.append('{}{} {}'.format(name, fmt_labels(key), value))
+                        continue
+                    for bound, count in value.cumulative():
+                        lines.append('{}_bucket{} {}'.format(name, fmt_labels(key, le=bound),
+                                                             count))
+                    lines.append('{}_sum{} {}'.format(name, fmt_labels(key), value.sum))
+                    lines.append('{}_count{} {}'.format(name, fmt_labels(key), value.count))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def view_label(request, view_func):
+    '''Returns "<view>.<action>" for DRF views and the function name otherwise'''
+    cls = getattr(view_func, 'cls', None)
+    if cls is None:
+        return getattr(view_func, '__name__', 'unknown')
+    actions = getattr(view_func, 'actions', None) or {}
+    return '{}.{}'.format(cls.__name__, actions.get(request.method.lower(),
+                                                    request.method.lower()))
+
+
+class QueryLog(deque):
+    '''
+    Replaces the queries_log of connections, counts all queries and their time including those
+    beyond maxlen, which the deque drops
+    '''
+    def __init__(self, iterable=(), maxlen=None):
+        super().__init__(iterable, maxlen)
+        self.total = 0
+        self.total_time = 0.0
+
+    def append(self, query):
+        super().append(query)
+        self.total += 1
+        self.total_time += float(query['time'])
+
+
+def get_query_log():
+    if not isinstance(connection.queries_log, QueryLog):
+        connection.queries_log = QueryLog(connection.queries_log, connection.queries_limit)
+    return connection.queries_log
+
+
+class MetricsMiddleware:
+    '''Records per view metrics, and logs requests that exceed LUACS_QUERY_BUDGET queries'''
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not getattr(settings, 'LUACS_METRICS', True):
+            return self.get_response(request)
+
+        # The debug cursor records every query with its duration
+        force_debug_cursor = connection.force_debug_cursor
+        connection.force_debug_cursor = True
+        log = get_query_log()
+        first_query, first_time = log.total, log.total_time
+        start = time.perf_counter()
+
+        def record(size):
+            duration = time.perf_counter() - start
+            connection.force_debug_cursor = force_debug_cursor
+            count = log.total - first_query
+            # The log only keeps the newest queries
+            queries = list(log)[len(log) - min(count, len(log)):]
+            if not connection.force_debug_cursor and not settings.DEBUG:
+                log.clear()
+
+            label = getattr(request, 'metrics_label', None) or 'unresolved'
+            registry.observe('luacs_request_duration_seconds', duration, DURATION_BUCKETS,
+                             'Wall time per request', view=label)
+            registry.observe('luacs_request_queries', count, QUERY_BUCKETS,
+                             'Database queries per request', view=label)
+            registry.observe('luacs_request_sql_seconds', log.total_time - first_time,
+                             DURATION_BUCKETS, 'Total SQL time per request', view=label)
+            registry.observe('luacs_response_size_bytes', size, SIZE_BUCKETS,
+                             'Response body size', view=label)
+
+            budget = getattr(settings, 'LUACS_QUERY_BUDGET', None)
+            if budget is not None and count > budget:
+                logger.warning('%s %s (%s) ran %d queries (budget %d):\n%s',
+                               request.method, request.path, label, count, budget,
+                               '\n'.join(q['sql'] for q in queries))
+
+        try:
+            response = self.get_response(request)
+        except Exception:
+            connection.force_debug_cursor = force_debug_cursor
+            raise
+        if response.streaming:
+            response.streaming_content = self.record_streaming(response.streaming_content, record)
+        else:
+            record(len(response.content))
+        return response
+
+    def record_streaming(self, content, record):
+        '''Yields the content, records the metrics once it was sent (or the client went away)'''
+        size = 0
+        try:
+            for chunk in content:
+                size += len(chunk)
+                yield chunk
+        finally:
+            record(size)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not hasattr(request, 'metrics_label'):
+            request.metrics_label = view_label(request, view_func)
+
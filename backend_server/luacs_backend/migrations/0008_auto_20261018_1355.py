@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 13:55
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('luacs_backend', '0007_auto_20170617_1621'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='devicestatus',
+            options={'get_latest_by': 'start_time', 'ordering': ['-start_time', 'id']},
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='current_status',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='luacs_backend.DeviceStatus'),
+        ),
+        migrations.AlterField(
+            model_name='devicestatus',
+            name='change_reason',
+            field=models.TextField(blank=True),
+        ),
+    ]
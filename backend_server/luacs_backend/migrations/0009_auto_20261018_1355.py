@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 13:55
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def backfill_current_status(apps, schema_editor):
+    Device = apps.get_model('luacs_backend', 'Device')
+    DeviceStatus = apps.get_model('luacs_backend', 'DeviceStatus')
+    for device in Device.objects.all():
+        latest = DeviceStatus.objects.filter(device=device).order_by('-start_time', '-id').first()
+        Device.objects.filter(pk=device.pk).update(current_status=latest)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('luacs_backend', '0008_auto_20261018_1355'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_current_status, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 13:56
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def backfill_end_time(apps, schema_editor):
+    DeviceStatus = apps.get_model('luacs_backend', 'DeviceStatus')
+    previous = None
+    for status in DeviceStatus.objects.order_by('device', 'start_time', 'id').only(
+            'pk', 'device', 'start_time').iterator():
+        if previous is not None and previous.device_id == status.device_id:
+            DeviceStatus.objects.filter(pk=previous.pk).update(end_time=status.start_time)
+        previous = status
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('luacs_backend', '0009_auto_20261018_1355'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='devicestatus',
+            name='end_time',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='devicestatus',
+            index_together=set([('device', 'start_time'), ('authorization', 'start_time')]),
+        ),
+        migrations.RunPython(backfill_end_time, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 13:59
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('luacs_backend', '0010_auto_20261018_1356'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Change',
+            fields=[
+                ('seq', models.BigAutoField(primary_key=True, serialize=False)),
+                ('timestamp', models.DateTimeField(auto_now_add=True)),
+                ('model', models.CharField(max_length=30)),
+                ('object_id', models.CharField(max_length=255)),
+                ('action', models.CharField(choices=[('created', 'created'), ('updated', 'updated'), ('withdrawn', 'withdrawn'), ('deleted', 'deleted')], max_length=10)),
+                ('terminal_id', models.IntegerField(blank=True, db_index=True, null=True)),
+                ('permission_group_id', models.IntegerField(blank=True, db_index=True, null=True)),
+                ('profile_id', models.IntegerField(blank=True, db_index=True, null=True)),
+            ],
+            options={
+                'ordering': ['seq'],
+            },
+        ),
+    ]
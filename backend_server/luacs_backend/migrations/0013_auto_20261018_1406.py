@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 14:06
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('luacs_backend', '0012_auto_20261018_1400'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='devicestatus',
+            name='start_time',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='permission',
+            name='granted_on',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 14:09
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('luacs_backend', '0013_auto_20261018_1406'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UsageRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'hour'), ('day', 'day')], max_length=4)),
+                ('bucket', models.DateTimeField(help_text='Start of the hour or day')),
+                ('usage_minutes', models.FloatField(default=0)),
+                ('operated_minutes', models.FloatField(default=0)),
+                ('sessions', models.PositiveIntegerField(default=0, help_text='Number of logins')),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='usage_rollups', to='luacs_backend.Device')),
+                ('permission_group', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='usage_rollups', to='luacs_backend.PermissionGroup')),
+            ],
+            options={
+                'ordering': ['period', 'bucket', 'device', 'permission_group'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='usagerollup',
+            unique_together=set([('period', 'bucket', 'device', 'permission_group')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='usagerollup',
+            index_together=set([('period', 'permission_group', 'bucket'), ('period', 'device', 'bucket')]),
+        ),
+    ]
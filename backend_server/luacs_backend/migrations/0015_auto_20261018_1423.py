@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 14:23
+from __future__ import unicode_literals
+
+import datetime
+from django.db import migrations, models
+from django.db.models import Max
+from django.utils.timezone import utc
+
+
+def backfill_effective_expiry(apps, schema_editor):
+    Permission = apps.get_model('luacs_backend', 'Permission')
+    permissions = Permission.objects.annotate(last_usage=Max('usage__start_time')).values_list(
+        'pk', 'granted_on', 'granted_until', 'permission_group__max_unused_days', 'last_usage')
+    for pk, granted_on, granted_until, max_unused_days, last_usage in permissions.iterator():
+        # Permissions without granted_until are unlimited (see Permission.valid_until)
+        expiry = datetime.datetime.max.replace(tzinfo=utc)
+        if granted_until is not None:
+            expiry = granted_until
+            if max_unused_days is not None:
+                expiry = min(expiry,
+                             (last_usage or granted_on) + datetime.timedelta(max_unused_days))
+        Permission.objects.filter(pk=pk).update(effective_expiry=expiry)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('luacs_backend', '0014_auto_20261018_1409'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExpiryWatermark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='permission',
+            name='effective_expiry',
+            field=models.DateTimeField(db_index=True, default=datetime.datetime(9999, 12, 31, 23, 59, 59, 999999, tzinfo=utc), editable=False),
+        ),
+        migrations.RunPython(backfill_effective_expiry, migrations.RunPython.noop),
+    ]
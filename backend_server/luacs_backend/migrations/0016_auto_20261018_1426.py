@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 14:26
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('luacs_backend', '0015_auto_20261018_1423'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='permission',
+            name='granted_to',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='permissions', to='luacs_backend.Profile'),
+        ),
+        migrations.AlterIndexTogether(
+            name='permission',
+            index_together=set([('granted_to', 'permission_group'), ('permission_group', 'effective_expiry')]),
+        ),
+    ]
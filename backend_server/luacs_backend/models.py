@@ -1,17 +1,33 @@
 from datetime import timedelta, date, datetime
 
 from django.utils import timezone
-from django.db import models
+from django.db import connections, models, transaction
+from django.db.models import (Case, F, Func, Max, OuterRef, Prefetch, Subquery, Value, When,
+                              ExpressionWrapper)
+from django.db.models.functions import Coalesce, Least
 from django.contrib.auth.models import AnonymousUser, User
 from django.core.validators import RegexValidator
 from django.core.exceptions import ValidationError
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 
 
+TZ_MIN = timezone.make_aware(datetime.min)
 TZ_MAX = timezone.make_aware(datetime.max)
 
 
+class Days(Func):
+    '''Converts an integer expression (number of days) into a duration'''
+    # Backends without a native duration type store durations as microseconds
+    template = '(%(expressions)s * 86400000000)'
+
+    def __init__(self, expression, **extra):
+        super().__init__(expression, output_field=models.DurationField(), **extra)
+
+    def as_postgresql(self, compiler, connection):
+        return self.as_sql(compiler, connection, template="(%(expressions)s * INTERVAL '1 day')")
+
+
 class Profile(models.Model):
     user = models.OneToOneField(User, related_name='luacs_profile', verbose_name='user',
                                 on_delete=models.CASCADE)
@@ -21,6 +37,11 @@ class Profile(models.Model):
     id_type = models.CharField('ID type', max_length=10, null=False, help_text='TODO info here')
     id_string = models.CharField('ID', max_length=255, null=False, help_text='TODO info here')
 
+    @property
+    def display_name(self):
+        return ("{} {}".format(self.user.first_name, self.user.last_name).strip() or
+                self.user.username)
+
     def __str__(self):
         return "{} {} ({})".format(self.user.first_name, self.user.last_name, self.user)
 
@@ -33,12 +54,42 @@ class Terminal(models.Model):
         max_length=20, unique=True, help_text='Used by Terminal to access backend API.')
     # TODO add ip, hostname and use for authentication (optional)
     # TODO add last_seen and currently_online
-    # TODO add get_cache_permissions function or transparent caching on terminal?
+
+    def get_cache_permissions(self, at=None):
+        '''
+        Returns all credentials that may use any device of this terminal
+
+        Maps id_type -> id_string -> {'user': {'id', 'name'}, 'devices': {shortname: {'permission',
+        'valid_until'}}}, so that terminals can decide locally.
+        '''
+        devices_by_group = {}
+        for shortname, group_id in self.devices.filter(
+                required_permission_group__isnull=False).values_list(
+                    'shortname', 'required_permission_group'):
+            devices_by_group.setdefault(group_id, []).append(shortname)
+
+        credentials = {}
+        permissions = Permission.objects.valid(at=at).filter(
+            permission_group__in=devices_by_group).select_related('granted_to__user')
+        for permission in permissions:
+            profile = permission.granted_to
+            credential = credentials.setdefault(profile.id_type, {}).setdefault(
+                profile.id_string, {'user': {'id': profile.id, 'name': profile.display_name},
+                                    'devices': {}})
+            for shortname in devices_by_group[permission.permission_group_id]:
+                current = credential['devices'].get(shortname)
+                # Overlapping permissions: keep the one that lasts longest
+                if current is None or current['valid_until'] < permission.valid_until:
+                    credential['devices'][shortname] = {'permission': permission.id,
+                                                        'valid_until': permission.valid_until}
+        return credentials
 
     def __str__(self):
         ret = "Terminal #{}".format(self.id)
-        if self.devices.exists():
-            ret += ' ({})'.format(', '.join([d.shortname for d in self.devices.all()]))
+        # One query, or none if the devices were prefetched
+        shortnames = [d.shortname for d in self.devices.all()]
+        if shortnames:
+            ret += ' ({})'.format(', '.join(shortnames))
         return ret
 
 
@@ -65,7 +116,22 @@ class Device(models.Model):
                   "shutdown/deactivated such as a door that stays open.")
     # TODO deadman switch
 
+    # Denormalized pointer to the most recent entry of status_history, maintained by
+    # DeviceStatus.save()
+    current_status = models.ForeignKey(
+        'DeviceStatus', related_name='+', null=True, blank=True, editable=False,
+        on_delete=models.SET_NULL)
+
+    @property
+    def automatic_logout_seconds(self):
+        if self.automatic_logout is None:
+            return None
+        return int(self.automatic_logout.total_seconds())
+
     def get_valid_permissions(self):
+        if self.required_permission_group_id is None:
+            # Annotated like valid permissions
+            return Permission.objects.valid().none()
         return self.required_permission_group.get_valid_permissions()
 
     @property
@@ -82,35 +148,119 @@ class Device(models.Model):
         else:
             return None
 
-    @property
-    def current_status(self):
-        try:
-            return self.status_history.latest()
-        except DeviceStatus.DoesNotExist:
+    def status_at(self, time):
+        '''Returns the status that was active at the given time (or None)'''
+        # Walks the (device, start_time) index backwards and stops at the first row
+        status = self.status_history.filter(start_time__lte=time).order_by(
+            '-start_time', '-id').first()
+        if status is None or (status.end_time is not None and status.end_time <= time):
             return None
+        return status
+
+    def refresh_current_status(self):
+        '''Recomputes current_status from status_history'''
+        self.current_status = self.status_history.order_by('-start_time', '-id').first()
+        Device.objects.filter(pk=self.pk).update(current_status=self.current_status)
 
     def __str__(self):
         return "{} ({})".format(self.shortname, self.model_name)
 
 
+class DeviceStatusQuerySet(models.QuerySet):
+    def active_at(self, time):
+        '''Returns statuses whose interval contains the given time'''
+        return self.filter(start_time__lte=time).filter(
+            models.Q(end_time__gt=time) | models.Q(end_time__isnull=True))
+
+    def overlapping(self, start, end):
+        '''Returns statuses whose interval overlaps [start, end)'''
+        return self.filter(start_time__lt=end).filter(
+            models.Q(end_time__gt=start) | models.Q(end_time__isnull=True))
+
+    def append(self, statuses):
+        '''
+        Inserts statuses in bulk, each must be newer than the current status of its device
+
+        Maintains end_time and Device.current_status like DeviceStatus.save() does, using a
+        constant number of queries per device.
+        '''
+        by_device = {}
+        for status in sorted(statuses, key=lambda s: s.start_time):
+            by_device.setdefault(status.device_id, []).append(status)
+        with transaction.atomic():
+            locked = Device.objects.select_for_update().filter(pk__in=by_device).values_list(
+                'pk', 'current_status', 'terminal')
+            current = {pk: status for pk, status, terminal in locked}
+            terminals = {pk: terminal for pk, status, terminal in locked}
+            for device_id, device_statuses in by_device.items():
+                for status, following in zip(device_statuses, device_statuses[1:]):
+                    status.end_time = following.start_time
+                # Close the interval of the current status
+                DeviceStatus.objects.filter(pk=current.get(device_id)).update(
+                    end_time=device_statuses[0].start_time)
+            created = DeviceStatus.objects.bulk_create(statuses)
+            authorizations = {s.authorization_id for s in statuses if s.authorization_id}
+            permission_groups = {}
+            if authorizations:
+                permission_groups = dict(Permission.objects.filter(
+                    pk__in=authorizations).values_list('pk', 'permission_group'))
+                # Usage extends the validity of the authorizing permissions
+                Permission.objects.filter(pk__in=authorizations).refresh_expiry()
+            changes = []
+            for device_id, device_statuses in by_device.items():
+                # Not all backends return primary keys from bulk_create
+                newest = DeviceStatus.objects.filter(
+                    device_id=device_id, start_time__gte=device_statuses[-1].start_time
+                ).order_by('-start_time', '-id').values_list('pk', flat=True).first()
+                Device.objects.filter(pk=device_id).update(current_status=newest)
+                # One change log entry per device and permission group, like save() would record
+                groups = {permission_groups.get(s.authorization_id) for s in device_statuses}
+                changes += [Change(model='devicestatus', object_id=str(newest),
+                                   action=Change.CREATED, terminal_id=terminals[device_id],
+                                   permission_group_id=group) for group in groups]
+            Change.objects.lock_for_insert()
+            Change.objects.bulk_create(changes)
+        return created
+
+
 class DeviceStatus(models.Model):
     device = models.ForeignKey(Device, related_name='status_history', on_delete=models.CASCADE)
-    start_time = models.DateTimeField(null=False)
+    start_time = models.DateTimeField(null=False, db_index=True)
+    # Start time of the following status of the same device, maintained by save()
+    end_time = models.DateTimeField(null=True, blank=True, editable=False)
     # TODO Validate that start_time is after most recent start_time for device
     in_operation = models.BooleanField(null=False)
     authorization = models.ForeignKey("Permission", null=True, blank=True, related_name='usage',
                                       on_delete=models.SET_NULL)
     # TODO Validate that authorization was valid at start_time and for device
     change_reason = models.TextField(blank=True)
-
-    @property
-    def end_time(self):
-        try:
-            return DeviceStatus.objects.filter(
-                device=self.device, start_time__gte=self.start_time, id__gt=self.id
-                ).order_by('start_time')[:1].get().start_time
-        except DeviceStatus.DoesNotExist:
-            return None
+    # Client supplied identifier, makes resubmission of buffered statuses idempotent
+    event_id = models.CharField(max_length=64, null=True, blank=True)
+
+    objects = DeviceStatusQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
+        with transaction.atomic():
+            # Serialize status insertions per device (no-op on backends without row locks)
+            self._terminal_id = Device.objects.select_for_update().filter(
+                pk=self.device_id).values_list('terminal', flat=True).first()
+            siblings = DeviceStatus.objects.filter(device_id=self.device_id)
+            following = siblings.filter(start_time__gt=self.start_time).order_by(
+                'start_time', 'id').values_list('start_time', flat=True).first()
+            preceding = siblings.filter(start_time__lte=self.start_time).order_by(
+                '-start_time', '-id').values_list('pk', flat=True).first()
+            self.end_time = following
+            super().save(*args, **kwargs)
+            if self.authorization_id is not None:
+                # Usage extends the validity of the authorizing permission
+                Permission.objects.filter(pk=self.authorization_id).refresh_expiry()
+            if preceding is not None:
+                DeviceStatus.objects.filter(pk=preceding).update(end_time=self.start_time)
+            if following is None:
+                # Newest status of this device, older statuses may be inserted late
+                Device.objects.filter(pk=self.device_id).update(current_status=self)
 
     def __str__(self):
         op = "IN" if self.in_operation else "NOT IN"
@@ -129,6 +279,8 @@ class DeviceStatus(models.Model):
     class Meta:
         ordering = ['-start_time', 'id']
         get_latest_by = 'start_time'
+        index_together = (('device', 'start_time'), ('authorization', 'start_time'))
+        unique_together = (('device', 'event_id'),)
 
 
 class PermissionGroup(models.Model):
@@ -145,44 +297,136 @@ class PermissionGroup(models.Model):
         help_text='Max. days since last use for permission to still be valid. If null/not set, '
                   'usage is not necessary.')
 
-    def get_valid_permissions(self):
-        # TODO make this work in the DB and using PermissionManager
-        return [p for p in (self.permission_set.filter(granted_until__gte=timezone.now()) |
-                            self.permission_set.filter(granted_until__isnull=True))
-                if p.valid_now]
+    def get_valid_permissions(self, at=None):
+        if at is None and hasattr(self, 'prefetched_valid_permissions'):
+            # See prefetch_valid_permissions()
+            return self.prefetched_valid_permissions
+        return self.permission_set.valid(at=at)
+
+    @staticmethod
+    def prefetch_valid_permissions(lookup='permission_set'):
+        '''
+        Returns the prefetch of the currently valid permissions of the groups at lookup (ending
+        with permission_set), which are then returned by get_valid_permissions()
+        '''
+        return Prefetch(lookup, queryset=Permission.objects.valid(),
+                        to_attr='prefetched_valid_permissions')
 
     def __str__(self):
         return "{} permission".format(self.name)
 
 
+class PermissionQuerySet(models.QuerySet):
+    def with_last_used(self):
+        '''Annotates last_used, the start of the newest status authorized by the permission'''
+        return self.annotate(last_used=self._last_used())
+
+    def _last_used(self):
+        last_usage = DeviceStatus.objects.filter(
+            authorization=OuterRef('pk')).order_by('-start_time').values('start_time')[:1]
+        return Coalesce(Subquery(last_usage, output_field=models.DateTimeField()), F('granted_on'))
+
+    def with_validity(self):
+        '''
+        Annotates last_used and valid_until, both computed by the database from the status history
+        (valid() uses the stored effective_expiry instead)
+        '''
+        last_used = self._last_used()
+        # A limit which does not apply (null) is replaced by TZ_MAX, so that Least() never sees a
+        # null (which would make the whole expression null on some backends)
+        unused_limit = Coalesce(
+            ExpressionWrapper(last_used + Days(F('permission_group__max_unused_days')),
+                              output_field=models.DateTimeField()),
+            Value(TZ_MAX, output_field=models.DateTimeField()))
+        # Permissions without granted_until are unlimited, max_unused_days does not apply
+        valid_until = Case(
+            When(granted_until__isnull=True,
+                 then=Value(TZ_MAX, output_field=models.DateTimeField())),
+            default=Least(unused_limit, F('granted_until')),
+            output_field=models.DateTimeField())
+        return self.annotate(last_used=last_used, valid_until=valid_until)
+
+    def valid(self, at=None):
+        '''Returns only permissions that are valid at the given time (default: now)'''
+        if at is None:
+            at = timezone.now()
+        # Range scan on the effective_expiry index, valid_until is the stored value
+        return self.filter(effective_expiry__gte=at).annotate(valid_until=F('effective_expiry'))
+
+    def expiring(self, start, end):
+        '''Returns permissions whose validity ends within [start, end)'''
+        return self.filter(effective_expiry__gte=start, effective_expiry__lt=end).annotate(
+            valid_until=F('effective_expiry'))
+
+    def refresh_expiry(self):
+        '''Recomputes effective_expiry of these permissions, returns the number of rows'''
+        computed = Permission.objects.with_validity().filter(pk=OuterRef('pk')).values(
+            'valid_until')[:1]
+        return self.update(effective_expiry=Subquery(computed))
+
+
+class PermissionManager(models.Manager.from_queryset(PermissionQuerySet)):
+    pass
+
+
 class Permission(models.Model):
+    # Indexed by the (granted_to, permission_group) index
     granted_to = models.ForeignKey(
-        Profile, related_name='permissions', on_delete=models.CASCADE)
-    granted_on = models.DateTimeField(auto_now_add=True)
+        Profile, related_name='permissions', db_index=False, on_delete=models.CASCADE)
+    granted_on = models.DateTimeField(auto_now_add=True, db_index=True)
     permission_group = models.ForeignKey(
         PermissionGroup, on_delete=models.CASCADE)
     granted_until = models.DateTimeField(
         null=True, blank=True, help_text='If not set, unlimited permission is granted.')
     granted_by = models.ForeignKey(Profile, null=True, blank=True, related_name='+',
                                    on_delete=models.SET_NULL)
-
+    # Stored valid_until (TZ_MAX if the permission does not expire), recomputed by save(), on
+    # usage and when the group's max_unused_days changes. See also the sweep_expiry command.
+    effective_expiry = models.DateTimeField(default=TZ_MAX, db_index=True, editable=False)
+
+    objects = PermissionManager()
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # granted_on is only set by saving, last usage might have changed since loading
+        for cached in ('_last_used', '_valid_until'):
+            self.__dict__.pop(cached, None)
+        if self.effective_expiry != self.valid_until:
+            self.effective_expiry = self.valid_until
+            Permission.objects.filter(pk=self.pk).update(effective_expiry=self.effective_expiry)
+
+    # last_used and valid_until are annotated by PermissionQuerySet.with_validity(). Instances
+    # loaded without annotation fall back to computing them here.
     @property
     def last_used(self):
-        try:
-            return self.usage.order_by('-start_time')[:1].get()
-        except DeviceStatus.DoesNotExist:
-            return self.granted_on
+        if not hasattr(self, '_last_used'):
+            try:
+                self._last_used = self.usage.order_by('-start_time')[:1].get().start_time
+            except DeviceStatus.DoesNotExist:
+                self._last_used = self.granted_on
+        return self._last_used
+
+    @last_used.setter
+    def last_used(self, value):
+        self._last_used = value
 
-    # TODO move this into the DB and make preselection in PermissionManager(models.Manager)
     @property
     def valid_until(self):
-        if self.granted_until == None:
-            return TZ_MAX
-        else:
-            return min(self.last_used + timedelta(days=self.permission_group.max_unused_days),
-                       self.granted_until)
+        if not hasattr(self, '_valid_until'):
+            # Permissions without granted_until are unlimited, max_unused_days does not apply
+            until = TZ_MAX
+            if self.granted_until is not None:
+                until = self.granted_until
+                max_unused_days = self.permission_group.max_unused_days
+                if max_unused_days is not None:
+                    until = min(until, self.last_used + timedelta(days=max_unused_days))
+            self._valid_until = until
+        return self._valid_until
+
+    @valid_until.setter
+    def valid_until(self, value):
+        self._valid_until = value
 
-    # TODO move this into the DB and make preselection in PermissionManager(models.Manager)
     @property
     def valid_now(self):
         # FIXME Use admin flag or special group for blanket permission?
@@ -195,6 +439,7 @@ class Permission(models.Model):
         else:
             # Set permission to expire now
             self.granted_until = timezone.now()
+            self.__dict__.pop('_valid_until', None)
 
     # TODO make sure no overlapping permissions exist
     # https://docs.djangoproject.com/en/1.11/ref/models/instances/#validating-objects
@@ -203,3 +448,223 @@ class Permission(models.Model):
         until = self.valid_until if self.valid_until != TZ_MAX else "forever"
         return "{} has {} until {}".format(
             self.granted_to, self.permission_group, until)
+
+    class Meta:
+        # Lookups of the valid permissions of a group, and of a profile's permissions
+        index_together = (('permission_group', 'effective_expiry'),
+                          ('granted_to', 'permission_group'))
+
+
+@receiver(post_delete, sender=DeviceStatus)
+def device_status_deleted(sender, instance, **kwargs):
+    # The preceding status now lasts until the deleted one would have ended
+    DeviceStatus.objects.filter(device_id=instance.device_id, end_time=instance.start_time).update(
+        end_time=instance.end_time)
+    device = Device.objects.filter(pk=instance.device_id, current_status__isnull=True).first()
+    if device is not None:
+        device.refresh_current_status()
+    if instance.authorization_id is not None:
+        # The deleted status might have been the last usage of its authorization
+        Permission.objects.filter(pk=instance.authorization_id).refresh_expiry()
+
+
+@receiver(pre_save, sender=DeviceStatus)
+def remember_previous_authorization(sender, instance, **kwargs):
+    if not instance._state.adding:
+        instance._previous_authorization_id = DeviceStatus.objects.filter(
+            pk=instance.pk).values_list('authorization', flat=True).first()
+
+
+@receiver(post_save, sender=DeviceStatus)
+def device_status_changed(sender, instance, created, **kwargs):
+    # Insertions are handled by DeviceStatus.save()
+    previous = getattr(instance, '_previous_authorization_id', None)
+    if not created and previous != instance.authorization_id:
+        Permission.objects.filter(pk__in=[previous, instance.authorization_id]).refresh_expiry()
+
+
+@receiver(pre_save, sender=PermissionGroup)
+def remember_previous_max_unused_days(sender, instance, **kwargs):
+    instance._previous_max_unused_days = PermissionGroup.objects.filter(
+        pk=instance.pk).values_list('max_unused_days', flat=True).first()
+
+
+@receiver(post_save, sender=PermissionGroup)
+def permission_group_changed(sender, instance, created, **kwargs):
+    if not created and instance._previous_max_unused_days != instance.max_unused_days:
+        instance.permission_set.all().refresh_expiry()
+
+
+class ChangeQuerySet(models.QuerySet):
+    def relevant_to(self, terminal):
+        '''Returns changes that affect the given terminal or its devices'''
+        groups = Device.objects.filter(terminal=terminal).values('required_permission_group')
+        members = Permission.objects.filter(permission_group__in=groups).values('granted_to')
+        return self.filter(
+            models.Q(terminal_id=terminal.id) |
+            models.Q(permission_group_id__in=groups) |
+            models.Q(model='profile', profile_id__in=members))
+
+    def last_seq(self):
+        '''Returns the newest sequence number, 0 if there is none'''
+        return self.aggregate(seq=Max('seq'))['seq'] or 0
+
+    def lock_for_insert(self):
+        '''
+        Makes inserts wait for this transaction, must be called in a transaction before inserting
+
+        Sequence numbers are assigned on insert, but rows only become visible on commit. Clients
+        sync up to the newest visible sequence number, so a change committed after a higher one
+        would never be sent. With inserts serialized until commit, every change up to the newest
+        visible one is visible as well. On PostgreSQL the table is locked (reads are not blocked),
+        SQLite transactions take the write lock when they begin (see backends/sqlite3).
+        '''
+        connection = connections[self.db]
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('LOCK TABLE {} IN EXCLUSIVE MODE'.format(
+                    connection.ops.quote_name(self.model._meta.db_table)))
+
+
+class Change(models.Model):
+    '''Change log entry, seq is the monotonically increasing sequence number'''
+    CREATED = 'created'
+    UPDATED = 'updated'
+    WITHDRAWN = 'withdrawn'
+    DELETED = 'deleted'
+    ACTIONS = ((CREATED, 'created'), (UPDATED, 'updated'), (WITHDRAWN, 'withdrawn'),
+               (DELETED, 'deleted'))
+
+    seq = models.BigAutoField(primary_key=True)
+    timestamp = models.DateTimeField(auto_now_add=True)
+    model = models.CharField(max_length=30)
+    object_id = models.CharField(max_length=255)
+    action = models.CharField(max_length=10, choices=ACTIONS)
+    # Scope of the change, used to select the changes relevant to a terminal. No foreign keys, so
+    # that entries outlive the objects they refer to.
+    terminal_id = models.IntegerField(null=True, blank=True, db_index=True)
+    permission_group_id = models.IntegerField(null=True, blank=True, db_index=True)
+    profile_id = models.IntegerField(null=True, blank=True, db_index=True)
+
+    objects = ChangeQuerySet.as_manager()
+
+    @classmethod
+    def record(cls, instance, action, **scope):
+        # Without a savepoint, the lock is held until the enclosing transaction ends
+        with transaction.atomic(savepoint=False):
+            cls.objects.lock_for_insert()
+            return cls.objects.create(model=instance._meta.model_name,
+                                      object_id=str(instance.pk), action=action, **scope)
+
+    def __str__(self):
+        return "#{} {} {} {}".format(self.seq, self.model, self.object_id, self.action)
+
+    class Meta:
+        ordering = ['seq']
+
+
+def _change_scopes(instance):
+    '''Yields the change log scopes an instance belongs to'''
+    if isinstance(instance, Terminal):
+        yield {'terminal_id': instance.pk}
+    elif isinstance(instance, Device):
+        yield {'terminal_id': instance.terminal_id}
+        previous = getattr(instance, '_previous_terminal_id', None)
+        if previous is not None and previous != instance.terminal_id:
+            # The device was moved away from its previous terminal
+            yield {'terminal_id': previous}
+    elif isinstance(instance, PermissionGroup):
+        yield {'permission_group_id': instance.pk}
+    elif isinstance(instance, Permission):
+        yield {'permission_group_id': instance.permission_group_id,
+               'profile_id': instance.granted_to_id}
+    elif isinstance(instance, Profile):
+        yield {'profile_id': instance.pk}
+    elif isinstance(instance, DeviceStatus):
+        if hasattr(instance, '_terminal_id'):
+            # Looked up by save()
+            terminal_id = instance._terminal_id
+        else:
+            terminal_id = Device.objects.filter(pk=instance.device_id).values_list(
+                'terminal', flat=True).first()
+        # Usage extends the validity of the authorizing permission
+        permission_group_id = Permission.objects.filter(pk=instance.authorization_id).values_list(
+            'permission_group', flat=True).first() if instance.authorization_id else None
+        yield {'terminal_id': terminal_id, 'permission_group_id': permission_group_id}
+
+
+@receiver(pre_save, sender=Device)
+def remember_previous_terminal(sender, instance, **kwargs):
+    instance._previous_terminal_id = Device.objects.filter(pk=instance.pk).values_list(
+        'terminal', flat=True).first()
+
+
+def record_save(sender, instance, created, **kwargs):
+    if created:
+        action = Change.CREATED
+    elif (sender is Permission and instance.granted_until is not None and
+            instance.granted_until <= timezone.now()):
+        action = Change.WITHDRAWN
+    else:
+        action = Change.UPDATED
+    for scope in _change_scopes(instance):
+        Change.record(instance, action, **scope)
+
+
+def record_delete(sender, instance, **kwargs):
+    for scope in _change_scopes(instance):
+        Change.record(instance, Change.DELETED, **scope)
+
+
+for _model in (Permission, Profile, Device, PermissionGroup, Terminal, DeviceStatus):
+    post_save.connect(record_save, sender=_model, dispatch_uid='change_log_save')
+    post_delete.connect(record_delete, sender=_model, dispatch_uid='change_log_delete')
+
+
+class UsageRollup(models.Model):
+    '''
+    Usage of a device within one hour or day (UTC), aggregated from the status history by
+    rollups.catch_up()
+
+    Usage is the time a user was logged in (the status had an authorization), operation the time
+    the device was in operation. permission_group is the group of the authorization, null for
+    time without one.
+    '''
+    HOUR = 'hour'
+    DAY = 'day'
+    PERIODS = ((HOUR, 'hour'), (DAY, 'day'))
+
+    period = models.CharField(max_length=4, choices=PERIODS)
+    bucket = models.DateTimeField(help_text='Start of the hour or day')
+    device = models.ForeignKey(Device, related_name='usage_rollups', on_delete=models.CASCADE)
+    permission_group = models.ForeignKey(PermissionGroup, null=True, blank=True,
+                                         related_name='usage_rollups', on_delete=models.CASCADE)
+    usage_minutes = models.FloatField(default=0)
+    operated_minutes = models.FloatField(default=0)
+    sessions = models.PositiveIntegerField(default=0, help_text='Number of logins')
+
+    def __str__(self):
+        return "{} {} of {} ({}): {:.0f} min used".format(
+            self.period, self.bucket, self.device_id, self.permission_group_id,
+            self.usage_minutes)
+
+    class Meta:
+        ordering = ['period', 'bucket', 'device', 'permission_group']
+        unique_together = (('period', 'bucket', 'device', 'permission_group'),)
+        index_together = (('period', 'device', 'bucket'), ('period', 'permission_group', 'bucket'))
+
+
+class RollupWatermark(models.Model):
+    '''Time up to which the status history has been aggregated into UsageRollup (single row)'''
+    time = models.DateTimeField()
+
+    def __str__(self):
+        return "Usage rolled up until {}".format(self.time)
+
+
+class ExpiryWatermark(models.Model):
+    '''Time up to which expiry.sweep() has sent notifications (single row)'''
+    time = models.DateTimeField()
+
+    def __str__(self):
+        return "Expiry swept until {}".format(self.time)
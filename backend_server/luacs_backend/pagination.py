@@ -0,0 +1,16 @@
+from rest_framework.pagination import CursorPagination
+
+
+class StatusCursorPagination(CursorPagination):
+    '''Keyset pagination over the status history, newest first'''
+    ordering = ('-start_time', '-id')
+
+
+class PermissionCursorPagination(CursorPagination):
+    '''Keyset pagination over permissions, oldest grant first'''
+    ordering = ('granted_on', 'id')
+
+
+class UsageCursorPagination(CursorPagination):
+    '''Keyset pagination over usage rollups, newest bucket first'''
+    ordering = ('-bucket', 'id')
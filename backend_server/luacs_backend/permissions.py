@@ -1,5 +1,13 @@
 from __future__ import unicode_literals
 
+from collections import OrderedDict
+import threading
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils.translation import ugettext_lazy as _
 from rest_framework.permissions import BasePermission
 from rest_framework.authentication import get_authorization_header
 from rest_framework import exceptions
@@ -7,6 +15,78 @@ from rest_framework import exceptions
 from . import models
 
 
+class TerminalCache:
+    '''
+    Bounded in-process cache mapping tokens to terminal ids
+
+    Entries expire after ttl seconds, least recently used entries are dropped beyond max_size.
+    Changes to terminals invalidate entries through signals, the ttl bounds how long
+    other processes may serve stale entries.
+    '''
+    def __init__(self, max_size=256, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        '''Returns the terminal id or None'''
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return value
+
+    def set(self, token, terminal_id):
+        with self._lock:
+            self._entries[token] = (time.monotonic() + self.ttl, terminal_id)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, terminal_id, token=None):
+        with self._lock:
+            self._entries.pop(token, None)
+            for cached_token, (expires, value) in list(self._entries.items()):
+                if value == terminal_id:
+                    del self._entries[cached_token]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+terminal_cache = TerminalCache(
+    max_size=getattr(settings, 'LUACS_TERMINAL_CACHE_SIZE', 256),
+    ttl=getattr(settings, 'LUACS_TERMINAL_CACHE_TTL', 60))
+
+
+@receiver(post_save, sender=models.Terminal)
+@receiver(post_delete, sender=models.Terminal)
+def invalidate_terminal(sender, instance, **kwargs):
+    terminal_cache.invalidate(instance.pk, instance.token)
+
+
+def get_terminal(token):
+    '''Returns the terminal with the given token, None if there is none'''
+    terminal_id = terminal_cache.get(token)
+    if terminal_id is not None:
+        # Terminals have no other fields, a fresh instance per request avoids sharing state
+        # between threads
+        return models.Terminal(id=terminal_id, token=token)
+    try:
+        terminal = models.Terminal.objects.get(token=token)
+    except models.Terminal.DoesNotExist:
+        return None
+    terminal_cache.set(token, terminal.id)
+    return terminal
+
+
 # Helper grant permission to Terminals according to their token passed via http headers:
 # -H "Authorization: Token Bearer 12345678901234567890" (curl)
 # Using CoreAPI:
@@ -14,8 +94,14 @@ from . import models
 # $ coreapi credentials add localhost:8000 "Token 123123123"
 class TerminalTokenOrAdminUserPermission(BasePermission):
     keyword = 'Token'
-    
+
     def has_permission(self, request, view):
+        # Object level checks reuse the result of the view level check
+        if not hasattr(request, '_terminal_permission'):
+            request._terminal_permission = self._check(request)
+        return request._terminal_permission
+
+    def _check(self, request):
         request.terminal = None
         if request.user and request.user.is_superuser:
             return True
@@ -37,11 +123,8 @@ class TerminalTokenOrAdminUserPermission(BasePermission):
             msg = _('Invalid token header. Token string should not contain invalid characters.')
             raise exceptions.AuthenticationFailed(msg)
         
-        try:
-            request.terminal = models.Terminal.objects.get(token=token)
-            return True
-        except models.Terminal.DoesNotExist:
-            return False
+        request.terminal = get_terminal(token)
+        return request.terminal is not None
 
     def has_object_permission(self, request, view, obj):
         return self.has_permission(request, view)
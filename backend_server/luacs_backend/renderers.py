@@ -0,0 +1,56 @@
+'''
+MessagePack renderer and parser, and a renderer for server-sent event streams
+
+Binary alternative to JSON for terminal traffic, selected with "Accept: application/msgpack" and
+"Content-Type: application/msgpack". Only enabled if the optional msgpack package is installed.
+Values without a MessagePack type (e.g., datetimes) are encoded as strings like the JSON renderer
+does.
+'''
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+from .events import format_event
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=JSONEncoder().default, use_bin_type=True)
+
+
+class MessagePackParser(BaseParser):
+    media_type = 'application/msgpack'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return msgpack.unpackb(stream.read(), raw=False)
+        except Exception as exc:
+            raise ParseError('MessagePack parse error - {}'.format(exc))
+
+
+class EventStreamRenderer(BaseRenderer):
+    '''
+    Accepts text/event-stream for views that stream events themselves, and renders their error
+    responses (e.g., failed authentication) as a single "error" event
+    '''
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return format_event(data, event='error').encode()
@@ -0,0 +1,140 @@
+'''
+Usage rollups
+
+The status history is aggregated into UsageRollup rows per hour and day (UTC), device and
+permission group. catch_up() continues from the RollupWatermark and only reads the statuses
+overlapping the new time window, so running it periodically keeps the rollups current at a
+constant cost. Statuses inserted or deleted before the watermark are not picked up anymore,
+rebuild() recomputes all rollups from the complete history.
+'''
+from datetime import timedelta
+import itertools
+
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery
+from django.utils import timezone
+
+from .models import Device, DeviceStatus, UsageRollup, RollupWatermark
+
+
+PERIOD_LENGTH = {UsageRollup.HOUR: timedelta(hours=1), UsageRollup.DAY: timedelta(days=1)}
+
+
+def bucket_start(time, period):
+    '''Returns the start of the hour or day (UTC) containing time'''
+    time = time.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    if period == UsageRollup.DAY:
+        time = time.replace(hour=0)
+    return time
+
+
+def split(start, end, period):
+    '''Yields (bucket, seconds) for all buckets overlapping the interval [start, end)'''
+    bucket = bucket_start(start, period)
+    while bucket < end:
+        following = bucket + PERIOD_LENGTH[period]
+        yield bucket, (min(end, following) - max(start, bucket)).total_seconds()
+        bucket = following
+
+
+def collect(start, end):
+    '''
+    Returns the usage within [start, end) as
+    {(period, bucket, device id, permission group id): [usage, operation, sessions]}
+    '''
+    fields = ('device', 'start_time', 'end_time', 'in_operation', 'authorization',
+              'authorization__permission_group', 'id')
+    # The status active at start of every device, found on the (device, start_time) index
+    preceding = Device.objects.annotate(status=Subquery(
+        DeviceStatus.objects.filter(device=OuterRef('pk'), start_time__lt=start).order_by(
+            '-start_time', '-id').values('pk')[:1])).filter(status__isnull=False).values('status')
+    statuses = sorted(itertools.chain(
+        DeviceStatus.objects.filter(pk__in=preceding).values_list(*fields),
+        DeviceStatus.objects.filter(start_time__gte=start, start_time__lt=end).values_list(*fields),
+    ), key=lambda s: (s[0], s[1], s[6]))
+
+    totals = {}
+    previous = None
+    for device, status_start, status_end, in_operation, authorization, group, pk in statuses:
+        if previous is not None and previous[0] != device:
+            previous = None
+        # A login, if the previous status of the device did not have the same authorization
+        login = (status_start >= start and authorization is not None and
+                 (previous is None or previous[4] != authorization))
+        interval_start = max(status_start, start)
+        interval_end = min(status_end or end, end)
+        for period in PERIOD_LENGTH:
+            if login:
+                key = (period, bucket_start(status_start, period), device, group)
+                totals.setdefault(key, [0, 0, 0])[2] += 1
+            if interval_end <= interval_start or not (authorization or in_operation):
+                continue
+            for bucket, seconds in split(interval_start, interval_end, period):
+                total = totals.setdefault((period, bucket, device, group), [0, 0, 0])
+                if authorization is not None:
+                    total[0] += seconds / 60
+                if in_operation:
+                    total[1] += seconds / 60
+        previous = (device, status_start, status_end, in_operation, authorization)
+    return totals
+
+
+def add(totals):
+    '''Adds the totals returned by collect() to the UsageRollup rows'''
+    if not totals:
+        return
+    existing = {
+        (r.period, r.bucket, r.device_id, r.permission_group_id): r.pk
+        for r in UsageRollup.objects.filter(bucket__gte=min(key[1] for key in totals)).only(
+            'pk', 'period', 'bucket', 'device', 'permission_group')}
+    new = []
+    for key, (usage, operation, sessions) in totals.items():
+        if key in existing:
+            UsageRollup.objects.filter(pk=existing[key]).update(
+                usage_minutes=F('usage_minutes') + usage,
+                operated_minutes=F('operated_minutes') + operation,
+                sessions=F('sessions') + sessions)
+        else:
+            period, bucket, device, group = key
+            new.append(UsageRollup(period=period, bucket=bucket, device_id=device,
+                                   permission_group_id=group, usage_minutes=usage,
+                                   operated_minutes=operation, sessions=sessions))
+    UsageRollup.objects.bulk_create(new)
+
+
+def watermark():
+    '''Returns the time up to which usage has been rolled up, None if it never was'''
+    return RollupWatermark.objects.values_list('time', flat=True).first()
+
+
+def catch_up(until=None, chunk=timedelta(days=7)):
+    '''
+    Rolls up the usage from the watermark until the given time (default: now), one transaction
+    per chunk. Returns the new watermark.
+    '''
+    if until is None:
+        until = timezone.now()
+    while True:
+        with transaction.atomic():
+            # Locked, so that concurrent runs do not count a window twice
+            mark = RollupWatermark.objects.select_for_update().first()
+            if mark is None:
+                first = DeviceStatus.objects.order_by('start_time').values_list(
+                    'start_time', flat=True).first()
+                if first is None:
+                    return None
+                mark = RollupWatermark(time=first)
+            if mark.time >= until:
+                return mark.time
+            end = min(until, mark.time + chunk)
+            add(collect(mark.time, end))
+            mark.time = end
+            mark.save()
+
+
+def rebuild(until=None, chunk=timedelta(days=7)):
+    '''Deletes all rollups and rolls up the complete status history again'''
+    with transaction.atomic():
+        UsageRollup.objects.all().delete()
+        RollupWatermark.objects.all().delete()
+        return catch_up(until, chunk)
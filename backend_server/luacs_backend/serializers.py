@@ -2,15 +2,24 @@ from rest_framework import serializers
 from django.contrib.auth.models import User
 
 from . import models
+from .expansion import ExpandableSerializerMixin
 
 
-class PermissionSerializer(serializers.HyperlinkedModelSerializer):
+class PermissionSerializer(ExpandableSerializerMixin, serializers.HyperlinkedModelSerializer):
+    expandable_fields = {
+        'granted_to': ('ProfileSerializer', {}),
+        'permission_group': ('PermissionGroupSerializer', {}),
+    }
+
     class Meta:
         model = models.Permission
         fields = ('granted_to_id', 'granted_to', 'permission_group', 'valid_until', 'url')
 
 
-class PermissionGroupSerializer(serializers.HyperlinkedModelSerializer):
+class PermissionGroupSerializer(ExpandableSerializerMixin,
+                                serializers.HyperlinkedModelSerializer):
+    expandable_fields = {'devices': ('DeviceSerializer', {'many': True})}
+
     class Meta:
         model = models.PermissionGroup
         fields = ('name', 'default_permission_days', 'max_unused_days', 'devices', 'url')
@@ -34,13 +43,17 @@ class ProfileSerializer(serializers.HyperlinkedModelSerializer):
 class DeviceStatusSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = models.DeviceStatus
-        fields = ('start_time', 'device', 'in_operation', 'authorization', 'change_reason')
+        fields = ('start_time', 'end_time', 'device', 'in_operation', 'authorization',
+                  'change_reason')
 
 
-class DeviceSerializer(serializers.HyperlinkedModelSerializer):
+class DeviceSerializer(ExpandableSerializerMixin, serializers.HyperlinkedModelSerializer):
+    expandable_fields = {'required_permission_group': (PermissionGroupSerializer, {})}
     valid_permissions = PermissionSerializer(
         source='get_valid_permissions', many=True, read_only=True)
-    # TODO automatic_logout should serialized as integer seconds not a timedelta string
+    authorization = serializers.HyperlinkedRelatedField(
+        source='current_status.authorization', view_name='permission-detail', read_only=True)
+    # automatic_logout is a timedelta string here, CompactDeviceSerializer uses integer seconds
 
     class Meta:
         model = models.Device
@@ -49,9 +62,106 @@ class DeviceSerializer(serializers.HyperlinkedModelSerializer):
                   'in_operation', 'authorization', 'url')
 
 
-class TerminalSerializer(serializers.HyperlinkedModelSerializer):
+class TerminalSerializer(ExpandableSerializerMixin, serializers.HyperlinkedModelSerializer):
+    expandable_fields = {'devices': (DeviceSerializer, {'many': True})}
+
     class Meta:
         model = models.Terminal
         fields = ['id', 'devices', 'url']
         #exclude = ['token']
 
+
+class ChangeSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = models.Change
+        fields = ('seq', 'timestamp', 'model', 'object_id', 'action')
+
+
+class DeviceStatusEventSerializer(serializers.Serializer):
+    event_id = serializers.CharField(max_length=64)
+    device = serializers.SlugField()
+    start_time = serializers.DateTimeField()
+    in_operation = serializers.BooleanField()
+    authorization = serializers.IntegerField(allow_null=True, required=False, default=None)
+    change_reason = serializers.CharField(allow_blank=True, required=False, default='')
+
+
+class AuthorizationRequestSerializer(serializers.Serializer):
+    device = serializers.SlugField()
+    id_type = serializers.CharField(max_length=10)
+    id_string = serializers.CharField(max_length=255)
+
+
+class UsageRollupSerializer(serializers.HyperlinkedModelSerializer):
+    class Meta:
+        model = models.UsageRollup
+        fields = ('period', 'bucket', 'device', 'permission_group', 'usage_minutes',
+                  'operated_minutes', 'sessions')
+
+
+# Compact representation (API version 2, see versioning.py)
+
+class CompactPermissionSerializer(ExpandableSerializerMixin, serializers.ModelSerializer):
+    expandable_fields = {
+        'granted_to': ('CompactProfileSerializer', {}),
+        'permission_group': ('CompactPermissionGroupSerializer', {}),
+    }
+    valid_until = serializers.DateTimeField(read_only=True)
+
+    class Meta:
+        model = models.Permission
+        fields = ('id', 'granted_to', 'permission_group', 'granted_until', 'valid_until')
+
+
+class CompactPermissionGroupSerializer(ExpandableSerializerMixin, serializers.ModelSerializer):
+    expandable_fields = {'devices': ('CompactDeviceSerializer', {'many': True})}
+
+    class Meta:
+        model = models.PermissionGroup
+        fields = ('id', 'name', 'default_permission_days', 'max_unused_days', 'devices')
+
+
+class CompactProfileSerializer(ProfileSerializer):
+    class Meta(ProfileSerializer.Meta):
+        fields = ('id', 'first_name', 'last_name', 'username', 'email', 'is_active', 'id_type',
+                  'id_string')
+
+
+class CompactDeviceStatusSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = models.DeviceStatus
+        fields = ('id', 'start_time', 'end_time', 'device', 'in_operation', 'authorization',
+                  'change_reason')
+
+
+class CompactDeviceSerializer(ExpandableSerializerMixin, serializers.ModelSerializer):
+    expandable_fields = {
+        'required_permission_group': (CompactPermissionGroupSerializer, {}),
+    }
+    automatic_logout = serializers.IntegerField(source='automatic_logout_seconds', read_only=True)
+    in_operation = serializers.BooleanField(read_only=True)
+    authorization = serializers.IntegerField(source='current_status.authorization_id',
+                                             read_only=True)
+    # [permission id, profile id, valid until] rows
+    valid_permissions = serializers.SerializerMethodField()
+
+    class Meta:
+        model = models.Device
+        fields = ('shortname', 'model_name', 'terminal', 'automatic_logout',
+                  'allow_logout_during_operation', 'valid_permissions', 'required_permission_group',
+                  'in_operation', 'authorization')
+
+    def get_valid_permissions(self, device):
+        permissions = device.get_valid_permissions()
+        if isinstance(permissions, list):
+            # Prefetched
+            return [[p.id, p.granted_to_id, p.valid_until] for p in permissions]
+        return [list(row) for row in permissions.values_list('id', 'granted_to', 'valid_until')]
+
+
+class CompactTerminalSerializer(ExpandableSerializerMixin, serializers.ModelSerializer):
+    expandable_fields = {'devices': (CompactDeviceSerializer, {'many': True})}
+
+    class Meta:
+        model = models.Terminal
+        fields = ('id', 'devices')
@@ -1,3 +1,1502 @@
-from django.test import TestCase
+import asyncio
+from concurrent.futures import Executor, Future
+import json
+from datetime import timedelta
+from io import StringIO
+import threading
+from unittest import skipIf
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management import call_command
+from django.core.signals import request_finished, request_started
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connection, connections, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.http import urlencode
+
+from . import apiviews
+from . import models
+from . import metrics
+from . import permissions
+from . import expiry
+from . import rollups
+from . import documents
+from . import events
+from .asgi import ASGIHandler, QUEUE_SIZE
+from .renderers import msgpack
+
+
+class PermissionManagerTest(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        self.group = models.PermissionGroup.objects.create(name='Laser', max_unused_days=90)
+        self.device = models.Device.objects.create(
+            shortname='laser', model_name='Laser', required_permission_group=self.group)
+        self.profiles = []
+        for i in range(5):
+            user = User.objects.create(username='user{}'.format(i))
+            self.profiles.append(models.Profile.objects.create(
+                user=user, id_type='rfid', id_string=str(i)))
+
+    def grant(self, profile, granted_on, granted_until=None):
+        # max_unused_days only applies to permissions with granted_until
+        if granted_until is None:
+            granted_until = self.now + timedelta(days=365)
+        permission = models.Permission.objects.create(
+            granted_to=profile, permission_group=self.group, granted_until=granted_until)
+        # granted_on uses auto_now_add and can only be changed after creation, bulk updates do not
+        # recompute the stored expiry
+        permissions = models.Permission.objects.filter(pk=permission.pk)
+        permissions.update(granted_on=granted_on)
+        permissions.refresh_expiry()
+        return permission
+
+    def test_validity_is_annotated(self):
+        fresh = self.grant(self.profiles[0], self.now - timedelta(days=10))
+        unused = self.grant(self.profiles[1], self.now - timedelta(days=100))
+        expired = self.grant(self.profiles[2], self.now - timedelta(days=10),
+                             granted_until=self.now - timedelta(days=1))
+        used = self.grant(self.profiles[3], self.now - timedelta(days=100))
+        models.DeviceStatus.objects.create(
+            device=self.device, start_time=self.now - timedelta(days=5), in_operation=True,
+            authorization=used)
+
+        valid = set(models.Permission.objects.valid().values_list('pk', flat=True))
+        self.assertEqual(valid, {fresh.pk, used.pk})
+
+        annotated = models.Permission.objects.with_validity().get(pk=used.pk)
+        self.assertEqual(annotated.last_used, self.now - timedelta(days=5))
+        self.assertEqual(annotated.valid_until, self.now + timedelta(days=85))
+
+        # Unannotated instances compute the same values in python
+        for permission in models.Permission.objects.with_validity():
+            plain = models.Permission.objects.get(pk=permission.pk)
+            self.assertEqual(plain.valid_until, permission.valid_until)
+            self.assertEqual(plain.valid_now, permission.valid_now)
+        self.assertFalse(models.Permission.objects.get(pk=unused.pk).valid_now)
+        self.assertFalse(models.Permission.objects.get(pk=expired.pk).valid_now)
+
+    def test_unused_days_not_set(self):
+        self.group.max_unused_days = None
+        self.group.save()
+        permission = self.grant(self.profiles[0], self.now - timedelta(days=1000))
+        annotated = models.Permission.objects.with_validity().get(pk=permission.pk)
+        self.assertEqual(annotated.valid_until, permission.granted_until)
+        self.assertIn(permission, self.group.get_valid_permissions())
+
+    def test_unlimited_permission(self):
+        # Without granted_until a permission stays valid, even if it is never used
+        permission = models.Permission.objects.create(
+            granted_to=self.profiles[0], permission_group=self.group)
+        permissions = models.Permission.objects.filter(pk=permission.pk)
+        permissions.update(granted_on=self.now - timedelta(days=1000))
+        permissions.refresh_expiry()
+        annotated = models.Permission.objects.with_validity().get(pk=permission.pk)
+        self.assertEqual(annotated.valid_until, models.TZ_MAX)
+        self.assertEqual(models.Permission.objects.get(pk=permission.pk).valid_until,
+                         models.TZ_MAX)
+        self.assertIn(permission, self.group.get_valid_permissions())
+
+    def test_valid_at(self):
+        permission = self.grant(self.profiles[0], self.now - timedelta(days=10))
+        self.assertIn(permission, models.Permission.objects.valid(
+            at=self.now + timedelta(days=79)))
+        self.assertNotIn(permission, models.Permission.objects.valid(
+            at=self.now + timedelta(days=81)))
+
+    def test_group_check_uses_constant_queries(self):
+        for profile in self.profiles:
+            self.grant(profile, self.now)
+        with self.assertNumQueries(1):
+            permissions = list(self.device.get_valid_permissions())
+            self.assertTrue(all(p.valid_now for p in permissions))
+        self.assertEqual(len(permissions), len(self.profiles))
+
+
+class DeviceCurrentStatusTest(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        self.device = models.Device.objects.create(shortname='door', model_name='Door')
+
+    def add_status(self, minutes_ago, in_operation):
+        return models.DeviceStatus.objects.create(
+            device=self.device, start_time=self.now - timedelta(minutes=minutes_ago),
+            in_operation=in_operation)
+
+    def test_pointer_follows_newest_status(self):
+        self.assertIsNone(self.device.current_status)
+        first = self.add_status(10, True)
+        newest = self.add_status(5, False)
+        # A late insertion of an older status must not move the pointer backwards
+        self.add_status(7, True)
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.current_status, newest)
+        self.assertFalse(self.device.in_operation)
+
+        newest.delete()
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.current_status.start_time, self.now - timedelta(minutes=7))
+        self.assertNotEqual(self.device.current_status, first)
+
+    def test_reading_state_does_not_touch_history(self):
+        for i in range(10):
+            self.add_status(10 - i, bool(i % 2))
+        device = models.Device.objects.select_related('current_status').get(pk=self.device.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(device.in_operation)
+            self.assertIsNone(device.authorization)
+
+
+class DeviceStatusIntervalTest(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        self.device = models.Device.objects.create(shortname='laser', model_name='Laser')
+        self.statuses = [
+            models.DeviceStatus.objects.create(
+                device=self.device, start_time=self.now - timedelta(hours=h), in_operation=False)
+            for h in (5, 3, 1)]
+
+    def test_end_time_is_stored(self):
+        # Insert a status between two existing ones
+        late = models.DeviceStatus.objects.create(
+            device=self.device, start_time=self.now - timedelta(hours=2), in_operation=True)
+        end_times = {s.pk: s.end_time for s in models.DeviceStatus.objects.all()}
+        self.assertEqual(end_times[self.statuses[0].pk], self.statuses[1].start_time)
+        self.assertEqual(end_times[self.statuses[1].pk], late.start_time)
+        self.assertEqual(end_times[late.pk], self.statuses[2].start_time)
+        self.assertIsNone(end_times[self.statuses[2].pk])
+
+        late.delete()
+        self.statuses[1].refresh_from_db()
+        self.assertEqual(self.statuses[1].end_time, self.statuses[2].start_time)
+
+    def test_status_at(self):
+        self.assertIsNone(self.device.status_at(self.now - timedelta(hours=6)))
+        self.assertEqual(self.device.status_at(self.now - timedelta(hours=4)), self.statuses[0])
+        self.assertEqual(self.device.status_at(self.now - timedelta(hours=3)), self.statuses[1])
+        self.assertEqual(self.device.status_at(self.now), self.statuses[2])
+        self.assertEqual(
+            list(models.DeviceStatus.objects.active_at(self.now - timedelta(hours=4))),
+            [self.statuses[0]])
+
+    def test_overlapping(self):
+        overlapping = models.DeviceStatus.objects.overlapping(
+            self.now - timedelta(hours=4), self.now - timedelta(hours=2))
+        self.assertEqual(set(overlapping), set(self.statuses[:2]))
+        self.assertEqual(
+            set(models.DeviceStatus.objects.overlapping(self.now, models.TZ_MAX)),
+            {self.statuses[2]})
+
+
+class ProfileLookupTest(TestCase):
+    def setUp(self):
+        models.Terminal.objects.create(token='terminal-token')
+        self.client.defaults['HTTP_AUTHORIZATION'] = 'Token terminal-token'
+        for i in range(15):
+            user = User.objects.create(username='user{}'.format(i))
+            models.Profile.objects.create(user=user, id_type='rfid', id_string='card{}'.format(i))
+
+    def test_lookup(self):
+        # One query authenticates the terminal (cached afterwards), one finds the profile
+        with self.assertNumQueries(2):
+            response = self.client.get(
+                '/luacs/api/profiles/lookup/', {'id_type': 'rfid', 'id_string': 'card14'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['username'], 'user14')
+
+    def test_lookup_unknown(self):
+        response = self.client.get(
+            '/luacs/api/profiles/lookup/', {'id_type': 'rfid', 'id_string': 'unknown'})
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get('/luacs/api/profiles/lookup/', {'id_type': 'rfid'})
+        self.assertEqual(response.status_code, 400)
+
+
+class AuthorizeTest(TestCase):
+    def setUp(self):
+        terminal = models.Terminal.objects.create(token='terminal-token')
+        other_terminal = models.Terminal.objects.create(token='other-token')
+        self.group = models.PermissionGroup.objects.create(name='Laser')
+        models.Device.objects.create(
+            shortname='laser', model_name='Laser', required_permission_group=self.group,
+            terminal=terminal, automatic_logout=timedelta(minutes=5))
+        models.Device.objects.create(
+            shortname='door', model_name='Door', terminal=other_terminal)
+        user = User.objects.create(username='jdoe', first_name='Jane', last_name='Doe')
+        self.profile = models.Profile.objects.create(user=user, id_type='rfid', id_string='42')
+        self.client.defaults['HTTP_AUTHORIZATION'] = 'Token terminal-token'
+
+    def authorize(self, device='laser', id_string='42'):
+        return self.client.post('/luacs/api/authorize/',
+                                {'device': device, 'id_type': 'rfid', 'id_string': id_string})
+
+    def test_authorized(self):
+        permission = models.Permission.objects.create(
+            granted_to=self.profile, permission_group=self.group)
+        # Terminal (cached afterwards), device, profile and permission
+        with self.assertNumQueries(4):
+            response = self.authorize()
+        data = response.json()
+        self.assertTrue(data['authorized'])
+        self.assertEqual(data['permission'], permission.pk)
+        self.assertEqual(data['user'], {'id': self.profile.pk, 'name': 'Jane Doe'})
+        self.assertEqual(data['device'], {'shortname': 'laser', 'automatic_logout': 300,
+                                          'allow_logout_during_operation': False})
+
+    def test_denied(self):
+        data = self.authorize().json()
+        self.assertFalse(data['authorized'])
+        self.assertEqual(data['reason'], 'no valid permission')
+        data = self.authorize(id_string='43').json()
+        self.assertIsNone(data['user'])
+        self.assertEqual(data['reason'], 'unknown credential')
+
+    def test_foreign_device(self):
+        self.assertEqual(self.authorize(device='door').status_code, 404)
+
+
+class TerminalSnapshotTest(TestCase):
+    def setUp(self):
+        self.terminal = models.Terminal.objects.create(token='terminal-token')
+        laser = models.PermissionGroup.objects.create(name='Laser')
+        door = models.PermissionGroup.objects.create(name='Door', max_unused_days=None)
+        models.Device.objects.create(shortname='laser', model_name='Laser',
+                                     required_permission_group=laser, terminal=self.terminal)
+        models.Device.objects.create(shortname='door', model_name='Door',
+                                     required_permission_group=door, terminal=self.terminal)
+        self.profiles = []
+        for i in range(3):
+            user = User.objects.create(username='user{}'.format(i))
+            profile = models.Profile.objects.create(user=user, id_type='rfid', id_string=str(i))
+            models.Permission.objects.create(granted_to=profile, permission_group=door)
+            self.profiles.append(profile)
+        self.laser_permission = models.Permission.objects.create(
+            granted_to=self.profiles[0], permission_group=laser)
+        self.client.defaults['HTTP_AUTHORIZATION'] = 'Token terminal-token'
+
+    def test_snapshot(self):
+        # Terminal (cached afterwards), change log sequence, devices (twice: configuration and
+        # permission groups) and permissions
+        with self.assertNumQueries(5):
+            response = self.client.get('/luacs/api/terminals/snapshot/')
+        data = response.json()
+        self.assertEqual(response['ETag'], '"{}"'.format(data['version']))
+        self.assertEqual(data['devices']['laser']['automatic_logout'], 0)
+        self.assertEqual(set(data['credentials']['rfid']), {'0', '1', '2'})
+        self.assertEqual(set(data['credentials']['rfid']['0']['devices']), {'laser', 'door'})
+        self.assertEqual(data['credentials']['rfid']['0']['devices']['laser']['permission'],
+                         self.laser_permission.pk)
+        self.assertEqual(set(data['credentials']['rfid']['1']['devices']), {'door'})
+
+    def test_conditional_request(self):
+        etag = self.client.get('/luacs/api/terminals/snapshot/')['ETag']
+        response = self.client.get('/luacs/api/terminals/snapshot/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.laser_permission.withdraw()
+        self.laser_permission.save()
+        response = self.client.get('/luacs/api/terminals/snapshot/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('laser', response.json()['credentials']['rfid']['0']['devices'])
+
+
+class ChangeFeedTest(TestCase):
+    def setUp(self):
+        self.terminal = models.Terminal.objects.create(token='terminal-token')
+        self.other_terminal = models.Terminal.objects.create(token='other-token')
+        self.group = models.PermissionGroup.objects.create(name='Laser')
+        self.other_group = models.PermissionGroup.objects.create(name='Door')
+        models.Device.objects.create(shortname='laser', model_name='Laser',
+                                     required_permission_group=self.group, terminal=self.terminal)
+        models.Device.objects.create(shortname='door', model_name='Door',
+                                     required_permission_group=self.other_group,
+                                     terminal=self.other_terminal)
+        user = User.objects.create(username='jdoe')
+        self.profile = models.Profile.objects.create(user=user, id_type='rfid', id_string='42')
+        self.client.defaults['HTTP_AUTHORIZATION'] = 'Token terminal-token'
+
+    def changes(self, since):
+        return self.client.get('/luacs/api/changes/', {'since': since})
+
+    def test_relevant_changes(self):
+        since = self.changes(0).json()['last_seq']
+        permission = models.Permission.objects.create(
+            granted_to=self.profile, permission_group=self.group)
+        models.Permission.objects.create(granted_to=self.profile,
+                                         permission_group=self.other_group)
+        self.profile.id_string = '43'
+        self.profile.save()
+        permission.withdraw()
+        permission.save()
+
+        data = self.changes(since).json()
+        self.assertEqual(
+            [(c['model'], c['action']) for c in data['changes']],
+            [('permission', 'created'), ('profile', 'updated'), ('permission', 'withdrawn')])
+        self.assertEqual(data['last_seq'], models.Change.objects.latest('seq').seq)
+        self.assertEqual(self.changes(data['last_seq']).json()['changes'], [])
+
+    def test_moved_device(self):
+        since = self.changes(0).json()['last_seq']
+        device = models.Device.objects.get(pk='laser')
+        device.terminal = self.other_terminal
+        device.save()
+        changes = self.changes(since).json()['changes']
+        self.assertEqual([(c['model'], c['object_id']) for c in changes], [('device', 'laser')])
+
+    def test_resync_after_pruning(self):
+        models.Change.objects.update(timestamp=timezone.now() - timedelta(days=60))
+        models.Terminal.objects.create(token='new-token')
+        call_command('prune_changes', days=30, stdout=StringIO())
+        response = self.changes(0)
+        self.assertEqual(response.status_code, 410)
+        self.assertTrue(response.json()['resync'])
+
+    @skipIf(connection.vendor != 'postgresql', 'Change log inserts are locked on PostgreSQL')
+    def test_inserts_serialized(self):
+        with transaction.atomic():
+            models.Terminal.objects.create(token='new-token')
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT mode FROM pg_locks WHERE pid = pg_backend_pid() AND '
+                               'granted AND relation = %s::regclass',
+                               [models.Change._meta.db_table])
+                modes = {mode for mode, in cursor.fetchall()}
+        # Held until the transaction ends
+        self.assertIn('ExclusiveLock', modes)
+
+    def stream(self, **headers):
+        response = self.client.get('/luacs/api/changes/stream/', HTTP_ACCEPT='text/event-stream',
+                                   **headers)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = []
+        for block in b''.join(response.streaming_content).decode().split('\n\n'):
+            fields = dict(line.split(': ', 1) for line in block.splitlines()
+                          if not line.startswith(':'))
+            if 'data' in fields:
+                events.append((fields.get('event'), fields.get('id'), json.loads(fields['data'])))
+        return events
+
+    @override_settings(LUACS_STREAM_TIMEOUT=0, LUACS_STREAM_POLL_INTERVAL=0)
+    def test_stream(self):
+        # Without Last-Event-ID, only changes after connecting are sent
+        self.assertEqual(self.stream(), [])
+        since = self.changes(0).json()['last_seq']
+        permission = models.Permission.objects.create(
+            granted_to=self.profile, permission_group=self.group)
+        models.Permission.objects.create(granted_to=self.profile,
+                                         permission_group=self.other_group)
+        models.DeviceStatus.objects.create(device_id='laser', start_time=timezone.now(),
+                                           in_operation=True, authorization=permission)
+
+        events = self.stream(HTTP_LAST_EVENT_ID=str(since))
+        self.assertEqual([(e[0], e[2]['model'], e[2]['action']) for e in events],
+                         [('change', 'permission', 'created'),
+                          ('change', 'devicestatus', 'created')])
+        self.assertEqual([int(e[1]) for e in events], [e[2]['seq'] for e in events])
+        # Resumes after the last received event
+        self.assertEqual(self.stream(HTTP_LAST_EVENT_ID=events[0][1])[0][1], events[1][1])
+        self.assertEqual(self.stream(HTTP_LAST_EVENT_ID=events[1][1]), [])
+
+    def test_stream_deadline(self):
+        models.Permission.objects.create(granted_to=self.profile, permission_group=self.group)
+        # Full batches are pending, the stream still ends at its deadline
+        stream = list(events.change_events(models.Change.objects.all(), 0, timeout=0, interval=0,
+                                           batch_size=1))
+        self.assertEqual(len(stream), 2)
+        self.assertTrue(stream[0].startswith('retry: '))
+
+    @override_settings(LUACS_STREAM_TIMEOUT=0, LUACS_STREAM_POLL_INTERVAL=0)
+    def test_stream_resync_after_pruning(self):
+        models.Change.objects.update(timestamp=timezone.now() - timedelta(days=60))
+        models.Terminal.objects.create(token='new-token')
+        call_command('prune_changes', days=30, stdout=StringIO())
+        self.assertEqual(self.stream(HTTP_LAST_EVENT_ID='0'), [('resync', None, {'resync': True})])
+
+
+class DeviceStatusBatchTest(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        terminal = models.Terminal.objects.create(token='terminal-token')
+        group = models.PermissionGroup.objects.create(name='Laser')
+        self.device = models.Device.objects.create(
+            shortname='laser', model_name='Laser', required_permission_group=group,
+            terminal=terminal)
+        models.Device.objects.create(shortname='door', model_name='Door')
+        user = User.objects.create(username='jdoe')
+        profile = models.Profile.objects.create(user=user, id_type='rfid', id_string='42')
+        self.permission = models.Permission.objects.create(
+            granted_to=profile, permission_group=group)
+        self.first = models.DeviceStatus.objects.create(
+            device=self.device, start_time=self.now - timedelta(hours=1), in_operation=False)
+        self.client.defaults['HTTP_AUTHORIZATION'] = 'Token terminal-token'
+
+    def event(self, event_id, minutes, device='laser', **kwargs):
+        data = {'event_id': event_id, 'device': device, 'in_operation': True,
+                'start_time': (self.now + timedelta(minutes=minutes)).isoformat()}
+        data.update(kwargs)
+        return data
+
+    def post(self, events):
+        return self.client.post('/luacs/api/devices_status/batch/', json.dumps(events),
+                                content_type='application/json')
+
+    def test_batch(self):
+        events = [self.event('b', 2, authorization=self.permission.pk),
+                  self.event('a', 1, in_operation=False),
+                  self.event('c', 3, device='door'),
+                  self.event('d', -120),
+                  self.event('e', 4, authorization=12345),
+                  {'event_id': 'f'}]
+        results = self.post(events).json()['results']
+        self.assertEqual([r['status'] for r in results],
+                         ['created', 'created', 'rejected', 'rejected', 'rejected', 'rejected'])
+
+        statuses = list(self.device.status_history.order_by('start_time'))
+        self.assertEqual([s.event_id for s in statuses], [None, 'a', 'b'])
+        self.assertEqual([s.end_time for s in statuses],
+                         [statuses[1].start_time, statuses[2].start_time, None])
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.current_status, statuses[2])
+        self.assertEqual(self.device.authorization, self.permission)
+
+        # Resubmission is idempotent
+        results = self.post(events[:2]).json()['results']
+        self.assertEqual([r['status'] for r in results], ['duplicate', 'duplicate'])
+        self.assertEqual(self.device.status_history.count(), 3)
+
+    def test_constant_queries(self):
+        events = [self.event(str(i), i) for i in range(50)]
+        # Terminal (cached afterwards), devices, existing events, locking, closing the current
+        # status, insert, newest status, device pointer and change log (plus savepoint handling)
+        with self.assertNumQueries(11):
+            self.post(events)
+        self.assertEqual(self.device.status_history.count(), 51)
+
+
+class TerminalAuthenticationCacheTest(TestCase):
+    def setUp(self):
+        self.terminal = models.Terminal.objects.create(token='terminal-token')
+        models.Device.objects.create(shortname='laser', model_name='Laser', terminal=self.terminal)
+        self.client.defaults['HTTP_AUTHORIZATION'] = 'Token terminal-token'
+
+    def test_cached_authentication(self):
+        self.client.get('/luacs/api/devices/laser/')
+        # Authentication and the device document are served from the caches
+        with self.assertNumQueries(0):
+            response = self.client.get('/luacs/api/devices/laser/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(permissions.terminal_cache.get('terminal-token'), self.terminal.pk)
+
+    def test_invalidation(self):
+        self.client.get('/luacs/api/terminals/myself/')
+        self.terminal.token = 'new-token'
+        self.terminal.save()
+        self.assertEqual(self.client.get('/luacs/api/terminals/myself/').status_code, 403)
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        metrics.registry.clear()
+        models.Terminal.objects.create(token='terminal-token')
+
+    def test_request_metrics(self):
+        self.client.get('/luacs/api/terminals/myself/', HTTP_AUTHORIZATION='Token terminal-token')
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.force_login(admin)
+        response = self.client.get('/luacs/metrics')
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertIn('luacs_request_queries_count{view="TerminalViewSet.myself"} 1', text)
+        self.assertIn(
+            'luacs_request_queries_bucket{view="TerminalViewSet.myself",le="5"} 1', text)
+        self.assertIn('luacs_response_size_bytes_sum{view="TerminalViewSet.myself"}', text)
+
+    def test_query_budget(self):
+        with self.settings(LUACS_QUERY_BUDGET=0), \
+                self.assertLogs('luacs_backend.metrics', 'WARNING') as logs:
+            self.client.get('/luacs/api/terminals/myself/',
+                            HTTP_AUTHORIZATION='Token terminal-token')
+        self.assertIn('luacs_backend_terminal', logs.output[0])
+
+    def test_full_query_log(self):
+        # Only the newest queries are kept, the count must not depend on that
+        queries_log = connection.queries_log
+        self.addCleanup(setattr, connection, 'queries_log', queries_log)
+        connection.queries_log = metrics.QueryLog(maxlen=1)
+        with self.settings(LUACS_QUERY_BUDGET=0), \
+                self.assertLogs('luacs_backend.metrics', 'WARNING') as logs:
+            self.client.get('/luacs/api/terminals/myself/',
+                            HTTP_AUTHORIZATION='Token terminal-token')
+        # Terminal, its devices and the newest change
+        self.assertIn('ran 3 queries', logs.output[0])
+        self.assertEqual(len(logs.output[0].splitlines()), 2)
+        self.assertIn(
+            'luacs_request_queries_sum{view="TerminalViewSet.myself"} 3', metrics.registry.render())
+
+    def test_streaming_response(self):
+        device = models.Device.objects.create(shortname='laser', model_name='Laser')
+        models.DeviceStatus.objects.create(device=device, start_time=timezone.now(),
+                                           in_operation=False)
+        response = self.client.get('/luacs/api/devices_status/export/',
+                                   HTTP_AUTHORIZATION='Token terminal-token')
+        self.assertNotIn('DeviceStatusViewSet.export', metrics.registry.render())
+        size = len(b''.join(response.streaming_content))
+        text = metrics.registry.render()
+        self.assertIn('luacs_response_size_bytes_sum{view="DeviceStatusViewSet.export"} '
+                      + str(size), text)
+        self.assertNotIn('luacs_request_queries_bucket{view="DeviceStatusViewSet.export",le="0"} 1',
+                         text)
+
+    def test_admin_only(self):
+        response = self.client.get('/luacs/metrics')
+        self.assertEqual(response.status_code, 302)
+
+
+class BenchmarkCommandTest(TestCase):
+    @override_settings(LUACS_QUERY_BUDGET=None)
+    def test_generate_and_benchmark(self):
+        call_command('generate_testdata', profiles=20, groups=3, terminals=2,
+                     devices_per_terminal=2, years=0.02, stdout=StringIO())
+        self.assertEqual(models.Device.objects.count(), 4)
+        self.assertTrue(models.DeviceStatus.objects.exists())
+
+        output = StringIO()
+        call_command('benchmark', iterations=2, host='testserver', stdout=output,
+                     stderr=StringIO())
+        results = json.loads(output.getvalue())
+        self.assertEqual(results['meta']['profiles'], 20)
+        self.assertEqual(results['results']['authorize']['queries'], 3)
+        self.assertGreater(results['formats']['snapshot']['json']['bytes'], 0)
+
+    def test_generated_expiry(self):
+        call_command('generate_testdata', profiles=30, groups=3, terminals=1,
+                     devices_per_terminal=1, years=0.5, sessions_per_day=1, stdout=StringIO())
+        permissions = models.Permission.objects.with_validity()
+        self.assertTrue(permissions.exclude(effective_expiry=models.TZ_MAX).exists())
+        for permission in permissions:
+            self.assertEqual(permission.effective_expiry, permission.valid_until)
+
+
+class DeviceStatusExportTest(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        models.Terminal.objects.create(token='terminal-token')
+        group = models.PermissionGroup.objects.create(name='Laser')
+        user = User.objects.create(username='jdoe')
+        profile = models.Profile.objects.create(user=user, id_type='rfid', id_string='42')
+        self.permission = models.Permission.objects.create(
+            granted_to=profile, permission_group=group)
+        for shortname in ('laser', 'door'):
+            device = models.Device.objects.create(shortname=shortname, model_name=shortname)
+            for minutes in range(15):
+                models.DeviceStatus.objects.create(
+                    device=device, start_time=self.now - timedelta(minutes=minutes),
+                    in_operation=False, authorization=self.permission if minutes < 5 else None)
+        self.client.defaults['HTTP_AUTHORIZATION'] = 'Token terminal-token'
+
+    def test_cursor_pagination(self):
+        url = '/luacs/api/devices_status/?device=laser'
+        start_times = []
+        while url:
+            data = self.client.get(url).json()
+            start_times += [s['start_time'] for s in data['results']]
+            url = data['next']
+        self.assertEqual(len(start_times), 15)
+        self.assertEqual(start_times, sorted(start_times, reverse=True))
+
+    def test_ndjson_export(self):
+        response = self.client.get('/luacs/api/devices_status/export/',
+                                   {'device': 'laser', 'user': self.permission.granted_to_id})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in
+                b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[-1]['end_time'], None)
+        self.assertEqual({r['user'] for r in rows}, {self.permission.granted_to_id})
+
+    def test_csv_export(self):
+        response = self.client.get('/luacs/api/devices_status/export/', {
+            'output': 'csv', 'start': (self.now - timedelta(minutes=2, seconds=30)).isoformat()})
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0].split(','), ['id', 'device', 'start_time', 'end_time',
+                                               'in_operation', 'authorization', 'user',
+                                               'change_reason'])
+        # Four statuses per device overlap the last two and a half minutes
+        self.assertEqual(len(lines), 1 + 2 * 4)
+
+    def test_invalid_user(self):
+        for url in ('/luacs/api/devices_status/', '/luacs/api/devices_status/export/'):
+            response = self.client.get(url, {'user': 'abc'})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('user', response.json())
+
+
+class UsageRollupTest(TestCase):
+    def setUp(self):
+        self.base = timezone.now().replace(hour=10, minute=0, second=0, microsecond=0,
+                                           tzinfo=timezone.utc) - timedelta(days=1)
+        models.Terminal.objects.create(token='terminal-token')
+        self.group = models.PermissionGroup.objects.create(name='Laser')
+        user = User.objects.create(username='jdoe')
+        profile = models.Profile.objects.create(user=user, id_type='rfid', id_string='42')
+        permission = models.Permission.objects.create(granted_to=profile,
+                                                      permission_group=self.group)
+        device = models.Device.objects.create(shortname='laser', model_name='Laser',
+                                              required_permission_group=self.group)
+        for minutes, in_operation, authorization in ((30, False, permission),
+                                                     (45, True, permission),
+                                                     (75, False, None),
+                                                     (120, False, permission)):
+            models.DeviceStatus.objects.create(
+                device=device, start_time=self.base + timedelta(minutes=minutes),
+                in_operation=in_operation, authorization=authorization)
+        self.client.defaults['HTTP_AUTHORIZATION'] = 'Token terminal-token'
+
+    def rollups(self, period):
+        return list(models.UsageRollup.objects.filter(period=period).order_by('bucket').values_list(
+            'bucket', 'usage_minutes', 'operated_minutes', 'sessions'))
+
+    def assertRolledUp(self):
+        hour = timedelta(hours=1)
+        self.assertEqual(self.rollups(models.UsageRollup.HOUR), [
+            (self.base, 30, 15, 1),
+            (self.base + hour, 15, 15, 0),
+            (self.base + 2 * hour, 30, 0, 1),
+        ])
+        self.assertEqual(self.rollups(models.UsageRollup.DAY), [
+            (self.base.replace(hour=0), 75, 30, 2)])
+
+    def test_catch_up(self):
+        until = self.base + timedelta(minutes=150)
+        self.assertEqual(rollups.catch_up(until), until)
+        self.assertRolledUp()
+        # Nothing left to do
+        self.assertEqual(rollups.catch_up(until), until)
+        self.assertRolledUp()
+
+    def test_catch_up_resumes_from_watermark(self):
+        rollups.catch_up(self.base + timedelta(minutes=50), chunk=timedelta(minutes=7))
+        self.assertEqual(rollups.watermark(), self.base + timedelta(minutes=50))
+        rollups.catch_up(self.base + timedelta(minutes=120), chunk=timedelta(minutes=13))
+        rollups.catch_up(self.base + timedelta(minutes=150))
+        self.assertRolledUp()
+
+    def test_rebuild(self):
+        rollups.catch_up(self.base + timedelta(minutes=150))
+        models.UsageRollup.objects.update(sessions=0)
+        rollups.rebuild(self.base + timedelta(minutes=150))
+        self.assertRolledUp()
+
+    def test_command(self):
+        out = StringIO()
+        call_command('rollup_usage', stdout=out)
+        self.assertIn('rolled up until', out.getvalue())
+        # The open status is rolled up until (about) now
+        self.assertGreater(models.UsageRollup.objects.filter(
+            period=models.UsageRollup.DAY).count(), 1)
+
+    def test_api(self):
+        rollups.catch_up(self.base + timedelta(minutes=150))
+        data = self.client.get('/luacs/api/usage/', {'period': 'hour', 'device': 'laser'}).json()
+        self.assertEqual([r['usage_minutes'] for r in data['results']], [30, 15, 30])
+        self.assertEqual(self.client.get('/luacs/api/usage/', {'period': 'week'}).status_code,
+                         400)
+        self.assertEqual(self.client.get('/luacs/api/usage/', {'permission_group': 'abc'})
+                         .status_code, 400)
+
+        with self.assertNumQueries(2):
+            # Watermark and totals
+            data = self.client.get('/luacs/api/usage/summary/', {
+                'period': 'hour', 'start': self.base.isoformat()}).json()
+        self.assertEqual(len(data['results']), 1)
+        result = data['results'][0]
+        self.assertEqual(result['device'], 'laser')
+        self.assertEqual((result['usage_minutes'], result['operated_minutes'],
+                          result['sessions']), (75, 30, 2))
+        self.assertAlmostEqual(result['utilization'], 75 / 150)
+
+        data = self.client.get('/luacs/api/usage/summary/', {
+            'group_by': 'permission_group', 'start': self.base.replace(hour=0).isoformat()}).json()
+        self.assertEqual(data['results'], [{'permission_group': self.group.pk,
+                                            'usage_minutes': 75, 'operated_minutes': 30,
+                                            'sessions': 2}])
+
+
+@override_settings(LUACS_QUERY_BUDGET=None)
+class AdminChangelistTest(TestCase):
+    def setUp(self):
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.force_login(admin)
+        self.now = timezone.now()
+
+    def add_rows(self, count):
+        '''Adds count rows to every changelist'''
+        for i in range(count):
+            n = models.Terminal.objects.count()
+            terminal = models.Terminal.objects.create(token='token-{}'.format(n))
+            group = models.PermissionGroup.objects.create(name='Group {}'.format(n))
+            user = User.objects.create(username='user-{}'.format(n), last_name=str(n))
+            profile = models.Profile.objects.create(user=user, id_type='rfid', id_string=str(n))
+            permission = models.Permission.objects.create(granted_to=profile,
+                                                          permission_group=group)
+            device = models.Device.objects.create(
+                shortname='device-{}'.format(n), model_name='Model', terminal=terminal,
+                required_permission_group=group)
+            models.DeviceStatus.objects.create(device=device, start_time=self.now,
+                                               in_operation=True, authorization=permission)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(captured)
+
+    def test_queries_independent_of_rows(self):
+        urls = ['/admin/luacs_backend/{}/'.format(model) for model in (
+            'permissiongroup', 'permission', 'profile', 'device', 'terminal', 'devicestatus')]
+        # Sorted by the annotated columns
+        urls += ['/admin/luacs_backend/permissiongroup/?o=3',
+                 '/admin/luacs_backend/terminal/?o=3',
+                 '/admin/luacs_backend/devicestatus/?o=5']
+        urls.append('/admin/luacs_backend/devicestatus/?' + urlencode({
+            'start_time__gte': self.now.replace(hour=0, minute=0, second=0).isoformat()}))
+        self.add_rows(1)
+        few = {url: self.count_queries(url) for url in urls}
+        self.add_rows(5)
+        many = {url: self.count_queries(url) for url in urls}
+        self.assertEqual(few, many)
+
+
+class CompactRepresentationTest(TestCase):
+    def setUp(self):
+        terminal = models.Terminal.objects.create(token='terminal-token')
+        self.group = models.PermissionGroup.objects.create(name='Laser')
+        user = User.objects.create(username='jdoe')
+        self.profile = models.Profile.objects.create(user=user, id_type='rfid', id_string='42')
+        self.permission = models.Permission.objects.create(granted_to=self.profile,
+                                                           permission_group=self.group)
+        self.device = models.Device.objects.create(
+            shortname='laser', model_name='Laser', terminal=terminal,
+            required_permission_group=self.group, automatic_logout=timedelta(minutes=5))
+        models.DeviceStatus.objects.create(device=self.device, start_time=timezone.now(),
+                                           in_operation=True, authorization=self.permission)
+        self.client.defaults['HTTP_AUTHORIZATION'] = 'Token terminal-token'
+
+    def test_device(self):
+        self.client.get('/luacs/api/terminals/myself/')
+        with self.assertNumQueries(4):
+            # Device with current status and group, valid permissions, change log (ETag) and the
+            # first expiry (timeout of the cached document)
+            data = self.client.get('/luacs/api/devices/laser/',
+                                   HTTP_ACCEPT='application/json; version=2').json()
+        self.assertEqual(data['terminal'], self.device.terminal_id)
+        self.assertEqual(data['automatic_logout'], 300)
+        self.assertEqual(data['required_permission_group'], self.group.pk)
+        self.assertEqual(data['in_operation'], True)
+        self.assertEqual(data['authorization'], self.permission.pk)
+        self.assertEqual([row[:2] for row in data['valid_permissions']],
+                         [[self.permission.pk, self.profile.pk]])
+        self.assertNotIn('url', data)
+
+    def test_query_parameter(self):
+        data = self.client.get('/luacs/api/terminals/myself/', {'version': '2'}).json()
+        self.assertEqual(data['devices'], ['laser'])
+        data = self.client.get('/luacs/api/permissions/', {'version': '2'}).json()
+        self.assertEqual(data['results'][0]['granted_to'], self.profile.pk)
+
+    def test_hyperlinked_by_default(self):
+        data = self.client.get('/luacs/api/terminals/myself/').json()
+        self.assertEqual(data['devices'], ['http://testserver/luacs/api/devices/laser/'])
+
+    def test_unknown_version(self):
+        self.assertEqual(self.client.get('/luacs/api/devices/', {'version': '3'}).status_code,
+                         404)
+        self.assertEqual(self.client.get('/luacs/api/devices/',
+                                         HTTP_ACCEPT='application/json; version=3').status_code,
+                         406)
+
+    def test_create_status(self):
+        response = self.client.post('/luacs/api/devices_status/?version=2', {
+            'device': 'laser', 'start_time': timezone.now().isoformat(), 'in_operation': False})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['device'], 'laser')
+
+
+@skipIf(msgpack is None, 'msgpack is not installed')
+class MessagePackTest(TestCase):
+    def setUp(self):
+        terminal = models.Terminal.objects.create(token='terminal-token')
+        group = models.PermissionGroup.objects.create(name='Laser')
+        user = User.objects.create(username='jdoe')
+        models.Profile.objects.create(user=user, id_type='rfid', id_string='42')
+        models.Device.objects.create(shortname='laser', model_name='Laser', terminal=terminal,
+                                     required_permission_group=group,
+                                     automatic_logout=timedelta(minutes=5))
+        self.client.defaults['HTTP_AUTHORIZATION'] = 'Token terminal-token'
+
+    def test_render(self):
+        response = self.client.get('/luacs/api/devices/laser/',
+                                   HTTP_ACCEPT='application/msgpack; version=2')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        data = msgpack.unpackb(response.content, raw=False)
+        self.assertEqual(data['automatic_logout'], 300)
+        self.assertEqual(data['valid_permissions'], [])
+
+    def test_parse(self):
+        response = self.client.post(
+            '/luacs/api/authorize/', msgpack.packb({'device': 'laser', 'id_type': 'rfid',
+                                                    'id_string': '42'}),
+            content_type='application/msgpack', HTTP_ACCEPT='application/msgpack')
+        data = msgpack.unpackb(response.content, raw=False)
+        self.assertEqual(data['reason'], 'no valid permission')
+
+    def test_parse_error(self):
+        response = self.client.post('/luacs/api/authorize/', b'\xc1',
+                                    content_type='application/msgpack')
+        self.assertEqual(response.status_code, 400)
+
+
+class ConditionalRequestTest(TestCase):
+    def setUp(self):
+        self.terminal = models.Terminal.objects.create(token='terminal-token')
+        self.group = models.PermissionGroup.objects.create(name='Laser', max_unused_days=None)
+        user = User.objects.create(username='jdoe')
+        self.profile = models.Profile.objects.create(user=user, id_type='rfid', id_string='42')
+        self.permission = models.Permission.objects.create(granted_to=self.profile,
+                                                           permission_group=self.group)
+        self.device = models.Device.objects.create(
+            shortname='laser', model_name='Laser', terminal=self.terminal,
+            required_permission_group=self.group)
+        self.client.defaults['HTTP_AUTHORIZATION'] = 'Token terminal-token'
+
+    def assertNotModified(self, url, **headers):
+        response = self.client.get(url, **headers)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag, **headers)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        return etag
+
+    def assertModified(self, url, etag, **headers):
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag, **headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_device(self):
+        url = '/luacs/api/devices/laser/'
+        etag = self.assertNotModified(url)
+        with self.assertNumQueries(0):
+            # Served from the document cache
+            self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        # Each representation has its own ETag
+        self.assertModified(url, etag, HTTP_ACCEPT='application/json; version=2')
+
+        models.DeviceStatus.objects.create(device=self.device, start_time=timezone.now(),
+                                           in_operation=True, authorization=self.permission)
+        self.assertModified(url, etag)
+        etag = self.assertNotModified(url)
+
+        models.Permission.objects.filter(pk=self.permission.pk).update(
+            effective_expiry=timezone.now() - timedelta(seconds=1))
+        # Expired without a logged change, queryset updates invalidate cached documents themselves
+        documents.invalidate_groups([self.group.pk])
+        self.assertModified(url, etag)
+
+    def test_terminal(self):
+        url = '/luacs/api/terminals/myself/'
+        etag = self.assertNotModified(url)
+        with self.assertNumQueries(0):
+            # Served from the document cache
+            self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        models.Device.objects.create(shortname='door', model_name='Door', terminal=self.terminal)
+        self.assertModified(url, etag)
+
+    def test_permission(self):
+        url = '/luacs/api/permissions/{}/'.format(self.permission.pk)
+        etag = self.assertNotModified(url)
+        self.group.max_unused_days = 30
+        self.group.save()
+        self.assertModified(url, etag)
+
+
+class DocumentCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.registry.clear()
+        self.terminal = models.Terminal.objects.create(token='terminal-token')
+        self.group = models.PermissionGroup.objects.create(name='Laser', max_unused_days=None)
+        user = User.objects.create(username='jdoe')
+        self.profile = models.Profile.objects.create(user=user, id_type='rfid', id_string='42')
+        self.device = models.Device.objects.create(
+            shortname='laser', model_name='Laser', terminal=self.terminal,
+            required_permission_group=self.group)
+        self.client.defaults['HTTP_AUTHORIZATION'] = 'Token terminal-token'
+
+    def get_device(self, **headers):
+        return self.client.get('/luacs/api/devices/laser/', **headers).json()
+
+    def test_hit(self):
+        data = self.get_device()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_device(), data)
+        # Each version and host has its own document
+        compact = self.get_device(HTTP_ACCEPT='application/json; version=2')
+        self.assertEqual(compact['terminal'], self.terminal.pk)
+        other = self.get_device(HTTP_HOST='testserver:8000')
+        self.assertEqual(other['url'], 'http://testserver:8000/luacs/api/devices/laser/')
+
+        text = metrics.registry.render()
+        self.assertIn('luacs_document_cache_total{document="device",result="hit"} 1', text)
+        self.assertIn('luacs_document_cache_total{document="device",result="miss"} 3', text)
+
+    def test_invalidation(self):
+        self.get_device()
+        self.device.model_name = 'Laser cutter'
+        self.device.save()
+        self.assertEqual(self.get_device()['model_name'], 'Laser cutter')
+
+        permission = models.Permission.objects.create(
+            granted_to=self.profile, permission_group=self.group,
+            granted_until=timezone.now() + timedelta(days=365))
+        self.assertEqual(len(self.get_device()['valid_permissions']), 1)
+
+        models.DeviceStatus.objects.create(device=self.device, start_time=timezone.now(),
+                                           in_operation=True, authorization=permission)
+        self.assertTrue(self.get_device()['in_operation'])
+
+        valid_until = self.get_device()['valid_permissions'][0]['valid_until']
+        self.group.max_unused_days = 30
+        self.group.save()
+        self.assertLess(self.get_device()['valid_permissions'][0]['valid_until'], valid_until)
+
+        permission.delete()
+        self.assertEqual(self.get_device()['valid_permissions'], [])
+
+        self.group.delete()
+        self.assertIsNone(self.get_device()['required_permission_group'])
+
+    def test_batch_invalidation(self):
+        self.get_device()
+        self.client.post('/luacs/api/devices_status/batch/', json.dumps([{
+            'event_id': 'a', 'device': 'laser', 'in_operation': True,
+            'start_time': timezone.now().isoformat()}]), content_type='application/json')
+        self.assertTrue(self.get_device()['in_operation'])
+
+    def test_terminal(self):
+        url = '/luacs/api/terminals/myself/'
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            self.assertEqual(len(self.client.get(url).json()['devices']), 1)
+        other = models.Terminal.objects.create(token='other-token')
+        self.device.terminal = other
+        self.device.save()
+        self.assertEqual(self.client.get(url).json()['devices'], [])
+        self.assertEqual(len(self.client.get('/luacs/api/terminals/{}/'.format(other.pk))
+                             .json()['devices']), 1)
+
+    def test_timeout(self):
+        models.Permission.objects.create(granted_to=self.profile, permission_group=self.group,
+                                         granted_until=timezone.now() + timedelta(seconds=60))
+        # Documents expire with their first permission
+        timeout = apiviews.DeviceViewSet(request=None).get_document_timeout(self.device)
+        self.assertTrue(0 < timeout <= 60)
+        with self.settings(LUACS_DOCUMENT_CACHE_TIMEOUT=0):
+            self.get_device()
+            self.get_device()
+        self.assertIn('luacs_document_cache_total{document="device",result="miss"} 2',
+                      metrics.registry.render())
+
+
+class DocumentCacheTransactionTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        models.Terminal.objects.create(token='terminal-token')
+        self.device = models.Device.objects.create(shortname='laser', model_name='Laser')
+        self.client.defaults['HTTP_AUTHORIZATION'] = 'Token terminal-token'
+
+    def get_device(self):
+        return self.client.get('/luacs/api/devices/laser/').json()
+
+    def test_invalidated_on_commit(self):
+        self.get_device()
+        with transaction.atomic():
+            self.device.model_name = 'Laser cutter'
+            self.device.save()
+            # Another request caching the document before the commit
+            version = documents.get(documents.DEVICE, 'laser', 'variant')[0]
+            documents.store(documents.DEVICE, 'laser', version, 'variant', 'stale')
+        self.assertEqual(documents.get(documents.DEVICE, 'laser', 'variant')[1], None)
+        self.assertEqual(self.get_device()['model_name'], 'Laser cutter')
+
+    def test_variants(self):
+        version = documents.get(documents.DEVICE, 'laser', 'a')[0]
+        documents.store(documents.DEVICE, 'laser', version, 'a', 1)
+        documents.store(documents.DEVICE, 'laser', version, 'b', 2)
+        self.assertEqual(documents.get(documents.DEVICE, 'laser', 'a'), (version, 1))
+        self.assertEqual(documents.get(documents.DEVICE, 'laser', 'b'), (version, 2))
+        # Values read before an invalidation are not cached
+        documents.invalidate(documents.DEVICE, ['laser'])
+        documents.store(documents.DEVICE, 'laser', version, 'a', 1)
+        self.assertEqual(documents.get(documents.DEVICE, 'laser', 'a')[1], None)
+
+
+class ExpansionTest(TestCase):
+    def setUp(self):
+        self.terminal = models.Terminal.objects.create(token='terminal-token')
+        self.group = models.PermissionGroup.objects.create(name='Laser')
+        for i in range(3):
+            user = User.objects.create(username='user{}'.format(i))
+            profile = models.Profile.objects.create(user=user, id_type='rfid', id_string=str(i))
+            models.Permission.objects.create(granted_to=profile, permission_group=self.group)
+        for name in ('laser', 'cutter', 'door'):
+            models.Device.objects.create(
+                shortname=name, model_name=name.title(), terminal=self.terminal,
+                required_permission_group=self.group if name != 'door' else None)
+        self.client.defaults['HTTP_AUTHORIZATION'] = 'Token terminal-token'
+
+    def test_terminal_devices(self):
+        url = '/luacs/api/terminals/myself/?expand=devices'
+        self.client.get(url)
+        # Devices with their status and group, valid permissions of the groups
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        self.assertNotIn('ETag', response)
+        devices = response.json()['devices']
+        self.assertEqual([d['shortname'] for d in devices], ['cutter', 'door', 'laser'])
+        self.assertEqual([len(d['valid_permissions']) for d in devices], [3, 0, 3])
+        # Embedded objects are not expanded any further
+        self.assertEqual(devices[0]['required_permission_group'],
+                         'http://testserver/luacs/api/permission_groups/{}/'.format(self.group.pk))
+
+        with self.assertNumQueries(2):
+            compact = self.client.get(url, HTTP_ACCEPT='application/json; version=2').json()
+        self.assertEqual(compact['devices'][2]['valid_permissions'],
+                         self.client.get('/luacs/api/devices/laser/?version=2').json()[
+                             'valid_permissions'])
+
+        # Not expanded
+        self.assertEqual(len(self.client.get('/luacs/api/terminals/myself/').json()['devices']), 3)
+
+    def test_permission_group_devices(self):
+        url = '/luacs/api/permission_groups/{}/?expand=devices'.format(self.group.pk)
+        devices = self.client.get(url).json()['devices']
+        self.assertEqual({d['shortname'] for d in devices}, {'cutter', 'laser'})
+
+    def test_permissions(self):
+        self.client.get('/luacs/api/permissions/')
+        # Permissions, their profiles with users, their groups and the devices of the groups
+        with self.assertNumQueries(4):
+            results = self.client.get('/luacs/api/permissions/?expand=granted_to,permission_group',
+                                      HTTP_ACCEPT='application/json; version=2').json()['results']
+        self.assertEqual([r['granted_to']['username'] for r in results],
+                         ['user0', 'user1', 'user2'])
+        self.assertEqual(sorted(results[0]['permission_group']['devices']), ['cutter', 'laser'])
+
+    def test_unknown_field(self):
+        response = self.client.get('/luacs/api/devices/laser/?expand=terminal')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('required_permission_group', response.json()['expand'])
+
+
+class SparseFieldsetTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.terminal = models.Terminal.objects.create(token='terminal-token')
+        self.group = models.PermissionGroup.objects.create(name='Laser')
+        user = User.objects.create(username='jdoe')
+        self.profile = models.Profile.objects.create(user=user, id_type='rfid', id_string='42')
+        models.Permission.objects.create(granted_to=self.profile, permission_group=self.group)
+        models.Device.objects.create(shortname='laser', model_name='Laser', terminal=self.terminal,
+                                     required_permission_group=self.group)
+        self.client.defaults['HTTP_AUTHORIZATION'] = 'Token terminal-token'
+        self.client.get('/luacs/api/terminals/myself/')
+
+    def test_fields(self):
+        url = '/luacs/api/devices/laser/?fields=shortname,in_operation'
+        # Device and change log (ETag), the permissions are not looked up
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        self.assertEqual(response.json(), {'shortname': 'laser', 'in_operation': False})
+        # Cached separately from the full document, with its own ETag
+        full = self.client.get('/luacs/api/devices/laser/')
+        self.assertIn('valid_permissions', full.json())
+        self.assertNotEqual(full['ETag'], response['ETag'])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code,
+                             304)
+
+    def test_list_prefetch(self):
+        door = models.PermissionGroup.objects.create(name='Door')
+        models.Permission.objects.create(granted_to=self.profile, permission_group=door)
+        for i in range(5):
+            models.Device.objects.create(shortname='device{}'.format(i), model_name='Device',
+                                         required_permission_group=(self.group, door, None)[i % 3])
+        for version in ('1', '2'):
+            # Count, devices and the valid permissions of their groups
+            with self.assertNumQueries(3):
+                results = self.client.get('/luacs/api/devices/', {'version': version}).json()[
+                    'results']
+            self.assertEqual([len(d['valid_permissions']) for d in results], [1, 1, 0, 1, 1, 1])
+            # Not looked up if left out
+            with self.assertNumQueries(2):
+                self.client.get('/luacs/api/devices/', {'version': version,
+                                                        'omit': 'valid_permissions'})
+
+    def test_omit(self):
+        data = self.client.get('/luacs/api/profiles/{}/?omit=email,url,id_string'.format(
+            self.profile.pk)).json()
+        self.assertEqual(sorted(data), ['first_name', 'id', 'id_type', 'is_active', 'last_name',
+                                        'username'])
+        results = self.client.get('/luacs/api/permissions/?omit=granted_until&version=2').json()[
+            'results']
+        self.assertNotIn('granted_until', results[0])
+        self.assertIn('valid_until', results[0])
+
+    def test_expansion(self):
+        url = '/luacs/api/terminals/myself/?expand=devices&fields=id'
+        # Not selected, so neither prefetched nor serialized
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).json(), {'id': self.terminal.pk})
+        devices = self.client.get('/luacs/api/permission_groups/{}/?expand=devices&fields=devices'
+                                  .format(self.group.pk)).json()['devices']
+        self.assertEqual(devices[0]['shortname'], 'laser')
+
+    def test_unknown_field(self):
+        response = self.client.get('/luacs/api/changes/?fields=seq,foo')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('foo', response.json()['fields'])
+
+
+class PermissionExpiryTest(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        models.Terminal.objects.create(token='terminal-token')
+        self.group = models.PermissionGroup.objects.create(name='Laser', max_unused_days=90)
+        self.device = models.Device.objects.create(
+            shortname='laser', model_name='Laser', required_permission_group=self.group)
+        user = User.objects.create(username='jdoe')
+        self.profile = models.Profile.objects.create(user=user, id_type='rfid', id_string='42')
+        # max_unused_days only applies to permissions with granted_until
+        self.until = self.now + timedelta(days=1000)
+        self.permission = models.Permission.objects.create(
+            granted_to=self.profile, permission_group=self.group, granted_until=self.until)
+        self.client.defaults['HTTP_AUTHORIZATION'] = 'Token terminal-token'
+
+    def expiry(self, permission=None):
+        return models.Permission.objects.values_list('effective_expiry', flat=True).get(
+            pk=(permission or self.permission).pk)
+
+    def use(self, days_ago, permission=None):
+        return models.DeviceStatus.objects.create(
+            device=self.device, start_time=self.now - timedelta(days=days_ago), in_operation=True,
+            authorization=permission or self.permission)
+
+    def test_maintained(self):
+        self.assertEqual(self.expiry(), self.permission.granted_on + timedelta(days=90))
+        self.assertEqual(self.expiry(), self.permission.valid_until)
+
+        status = self.use(-1)
+        self.assertEqual(self.expiry(), self.now + timedelta(days=91))
+        models.DeviceStatus.objects.append([models.DeviceStatus(
+            device=self.device, start_time=self.now + timedelta(days=2), in_operation=False,
+            authorization=self.permission)])
+        self.assertEqual(self.expiry(), self.now + timedelta(days=92))
+
+        self.group.max_unused_days = 30
+        self.group.save()
+        self.assertEqual(self.expiry(), self.now + timedelta(days=32))
+
+        self.permission.granted_until = self.now + timedelta(days=10)
+        self.permission.save()
+        self.assertEqual(self.expiry(), self.now + timedelta(days=10))
+
+        self.group.max_unused_days = None
+        self.group.save()
+        self.permission.granted_until = None
+        self.permission.save()
+        self.assertEqual(self.expiry(), models.TZ_MAX)
+
+        # Moving usage to another permission shortens the validity of the previous one
+        self.group.max_unused_days = 90
+        self.group.save()
+        self.permission.granted_until = self.until
+        self.permission.save()
+        other = models.Permission.objects.create(granted_to=self.profile,
+                                                 permission_group=self.group,
+                                                 granted_until=self.until)
+        models.DeviceStatus.objects.filter(start_time__gt=self.now + timedelta(days=1)).delete()
+        status.authorization = other
+        status.save()
+        self.assertEqual(self.expiry(other), self.now + timedelta(days=91))
+        self.assertEqual(self.expiry(), self.permission.granted_on + timedelta(days=90))
+
+    def test_sweep(self):
+        received = []
+
+        def receiver(signal, permissions, **kwargs):
+            received.append((signal, sorted(p.pk for p in permissions)))
+        expiry.permissions_expiring.connect(receiver)
+        expiry.permissions_expired.connect(receiver)
+        self.addCleanup(expiry.permissions_expiring.disconnect, receiver)
+        self.addCleanup(expiry.permissions_expired.disconnect, receiver)
+
+        # Expires in 90 days
+        self.assertEqual(expiry.sweep(self.now, notice=timedelta(days=14)), (0, 0))
+        self.assertEqual(expiry.sweep(self.now + timedelta(days=80)), (1, 0))
+        self.assertEqual(received, [(expiry.permissions_expiring, [self.permission.pk])])
+        # Not notified twice
+        self.assertEqual(expiry.sweep(self.now + timedelta(days=85)), (0, 0))
+
+        # Changes made without recomputing the stored expiry are picked up, the new expiry is
+        # notified again
+        models.Permission.objects.filter(pk=self.permission.pk).update(
+            granted_on=self.now + timedelta(days=10))
+        self.assertEqual(expiry.sweep(self.now + timedelta(days=91)), (1, 0))
+        self.assertEqual(self.expiry(), self.now + timedelta(days=100))
+        self.assertEqual(expiry.sweep(self.now + timedelta(days=101)), (0, 1))
+        self.assertEqual(received[-1], (expiry.permissions_expired, [self.permission.pk]))
+
+    def test_endpoints(self):
+        soon = models.Permission.objects.create(
+            granted_to=self.profile, permission_group=self.group,
+            granted_until=self.now + timedelta(days=5))
+        withdrawn = models.Permission.objects.create(
+            granted_to=self.profile, permission_group=self.group)
+        withdrawn.withdraw()
+        withdrawn.save()
+        lapsed = models.Permission.objects.create(granted_to=self.profile,
+                                                  permission_group=self.group,
+                                                  granted_until=self.until)
+        models.Permission.objects.filter(pk=lapsed.pk).update(
+            granted_on=self.now - timedelta(days=100))
+        models.Permission.objects.filter(pk=lapsed.pk).refresh_expiry()
+
+        def ids(path, **params):
+            response = self.client.get('/luacs/api/permissions/{}/'.format(path), params,
+                                       HTTP_ACCEPT='application/json; version=2')
+            self.assertEqual(response.status_code, 200)
+            return [p['id'] for p in response.json()['results']]
+        self.assertEqual(ids('expiring'), [soon.pk])
+        self.assertEqual(ids('expiring', days=100), [self.permission.pk, soon.pk])
+        self.assertEqual(ids('lapsed'), [lapsed.pk])
+        self.assertEqual(ids('lapsed', days=5), [])
+        self.assertEqual(self.client.get('/luacs/api/permissions/expiring/',
+                                         {'days': 'x'}).status_code, 400)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('sweep_expiry', '--rebuild', stdout=out)
+        self.assertIn('Recomputed the expiry of 1 permissions.', out.getvalue())
+        self.assertIn('0 permissions expiring, 0 expired.', out.getvalue())
+
+
+class PermissionFilterTest(TestCase):
+    def setUp(self):
+        models.Terminal.objects.create(token='terminal-token')
+        self.group = models.PermissionGroup.objects.create(name='Laser')
+        other_group = models.PermissionGroup.objects.create(name='Door')
+        models.Device.objects.create(shortname='laser', model_name='Laser',
+                                     required_permission_group=self.group)
+        self.profiles = []
+        for i in range(2):
+            user = User.objects.create(username='user{}'.format(i))
+            self.profiles.append(models.Profile.objects.create(
+                user=user, id_type='rfid', id_string=str(i)))
+        self.permission = models.Permission.objects.create(
+            granted_to=self.profiles[0], permission_group=self.group)
+        models.Permission.objects.create(granted_to=self.profiles[0], permission_group=other_group)
+        models.Permission.objects.create(granted_to=self.profiles[1], permission_group=self.group)
+        expired = models.Permission.objects.create(
+            granted_to=self.profiles[0], permission_group=self.group)
+        expired.withdraw()
+        expired.save()
+        self.client.defaults['HTTP_AUTHORIZATION'] = 'Token terminal-token'
+
+    def ids(self, **params):
+        response = self.client.get('/luacs/api/permissions/', params,
+                                   HTTP_ACCEPT='application/json; version=2')
+        self.assertEqual(response.status_code, 200)
+        return [p['id'] for p in response.json()['results']]
+
+    def test_filters(self):
+        self.assertEqual(len(self.ids()), 3)
+        self.assertEqual(self.ids(granted_to=self.profiles[0].pk, permission_group=self.group.pk),
+                         [self.permission.pk])
+        self.assertEqual(self.ids(granted_to=self.profiles[0].pk, device='laser'),
+                         [self.permission.pk])
+        self.assertEqual(self.ids(device='door'), [])
+        response = self.client.get('/luacs/api/permissions/', {'granted_to': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_expired_permissions_are_filtered_per_request(self):
+        self.assertIn(self.permission.pk, self.ids())
+        models.Permission.objects.filter(pk=self.permission.pk).update(
+            effective_expiry=timezone.now())
+        self.assertNotIn(self.permission.pk, self.ids())
+
+    def index(self, *columns):
+        '''Returns the name of the index on exactly these columns'''
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(
+                cursor, models.Permission._meta.db_table)
+        return next(name for name, c in constraints.items()
+                    if c['index'] and c['columns'] == list(columns))
+
+    def query_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return ' '.join(row[-1] for row in cursor.fetchall())
+
+    @skipIf(connection.vendor != 'sqlite', 'Query plans are checked with SQLite')
+    def test_lookups_use_indexes(self):
+        group_index = self.index('permission_group_id', 'effective_expiry')
+        profile_index = self.index('granted_to_id', 'permission_group_id')
+        valid = models.Permission.objects.valid()
+        self.assertIn(group_index, self.query_plan(valid.filter(permission_group=self.group)))
+        self.assertIn(group_index, self.query_plan(valid.filter(permission_group__devices='laser')))
+        self.assertIn(profile_index, self.query_plan(valid.filter(granted_to=self.profiles[0])))
+        # Either index, depending on the planner's estimates
+        plan = self.query_plan(valid.filter(granted_to=self.profiles[0],
+                                            permission_group=self.group))
+        self.assertTrue(group_index in plan or profile_index in plan, plan)
+        self.assertNotIn('SCAN', plan)
+
+
+@skipIf(connection.vendor != 'sqlite', 'SQLite backend')
+class SQLiteBackendTest(TestCase):
+    def pragma(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA {}'.format(name))
+            return cursor.fetchone()[0]
+
+    def test_pragmas(self):
+        # The in-memory test database has no write-ahead log
+        self.assertEqual(self.pragma('synchronous'), 1)
+        self.assertEqual(self.pragma('cache_size'), -20000)
+
+
+class SharedConnectionExecutor(Executor):
+    '''Runs every job in a new thread, using the test's database connection and transaction'''
+    def submit(self, function, *args, **kwargs):
+        future = Future()
+        shared = connections[DEFAULT_DB_ALIAS]
+
+        def run():
+            connections[DEFAULT_DB_ALIAS] = shared
+            try:
+                future.set_result(function(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+        threading.Thread(target=run).start()
+        return future
+
+
+@override_settings(LUACS_STREAM_TIMEOUT=0, LUACS_STREAM_POLL_INTERVAL=0)
+class ASGITest(TestCase):
+    def setUp(self):
+        terminal = models.Terminal.objects.create(token='terminal-token')
+        self.group = models.PermissionGroup.objects.create(name='Laser')
+        models.Device.objects.create(shortname='laser', model_name='Laser', terminal=terminal,
+                                     required_permission_group=self.group)
+        user = User.objects.create(username='jdoe')
+        self.profile = models.Profile.objects.create(user=user, id_type='rfid', id_string='42')
+        self.handler = ASGIHandler(WSGIHandler(), executor=SharedConnectionExecutor())
+        connection.allow_thread_sharing = True
+        self.addCleanup(setattr, connection, 'allow_thread_sharing', False)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        # Like the test client, keep the test's database connection open
+        for signal in (request_started, request_finished):
+            signal.disconnect(close_old_connections)
+            self.addCleanup(signal.connect, close_old_connections)
+
+    def request(self, method, path, body=b'', handler=None, send=None, **headers):
+        '''Returns status, headers and body of the response'''
+        headers = dict({'host': 'testserver', 'authorization': 'Token terminal-token'}, **headers)
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'',
+                 'headers': [(name.replace('_', '-').encode(), value.encode())
+                             for name, value in headers.items()]}
+        requests = [{'type': 'http.request', 'body': body}]
+        sent = []
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            # Never disconnects
+            return await asyncio.Future()
+
+        async def record(message):
+            if send is not None:
+                await send(message)
+            sent.append(message)
+
+        self.loop.run_until_complete((handler or self.handler)(scope, receive, record))
+        self.assertEqual(sent[0]['type'], 'http.response.start')
+        self.assertFalse(sent[-1].get('more_body'))
+        return (sent[0]['status'], dict(sent[0]['headers']),
+                b''.join(m.get('body', b'') for m in sent[1:]))
+
+    def test_authorize(self):
+        permission = models.Permission.objects.create(
+            granted_to=self.profile, permission_group=self.group)
+        status, headers, body = self.request(
+            'POST', '/luacs/api/authorize/', content_type='application/json',
+            body=json.dumps({'device': 'laser', 'id_type': 'rfid', 'id_string': '42'}).encode())
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode())['permission'], permission.pk)
+
+    def test_stream(self):
+        since = models.Change.objects.last_seq()
+        models.Permission.objects.create(granted_to=self.profile, permission_group=self.group)
+        status, headers, body = self.request('GET', '/luacs/api/changes/stream/',
+                                             last_event_id=str(since))
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b'content-type'], b'text/event-stream')
+        self.assertIn('id: {}\nevent: change\n'.format(since + 1), body.decode())
+        self.assertIn('"model": "permission"', body.decode())
+
+        # Invalid tokens are left to Django
+        status, headers, body = self.request('GET', '/luacs/api/changes/stream/',
+                                             authorization='Token invalid')
+        self.assertEqual(status, 403)
+
+    def test_backpressure(self):
+        produced = []
+        ahead = []
+
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            for i in range(100):
+                produced.append(i)
+                yield b'x'
+
+        async def send(message):
+            # A slow client
+            await asyncio.sleep(0.001)
+            if message.get('body'):
+                ahead.append(len(produced) - len(ahead))
+
+        handler = ASGIHandler(application, executor=SharedConnectionExecutor())
+        status, headers, body = self.request('GET', '/export/', handler=handler, send=send)
+        self.assertEqual(body, b'x' * 100)
+        # The thread only produced the queued chunks, and the one it waits to queue
+        self.assertLessEqual(max(ahead), QUEUE_SIZE + 2)
+
+    def test_lifespan(self):
+        messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message['type'])
+        self.loop.run_until_complete(self.handler({'type': 'lifespan'}, receive, send))
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
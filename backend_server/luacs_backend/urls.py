@@ -11,8 +11,12 @@ router.register(r'terminals', apiviews.TerminalViewSet)
 router.register(r'profiles', apiviews.ProfileViewSet)
 router.register(r'permissions', apiviews.PermissionViewSet)
 router.register(r'permission_groups', apiviews.PermissionGroupViewSet)
+router.register(r'changes', apiviews.ChangeViewSet)
+router.register(r'usage', apiviews.UsageViewSet)
 
 urlpatterns = [
+    url(r'^api/authorize/$', apiviews.AuthorizeView.as_view(), name='authorize'),
     url(r'^api/', include(router.urls)),
+    url(r'^metrics$', views.metrics, name='metrics'),
     url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework'))
 ]
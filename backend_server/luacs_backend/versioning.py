@@ -0,0 +1,36 @@
+'''
+API versions
+
+Version 1 is the hyperlinked representation, version 2 the compact one meant for terminals:
+primary keys instead of URLs, durations as integer seconds and flat arrays instead of nested
+objects. Clients select it with "Accept: application/json; version=2" or ?version=2.
+'''
+from django.utils.translation import ugettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.versioning import AcceptHeaderVersioning
+
+
+COMPACT = '2'
+
+
+class AcceptHeaderOrQueryParameterVersioning(AcceptHeaderVersioning):
+    '''Takes the version from the query parameter if given, else from the Accept header'''
+    invalid_query_version_message = _('Invalid version in query parameter.')
+
+    def determine_version(self, request, *args, **kwargs):
+        version = request.query_params.get(self.version_param)
+        if version is None:
+            return super().determine_version(request, *args, **kwargs)
+        if not self.is_allowed_version(version):
+            raise exceptions.NotFound(self.invalid_query_version_message)
+        return version
+
+
+class CompactMixin:
+    '''Serializes with compact_serializer_class if the compact representation was requested'''
+    compact_serializer_class = None
+
+    def get_serializer_class(self):
+        if self.request.version == COMPACT and self.compact_serializer_class is not None:
+            return self.compact_serializer_class
+        return super().get_serializer_class()
@@ -1,3 +1,12 @@
+from django.contrib.auth.decorators import user_passes_test
+from django.http import HttpResponse
 from django.shortcuts import render
 
-# Create your views here.
+from . import metrics as request_metrics
+
+
+@user_passes_test(lambda u: u.is_superuser)
+def metrics(request):
+    '''Exports the request metrics of this process in the Prometheus text format'''
+    return HttpResponse(request_metrics.registry.render(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
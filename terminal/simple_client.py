@@ -3,12 +3,18 @@ import argparse
 from pprint import pprint
 import logging
 from datetime import timedelta, datetime
+import json
 import threading
 import re
 import sys
 
 import requests
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 
 def timedelta_from_str(s):
     '''Parses timedelta.__str___ back to timedelta objects'''
@@ -31,39 +37,92 @@ class TerminalBackendInterface:
     def __init__(self, token, base_url):
         self.token = token
         self.base_url = base_url
-        self._auth_header = {'Authorization': 'Token '+self.token}
+        # Compact representation: primary keys, durations in seconds. MessagePack is smaller and
+        # faster to decode than JSON, if available.
+        self._media_type = 'application/msgpack' if msgpack else 'application/json'
+        self._auth_header = {'Authorization': 'Token '+self.token,
+                             'Accept': self._media_type + '; version=2'}
+        # Bodies of GET requests with an ETag, revalidated with If-None-Match
+        self._cache = {}
         # Information to be retrieved from backend
         self._info = self.api_get('/terminals/myself')
 
-    def api_get(self, api_path):
+    def api_get(self, api_path, params=None):
         '''
         Requests and returns a json object
         
-        api_path may be a full URL or an absolut path bellow base_url.
+        api_path may be a full URL or an absolut path bellow base_url. Returns None if the
+        requested object does not exist.
         '''
         # TODO add support for caching incase a timeout / network error is seen
         
         url = api_path if self.base_url in api_path else self.base_url+api_path
-        r = requests.get(url, headers=self._auth_header)
-        return r.json()
+        key = (url, tuple(sorted((params or {}).items())))
+        headers = self._auth_header
+        if key in self._cache:
+            headers = dict(headers, **{'If-None-Match': self._cache[key][0]})
+        r = requests.get(url, params=params, headers=headers)
+        if r.status_code == 304:
+            return self._cache[key][1]
+        if r.status_code == 404:
+            self._cache.pop(key, None)
+            return None
+        data = self._decode(r)
+        if 'ETag' in r.headers:
+            self._cache[key] = (r.headers['ETag'], data)
+        return data
 
-    def identify_user(self, id_type, id_str):
-        '''Returns user that machtes id_type and id_str'''
-        # TODO FIXME use api filtering features
-        user = [p for p in self.api_get('/profiles/')['results']
-                if p['id_type'] == id_type and p['id_string'] == id_str]
-        if user:
-            return user[0]
+    def api_post(self, api_path, data):
+        '''Posts data and returns the json response'''
+        url = api_path if self.base_url in api_path else self.base_url+api_path
+        if msgpack:
+            headers = dict(self._auth_header, **{'Content-Type': self._media_type})
+            r = requests.post(url, data=msgpack.packb(data, use_bin_type=True), headers=headers)
         else:
+            r = requests.post(url, json=data, headers=self._auth_header)
+        r.raise_for_status()
+        return self._decode(r)
+
+    def _decode(self, response):
+        '''Returns the decoded body, the backend may fall back to JSON'''
+        if response.headers.get('Content-Type', '').startswith('application/msgpack'):
+            return msgpack.unpackb(response.content, raw=False)
+        return response.json()
+
+    def authorize(self, dev_shortname, id_type, id_str):
+        '''
+        Returns the authorization decision for the user identified by id_type and id_str on device
+
+        The result contains 'authorized', 'reason', 'permission', 'valid_until', 'user' and the
+        devices logout policy ('device').
+        '''
+        return self.api_post('/authorize/', {'device': dev_shortname,
+                                             'id_type': id_type, 'id_string': id_str})
+
+    def get_authorization(self, permission_id):
+        '''
+        Returns the authorization (like authorize()) granted by a permission, None if the
+        permission is not valid anymore
+        '''
+        perm = self.api_get('/permissions/{}/'.format(permission_id),
+                            params={'expand': 'granted_to'})
+        if perm is None:
             return None
+        profile = perm['granted_to']
+        name = ('{} {}'.format(profile['first_name'], profile['last_name']).strip() or
+                profile['username'])
+        return {'authorized': True, 'reason': None, 'permission': perm['id'],
+                'valid_until': perm['valid_until'],
+                'user': {'id': profile['id'], 'name': name}}
+
+    def identify_user(self, id_type, id_str):
+        '''Returns user that machtes id_type and id_str'''
+        return self.api_get('/profiles/lookup/', params={'id_type': id_type, 'id_string': id_str})
 
     def check_permission(self, user_id, dev_shortname):
         '''Returns permission that authorizes user to use device'''
-        # TODO FIXME use api filtering features
-        dev = self.api_get('/devices/'+dev_shortname)
-        perm = [p for p in self.api_get('/permissions/')['results']
-                if p['granted_to_id'] == user_id and 
-                p['permission_group'] == dev['required_permission_group']]
+        perm = self.api_get('/permissions/', params={'granted_to': user_id,
+                                                     'device': dev_shortname})['results']
         if perm:
             return perm[0]
         else:
@@ -81,12 +140,43 @@ class TerminalBackendInterface:
         url = self.base_url+'/device/'+shortname+'/status'
         request.put(url, data=data, header=self._auth_header)
 
+    def changes(self, last_event_id=None):
+        '''
+        Yields relevant changes (permissions, devices, device status) as they happen
+
+        Reads the server-sent event stream and reconnects whenever the server closes it, resuming
+        after the last received change. Yields {'resync': True} if changes were missed, the
+        terminal then has to refetch its state.
+        '''
+        headers = dict(self._auth_header, **{'Accept': 'text/event-stream'})
+        while True:
+            if last_event_id is not None:
+                headers['Last-Event-ID'] = str(last_event_id)
+            r = requests.get(self.base_url+'/changes/stream/', headers=headers, stream=True)
+            r.raise_for_status()
+            event = {}
+            for line in r.iter_lines(decode_unicode=True):
+                if line:
+                    field, _, value = line.partition(': ')
+                    event[field] = value
+                    continue
+                # An empty line ends the event
+                if 'data' in event:
+                    data = json.loads(event['data'])
+                    if event.get('event') == 'resync':
+                        last_event_id = None
+                    elif 'id' in event:
+                        last_event_id = event['id']
+                    yield data
+                event = {}
+
     def get_devices(self):
         '''Creates and returns all devices configured on this terminal'''
+        # All devices embedded in one response
+        info = self.api_get('/terminals/myself/', params={'expand': 'devices'})
         devices = []
-        for dev_url in self._info['devices']:
+        for dev_info in info['devices']:
             # TODO add informtion on device class and configuration to backend Device model
-            dev_info = self.api_get(dev_url)
             dev = DeviceInterfaceDummy(**dev_info)
             devices.append(dev)
         return devices
@@ -203,6 +293,9 @@ def interactive(backend):
                     cur_dev = d
                     # get permission from device (there might be somebody logged in)
                     cur_perm = cur_dev.authorization
+                    if cur_perm is not None and not isinstance(cur_perm, dict):
+                        # Devices in use at startup only know the id of the permission
+                        cur_perm = backend.get_authorization(cur_perm)
         # 2. Identify and authortize user
         if not cur_perm:
             print('Identifcation <id_type> <id_str>: ', end='', flush=True)
@@ -211,17 +304,15 @@ def interactive(backend):
             except ValueError as e:
                 print('! wrong format', e)
                 continue
-            cur_user = backend.identify_user(id_type, id_str)
-            if not cur_user:
+            auth = backend.authorize(cur_dev.shortname, id_type, id_str)
+            if not auth['user']:
                 print("! could not identify user.")
                 # TODO Register new user here
                 continue
-            # Check permission
-            cur_perm = backend.check_permission(cur_user['id'], cur_dev.shortname)
-            if not cur_perm:
-                cur_user = None
+            if not auth['authorized']:
                 print("! no valid permission found")
                 continue
+            cur_perm = auth
         
         # Login to device
         cur_dev.login(cur_perm)
@@ -229,7 +320,8 @@ def interactive(backend):
         # Device shell
         print('Commands are: op, nop, change id, change dev, logout, grant <id_type> <id_str>')
         while True:
-            print('{} on {}> '.format(cur_perm['granted_to_id'], cur_dev.shortname), end='', flush=True)
+            print('{} on {}> '.format(cur_perm['user']['name'], cur_dev.shortname), end='',
+                  flush=True)
             cmd = sys.stdin.readline().strip()
             if cmd == 'help':
                 print('Commands are: op, nop, change id, change device, logout, '